@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import codecs
 import glob
 import os
 
@@ -11,7 +12,14 @@ import qpid.messaging as qm
 import time
 import requests
 import struct
+import threading
+from collections import OrderedDict
 from logger import get_logger
+from log_tailer import LOG_EVENTS, LogEvents, LogTailer, get_tailer
+from multiprocessing.pool import ThreadPool
+from running_stats import RecordStats
+from requests.adapters import HTTPAdapter
+import simplejson
 import simplejson.scanner
 
 
@@ -33,7 +41,134 @@ DEFAULT_STANDARD_TIMEOUT = 60
 
 EDEX_BASE_URL = 'http://%s:12575/sensor/inv/%s/%s/%s'
 
-results_cache = {}
+# connections kept alive per host, enough for the validate_dataset thread pool
+HTTP_POOL_SIZE = 32
+# default number of concurrent queries made by get_from_edex_many
+MAX_EDEX_REQUESTS = 8
+
+# size of the retrieved responses kept in the results cache
+RESULTS_CACHE_BYTES = 256 * 1024 * 1024
+
+# bytes read at a time from a streamed response
+STREAM_CHUNK_SIZE = 65536
+# characters which may continue a JSON number
+JSON_NUMBER_CHARS = frozenset(u'0123456789+-.eE')
+# edex sends NaN as the string u'NaN'
+NAN = float('nan')
+
+http_session = None
+http_session_lock = threading.Lock()
+
+
+class ResultsCache(object):
+    """
+    Thread-safe least recently used cache with a byte-size budget.  Concurrent gets of the same missing key share
+    one fetch: the first caller fetches while the others wait for its result.
+    """
+
+    def __init__(self, max_bytes=RESULTS_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> (value, size) in least to most recently used order
+        self.entries = OrderedDict()
+        self.size = 0
+        # key -> _Flight for fetches in progress
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    def get(self, key, fetch):
+        """
+        Fetch a value from the cache, or from the fetch function if it is not cached
+        :param key:  cache key
+        :param fetch:  function returning a (value, size in bytes) tuple, called for a miss
+        :return:  the value
+        """
+        with self.lock:
+            if key in self.entries:
+                entry = self.entries.pop(key)
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[0]
+            flight = self.in_flight.get(key)
+            if flight is None:
+                flight = self.in_flight[key] = _Flight()
+                self.misses += 1
+                owner = True
+            else:
+                self.shared += 1
+                owner = False
+
+        if not owner:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value, size = fetch()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            self.put(key, flight.value, size)
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            flight.event.set()
+        return flight.value
+
+    def put(self, key, value, size):
+        """
+        Store a value, evicting the least recently used values to stay within the byte budget.  A value larger
+        than the whole budget is not stored.
+        :param key:  cache key
+        :param value:  value to store
+        :param size:  size of the value in bytes
+        """
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            while self.entries and self.size + size > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1][1]
+                self.evictions += 1
+            self.entries[key] = (value, size)
+            self.size += size
+
+    def clear(self):
+        """
+        Drop all cached values
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        :return:  dictionary of hit, miss, shared fetch and eviction counts, and the number and bytes of entries
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'shared': self.shared, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.size}
+
+
+class _Flight(object):
+    """
+    A fetch in progress, holding its result or error once the event is set
+    """
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+results_cache = ResultsCache()
 
 
 def get_qpid():
@@ -45,6 +180,24 @@ def get_qpid():
     return qpid_session
 
 
+def get_http_session():
+    """
+    Fetch the shared requests session, creating it on first use.  Connections are pooled and kept alive between
+    queries, and the session is shared by all threads.
+    :return: requests.Session
+    """
+    global http_session
+    if http_session is None:
+        with http_session_lock:
+            if http_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                http_session = session
+    return http_session
+
+
 def purge_edex(table='PURGE_ALL_DATA'):
     purge_message = qm.Message(content=table, content_type='text/plain', user_id=user)
     log.info('Purging edex')
@@ -76,8 +229,94 @@ def get_record_json(record):
         return []
 
 
+def iter_json_array(chunks):
+    """
+    Incrementally decode a JSON array, yielding each element as soon as it is complete so only the undecoded
+    remainder of the input is held in memory.
+    :param chunks:  iterable of UTF-8 encoded byte strings making up the JSON text
+    :return:  generator of the decoded array elements
+    :raises ValueError:  if the input is not a well formed JSON array
+    """
+    decoder = simplejson.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = u''
+    pos = 0
+    eof = False
+    started = False
+    # a value is expected next, and the array may be closed next
+    expect_value = True
+    can_close = True
+
+    while True:
+        while pos < len(buf) and buf[pos] in u' \t\r\n':
+            pos += 1
+
+        # read more input if the buffer is used up, or the next value may be incomplete
+        if pos == len(buf):
+            if eof:
+                raise ValueError('Unterminated JSON array')
+            text, eof = _read_json_chunks(chunks, text_decoder, 1)
+            buf, pos = text, 0
+            continue
+
+        char = buf[pos]
+        if not started:
+            if char != u'[':
+                raise ValueError('Expected a JSON array at %d' % pos)
+            started = True
+            pos += 1
+        elif char == u']' and can_close:
+            return
+        elif not expect_value:
+            if char != u',':
+                raise ValueError('Expected , or ] in JSON array')
+            expect_value = True
+            can_close = False
+            pos += 1
+        else:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = None
+            if end is None or (not eof and type(value) in (int, long, float) and
+                               all(c in JSON_NUMBER_CHARS for c in buf[end:])):
+                # the value may continue in the next chunk, read on until the remainder has at least doubled so a
+                # long value is only copied and decoded again a logarithmic number of times
+                text, eof = _read_json_chunks(chunks, text_decoder, len(buf) - pos)
+                buf, pos = buf[pos:] + text, 0
+                continue
+            pos = end
+            expect_value = False
+            can_close = True
+            yield value
+
+
+def _read_json_chunks(chunks, text_decoder, wanted):
+    """
+    Read and decode chunks of input until at least the wanted number of characters are read, joining them once
+    :param wanted:  number of characters to read, unless the input is used up first
+    :return:  (decoded text, True if the input is used up) tuple
+    """
+    pieces = []
+    length = 0
+    eof = False
+    while length < wanted and not eof:
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            chunk = b''
+            eof = True
+        piece = text_decoder.decode(chunk, eof)
+        pieces.append(piece)
+        length += len(piece)
+    return u''.join(pieces), eof
+
+
 def get_edex_metadata(hostname, subsite, node, sensor):
-    r = requests.get(EDEX_BASE_URL % (hostname, subsite, node, sensor) + '/metadata/parameters')
+    r = get_http_session().get(EDEX_BASE_URL % (hostname, subsite, node, sensor) + '/metadata/parameters')
     try:
         r = r.json()
     except:
@@ -90,9 +329,43 @@ def get_edex_metadata(hostname, subsite, node, sensor):
     return d
 
 
-def get_from_edex(hostname, subsite, node, sensor, method, stream, start_time, stop_time, timestamp_as_string=False, netcdf=False):
+def stream_edex_records(url, params, keep_arrays=False, nbytes=None):
+    """
+    Retrieve records from edex, decoding the response and restoring the lists in each record as it is read, so only
+    one record is held at a time
+    :param url:  edex stream url
+    :param params:  query parameters
+    :param keep_arrays:  leave array parameters as numpy arrays rather than lists
+    :param nbytes:  optional one element list the number of response bytes read is added to
+    :return:  generator of records, closing the response when exhausted or closed
+    :raises ValueError:  if the response is not a JSON array
+    """
+    r = get_http_session().get(url, params=params, stream=True)
+    # all records are from the one stream
+    schema = RecordSchema()
+
+    def chunks():
+        for chunk in r.iter_content(STREAM_CHUNK_SIZE):
+            if nbytes is not None:
+                nbytes[0] += len(chunk)
+            yield chunk
+
+    try:
+        for record in iter_json_array(chunks()):
+            restore_lists(record, schema, keep_arrays)
+            yield record
+    finally:
+        r.close()
+
+
+def get_from_edex(hostname, subsite, node, sensor, method, stream, start_time, stop_time, timestamp_as_string=False, netcdf=False,
+                  streaming=False, keep_arrays=False):
     """
     Retrieve all stored sensor data from edex
+    :param streaming:  decode the response as it is read, restoring the lists in each record as it arrives, rather
+                       than holding the whole response body and decoding it in one go.  Every decoded record is still
+                       kept for the results cache, so this saves the memory of the response body, not of the records.
+    :param keep_arrays:  leave array parameters as numpy arrays rather than lists
     :return: list of edex records
     """
     url = EDEX_BASE_URL % (hostname, subsite, node, sensor) + '/%s/%s' % (method, stream)
@@ -106,43 +379,89 @@ def get_from_edex(hostname, subsite, node, sensor, method, stream, start_time, s
     if netcdf:
         netcdf_file = os.path.join('%s-%s.nc' % (stream, sensor))
         with open(netcdf_file, 'wb') as fh:
-            r = requests.get(url, params={'format': 'application/netcdf'})
+            r = get_http_session().get(url, params={'format': 'application/netcdf'})
             fh.write(r.content)
             return
 
-    results_key = (url, start_time, stop_time)
+    # the cached records have their lists restored, as numpy arrays or not, but are the same whether streamed or not
+    results_key = (url, start_time, stop_time, keep_arrays)
+    # all records are from the one stream
+    schema = RecordSchema()
 
-    if results_key not in results_cache:
+    def fetch_streaming():
         now = time.time()
-        r = requests.get(url, params=data)
+        nbytes = [0]
+        try:
+            records = list(stream_edex_records(url, data, keep_arrays, nbytes))
+        except ValueError as e:
+            log.warn('unable to decode record as JSON - %s - skipping data from: %s', e, url)
+            records = []
+        elapsed = time.time() - now
+        log.info('Took %.2f secs to retrieve and de-jsonify the data from: %s', elapsed, url)
+        return records, nbytes[0]
+
+    def fetch():
+        if streaming:
+            return fetch_streaming()
+        now = time.time()
+        r = get_http_session().get(url, params=data)
         elapsed = time.time() - now
         log.info('Took %.2f secs to retrieve data from: %s', elapsed, r.url)
 
         now = time.time()
         records = get_record_json(r)
+        for record in records:
+            restore_lists(record, schema, keep_arrays)
         elapsed = time.time() - now
         log.info('Took %.2f secs to de-jsonify the data', elapsed)
+        # the response size stands in for the size of the decoded records
+        return records, len(r.content)
 
-        results_cache[results_key] = records
-
-    records = results_cache[results_key]
+    # the cached records are shared by every caller, so are copied rather than changed here
+    records = results_cache.get(results_key, fetch)
 
     #log.debug('RETRIEVED:')
     #log.debug(pprint.pformat(records, depth=3))
     d = {}
     for record in records:
         timestamp = record.get('pk', {}).get('time')
-        restore_lists(record)
 
         if timestamp is not None and timestamp_as_string:
             timestamp = '%12.3f' % timestamp
 
-        record['timestamp'] = timestamp
+        record = dict(record, timestamp=timestamp)
         d.setdefault((stream, timestamp), []).append(record)
 
     return d
 
 
+def get_from_edex_many(hostname, queries, timestamp_as_string=False, max_requests=MAX_EDEX_REQUESTS, streaming=False):
+    """
+    Retrieve stored sensor data for many streams from edex concurrently
+    :param hostname:  edex host
+    :param queries:  list of (subsite, node, sensor, method, stream, start_time, stop_time) tuples
+    :param timestamp_as_string:  passed to get_from_edex
+    :param max_requests:  maximum number of queries in flight at once
+    :param streaming:  passed to get_from_edex
+    :return: dictionary of query tuple -> get_from_edex result for that query
+    """
+    def fetch(query):
+        subsite, node, sensor, method, stream, start_time, stop_time = query
+        return get_from_edex(hostname, subsite, node, sensor, method, stream, start_time, stop_time,
+                             timestamp_as_string=timestamp_as_string, streaming=streaming)
+
+    queries = list(queries)
+    if not queries:
+        return {}
+    pool = ThreadPool(min(max_requests, len(queries)))
+    try:
+        results = pool.map(fetch, queries)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(queries, results))
+
+
 def nanize(l):
     rlist = []
     for x in l:
@@ -153,25 +472,113 @@ def nanize(l):
     return rlist
 
 
-def restore_lists(record):
-    shapes = []
-    for k in record:
-        if k.endswith('_shape'):
-            shapes.append(k)
+def nanize_list(values):
+    """
+    Replace the u'NaN' strings edex sends for NaN with float NaN.  Only values whose type shows they are strings are
+    compared with u'NaN', as comparing a number with a unicode string is slow in python 2.
+    :param values:  flat list of values
+    :return:  list with the NaN strings replaced, values itself if it has none
+    """
+    types = set(map(type, values))
+    if unicode not in types and str not in types:
+        return values
+    strings = [i for i, x in enumerate(values) if x.__class__ is unicode or x.__class__ is str]
+    nans = [i for i in strings if values[i] == u'NaN']
+    if not nans:
+        return values
+    values = list(values)
+    for i in nans:
+        values[i] = NAN
+    return values
+
+
+def nanize_array(values):
+    """
+    Build a numpy array from a list of values, replacing the u'NaN' strings edex sends for NaN with float NaN.
+    Numbers are never converted to strings, which would lose precision.
+    :param values:  flat list of values
+    :return:  numpy array, an object array if values holds strings other than NaN
+    """
+    nanized = nanize_list(values)
+    array = numpy.array(nanized)
+    if nanized is not values and array.dtype.kind in 'SU':
+        # mixed with other strings, keep the original objects
+        return numpy.array(nanized, dtype=object)
+    return array
 
-    for k in shapes:
-        array_key = k.replace('_shape','')
+
+def reshape_list(values, shape):
+    """
+    Nest a flat list of values into lists of the given shape, in the row major order of numpy.reshape
+    :param values:  flat list of values, with as many values as the shape holds
+    :param shape:  list of dimensions, none of them zero
+    :return:  nested lists, or the single value for an empty shape
+    """
+    if not shape:
+        return values[0]
+    for size in reversed(shape[1:]):
+        values = [values[i:i + size] for i in xrange(0, len(values), size)]
+    return values
+
+
+class RecordSchema(object):
+    """
+    The shaped array keys of the records of one stream, learned from the first record and only looked for again
+    when a record has a different set of keys
+    """
+
+    def __init__(self):
+        self.keys = None
+        # list of (shape key, array key) tuples
+        self.shaped = []
+
+    def shaped_keys(self, record):
+        """
+        :param record:  edex record
+        :return:  list of (shape key, array key) tuples in the record
+        """
+        keys = record.viewkeys()
+        if self.keys is None or keys != self.keys:
+            self.keys = frozenset(keys)
+            self.shaped = [(k, k.replace('_shape', '')) for k in keys if k.endswith('_shape')]
+        return self.shaped
+
+
+def restore_lists(record, schema=None, keep_arrays=False):
+    """
+    Restore the shape of the flattened array parameters in an edex record, dropping the shape keys
+    :param record:  edex record
+    :param schema:  RecordSchema shared by the records of a stream, so the shaped keys are only found once
+    :param keep_arrays:  leave the parameters as numpy arrays instead of converting them back to lists
+    """
+    if schema is None:
+        shapes = [(k, k.replace('_shape', '')) for k in record if k.endswith('_shape')]
+    else:
+        shapes = schema.shaped_keys(record)
+
+    for k, array_key in shapes:
         shape = record[k]
-        array = numpy.array(nanize(record.get(array_key, [])))
+        values = record.get(array_key, [])
 
-        if numpy.product(shape) == len(array):
-            array = array.reshape(shape)
+        if not keep_arrays and all(shape) and numpy.product(shape) == len(values):
+            # nest the lists directly rather than through a numpy array
+            record[array_key] = reshape_list(nanize_list(values), shape)
         else:
-            log.error('Shape wrong? %r %d %s', shape, len(array), array)
-        record[array_key] = array.tolist()
+            array = nanize_array(values)
+            if numpy.product(shape) == len(array):
+                array = array.reshape(shape)
+            else:
+                log.error('Shape wrong? %r %d %s', shape, len(array), array)
+            record[array_key] = array if keep_arrays else array.tolist()
         del(record[k])
 
 
+# fields diff ignores, and renames before comparison, by default
+DIFF_IGNORE = ['particle_object', 'quality_flag', 'driver_timestamp', 'ingestion_timestamp',
+               'stream_name', 'preferred_timestamp', 'port_timestamp', 'pk', 'timestamp', 'provenance']
+DIFF_RENAME = {'particle_type': 'stream_name'}
+
+
 # noinspection PyClassHasNoInit
 class FAILURES:
     MISSING_SAMPLE = 'MISSING_SAMPLE'
@@ -195,41 +602,75 @@ def find_latest_log():
     return fh
 
 
+def log_cursor():
+    """
+    Mark the current position in the EDEX log, starting the shared log tailer if needed.  Will throw OSError if
+    there are no log files.
+    :return:  cursor to pass to watch_log_for as logfile, to count lines written from now on
+    """
+    return get_tailer(log_dir).cursor()
+
+
+def watch_log_events(logfile=None, callback=None, patterns=LOG_EVENTS):
+    """
+    Count ingest complete, exception and purge events in the EDEX log, per file and per queue.  Will throw OSError
+    if there are no log files.  Call close on the result when done.
+    :param logfile:  cursor from log_cursor to count from, defaults to lines written to the log from now on
+    :param callback:  function called with each LogEvent as it is seen
+    :param patterns:  ordered dictionary of event name -> regex to match
+    :return:  LogEvents counting the events
+    """
+    return LogEvents(patterns, callback).attach(get_tailer(log_dir), logfile)
+
+
 def watch_log_for(expected_string, logfile=None, expected_count=1, timeout=DEFAULT_STANDARD_TIMEOUT):
     """
     Wait for expected string to appear in log file.
     :param expected_string:   string to watch for in log file
-    :param logfile:   file to watch
+    :param logfile:   cursor from log_cursor to watch from, or file handle to follow from its current position,
+                      defaults to lines written to the log from now on
     :param expected_count:  number of occurrences expected
     :param timeout:  maximum time to wait for expected string
     :return:  True if expected string occurs before specified timeout, False otherwise.
     """
-    if logfile is None:
-        try:
-            logfile = find_latest_log()
-        except OSError as e:
-            log.error('Error fetching latest log file - %s', e)
-            return False
+    private_tailer = None
+    since = None
+    try:
+        if logfile is None or isinstance(logfile, (int, long)):
+            tailer = get_tailer(log_dir)
+            since = logfile
+        else:
+            tailer = private_tailer = LogTailer(fh=logfile).start()
+    except OSError as e:
+        log.error('Error fetching latest log file - %s', e)
+        return False
 
-    log.info('waiting for %s in logfile: %s', expected_string, logfile.name)
+    log.info('waiting for %s in logfile: %s', expected_string, tailer.path)
     log.info('timeout value: %s', timeout)
 
-    end_time = time.time() + timeout
-    count = 0
+    found = threading.Event()
+    count = [0]
 
+    def check_line(line):
+        if expected_string in line and not found.is_set():
+            count[0] += 1
+            log.info('Found expected string %d times of %d', count[0], expected_count)
+            if count[0] == expected_count:
+                found.set()
+
+    subscription = tailer.subscribe(check_line, since)
+    end_time = time.time() + timeout
     try:
-        while time.time() < end_time:
-            data = logfile.read()
-            for line in data.split('\n'):
-                if expected_string in line:
-                    count += 1
-                    log.info('Found expected string %d times of %d', count, expected_count)
-                    if count == expected_count:
-                        return True
-            time.sleep(.1)
+        # wait in short steps so KeyboardInterrupt is seen
+        while not found.is_set() and time.time() < end_time:
+            found.wait(min(1.0, max(0.0, end_time - time.time())))
     except KeyboardInterrupt:
         pass
-    return False
+    finally:
+        tailer.unsubscribe(subscription)
+        if private_tailer is not None:
+            private_tailer.stop()
+    return found.is_set()
 
 
 def parse_scorecard(scorecard):
@@ -305,54 +746,50 @@ def parse_scorecard(scorecard):
     return '\n'.join(result), table_data
 
 
-def edex_mio_report(hostname, stream, instrument, output_dir='.'):
+def edex_mio_report(hostname, stream, instrument, method, output_dir='.', exact_median=False):
     """
     Calculate statistics for captured data stream and write to CSV file output_dir/<stream>-<instrument>.csv.
+    The retrieved records are saved to output_dir/<stream>-<instrument>.json.  Each record is added to the
+    statistics and written out as it is decoded, so the stream is never held in memory or in the results cache.
     :param stream:      stream name
-    :param instrument:  instrument name
+    :param instrument:  instrument reference designator, <subsite>-<node>-<sensor>
+    :param method:      delivery method of the stream
     :param output_dir:  location to write mio report
+    :param exact_median:  keep all values for exact medians rather than estimating them in constant memory
     :return:            none
     """
 
     stat_file = os.path.join(output_dir, '%s-%s.csv' % (stream, instrument))
     json_file = os.path.join(output_dir, '%s-%s.json' % (stream, instrument))
 
-    data = edex_get_json(hostname, stream, instrument, sample_data_file=json_file, save_sample_data=True)
-    d = {}
+    subsite, node, sensor = instrument.split('-', 2)
+    url = EDEX_BASE_URL % (hostname, subsite, node, sensor) + '/%s/%s' % (method, stream)
+    params = {'beginDT': ntptime_to_string(ntplib.system_to_ntp_time(1) - .1), 'endDT': ntptime_to_string(1e10 + .1)}
 
-    # first pass to extract data values
-    for record in data:
-        for param in record:
-            d.setdefault(param, []).append(record[param])
+    # single pass over the records
+    stats = RecordStats(exact_median)
+    log.info('saving sample data to %s', json_file)
+    with open(json_file, 'wb') as f:
+        f.write('[')
+        try:
+            for count, record in enumerate(stream_edex_records(url, params)):
+                if count:
+                    f.write(', ')
+                simplejson.dump(record, f)
+                stats.add(record)
+        except ValueError as e:
+            log.warn('unable to decode record as JSON - %s - skipping the rest of the data from: %s', e, url)
+        f.write(']')
 
-    # second pass to compute statistics
     log.info('saving statistics to %s', stat_file)
     with open(stat_file, 'wb') as f:
         f.write("key,count,min,max,median,mean,sigma\n")
-        for param in sorted(d.keys()):
-            value = numpy.array(d[param])
-            dtype = value.dtype
-            if dtype.kind in 'iuf':
-                # expect 1 or 2-d arrays - other multi-dimensional arrays are not supported
-                if len(value.shape) > 1:
-                    value = numpy.transpose(value)
-                    for i, row in enumerate(value):
-                        v_min = numpy.min(row)
-                        v_max = numpy.max(row)
-                        median = numpy.median(row)
-                        mean = numpy.mean(row)
-                        sigma = numpy.std(row)
-                        f.write("%s(%d),%d,%f,%f,%f,%f,%f\n" % (param, i, len(row), v_min, v_max, median, mean, sigma))
-
-                v_min = numpy.min(value)
-                v_max = numpy.max(value)
-                median = numpy.median(value)
-                mean = numpy.mean(value)
-                sigma = numpy.std(value)
-                f.write("%s,%d,%f,%f,%f,%f,%f\n" % (param, len(value), v_min, v_max, median, mean, sigma))
+        for param in sorted(stats.params.keys()):
+            param_stats = stats.params[param]
+            if param_stats.numeric:
+                for row in param_stats.rows(param):
+                    f.write("%s,%d,%f,%f,%f,%f,%f\n" % row)
             else:
-                s = set()
-                s.update(list(value.flatten()))
                 log.info(" - skipping non-numeric data for %s", param)
 
 
@@ -426,12 +863,17 @@ def same(a, b, errors, float_tolerance=0.001):
 
 def compare(stored, expected, metadata, ignore_nulls=False, lookup_preferred_timestamp=False):
     """
-    Compares a set of expected results against the retrieved values
+    Compares a set of expected results against the retrieved values.  Expected records are joined to the stored
+    records with the same stream and timestamp, the numeric parameters of all the joined pairs are compared a
+    column at a time, and only the parameters not already known to match are compared with diff.
     :param stored:
     :param expected:
     :return: list of failures
     """
     failures = []
+    # failure, or (expected record, stream name, timestamp, candidate stored records) for each expected record
+    joined = []
+    pairs = []
     for record in expected:
         if lookup_preferred_timestamp:
             timestamp = '%12.3f' % record.get(record.get('preferred_timestamp'), 0.0)
@@ -449,26 +891,43 @@ def compare(stored, expected, metadata, ignore_nulls=False, lookup_preferred_tim
             if len(keys) == 1:
                 key = (timestamp, keys.pop())
             else:
-                failures.append((FAILURES.AMBIGUOUS, 'Multiple streams in output, no stream in YML'))
+                joined.append((FAILURES.AMBIGUOUS, 'Multiple streams in output, no stream in YML'))
                 log.error('Ambiguous stream information in YML file and unable to infer')
                 continue
 
-        matches = []
+        candidates = []
         for each in stored.get((stream_name, timestamp), []):
             stored_name = each.get('stream_name')
             if stored_name is None:
                 stored_name = each.get('pk', {}).get('stream_name')
             if stored_name == stream_name and each['timestamp'] == timestamp:
-                f, errors = diff(stream_name, record, each, metadata, ignore_nulls=ignore_nulls)
-                matches.append((len(f), each, f, errors))
+                candidates.append((len(pairs), each))
+                pairs.append((record, each))
+        joined.append((record, stream_name, timestamp, candidates))
+
+    equal_keys = equal_numeric_keys(pairs)
+
+    for entry in joined:
+        if len(entry) == 2:
+            failures.append(entry)
+            continue
+        record, stream_name, timestamp, candidates = entry
+
+        matches = []
+        for index, each in candidates:
+            f, errors = diff(stream_name, record, each, metadata, ignore_nulls=ignore_nulls,
+                             equal_keys=equal_keys[index])
+            matches.append((len(f), each, f, errors))
 
-        matches.sort()
         if len(matches) == 0:
             m = 'Unable to find a matching sample: %s %s' % (stream_name, timestamp)
             failures.append((FAILURES.MISSING_SAMPLE, m))
             log.error(m)
         if len(matches) > 0:
-            failcount, match, f, errors = matches[0]
+            # the closest match, ties are broken by comparing the whole tuples as sorting them would
+            failcount = min(match[0] for match in matches)
+            closest = [match for match in matches if match[0] == failcount]
+            failcount, match, f, errors = closest[0] if len(closest) == 1 else min(closest)
             if failcount > 0:
                 # we had at least one failure, but this record
                 # was the closest match; record the failures
@@ -479,6 +938,55 @@ def compare(stored, expected, metadata, ignore_nulls=False, lookup_preferred_tim
     return failures
 
 
+def equal_numeric_keys(pairs, ignore=None, rename=None, float_tolerance=0.001):
+    """
+    Find the numeric parameters which match in pairs of expected and retrieved records.  Each parameter is
+    gathered into a column of the values that have the same type, int or float, in both records, and compared
+    with numpy: floats match if equal, within the tolerance or both NaN, ints if equal, the same as same().
+    :param pairs: list of (expected record, retrieved record) tuples
+    :param ignore: fields to ignore
+    :param rename: fields to rename before comparison
+    :param float_tolerance: maximum difference between matching floats
+    :return: list of the set of retrieved record keys known to match for each pair
+    """
+    if ignore is None:
+        ignore = DIFF_IGNORE
+    if rename is None:
+        rename = DIFF_RENAME
+
+    # (key, type) -> (pair indexes, expected values, retrieved values)
+    columns = {}
+    for index, (a, b) in enumerate(pairs):
+        for k, v in a.iteritems():
+            if k in ignore or k.startswith('_'):
+                continue
+            k = rename.get(k, k)
+            if k not in b:
+                continue
+            if type(v) == dict:
+                v = v.get('value')
+            value_type = type(v)
+            if (value_type is float or value_type is int) and type(b[k]) is value_type:
+                column = columns.setdefault((k, value_type), ([], [], []))
+                column[0].append(index)
+                column[1].append(v)
+                column[2].append(b[k])
+
+    equal_keys = [set() for _ in pairs]
+    for (k, value_type), (indexes, a_values, b_values) in columns.iteritems():
+        a_values = numpy.array(a_values, dtype=value_type)
+        b_values = numpy.array(b_values, dtype=value_type)
+        if value_type is float:
+            with numpy.errstate(invalid='ignore', over='ignore'):
+                matched = (a_values == b_values) | (numpy.abs(a_values - b_values) < float_tolerance) | \
+                          (numpy.isnan(a_values) & numpy.isnan(b_values))
+        else:
+            matched = a_values == b_values
+        for index in numpy.array(indexes)[matched]:
+            equal_keys[index].add(k)
+    return equal_keys
+
+
 def check_fill(a, b):
     if type(a) == int:
         try:
@@ -496,20 +1004,22 @@ def check_fill(a, b):
 
     return a == b
 
-def diff(stream, a, b, metadata, ignore=None, rename=None, ignore_nulls=False, float_tolerance=0.001):
+def diff(stream, a, b, metadata, ignore=None, rename=None, ignore_nulls=False, float_tolerance=0.001, equal_keys=None):
     """
     Compare two data records
     :param a:
     :param b:
     :param ignore: fields to ignore
     :param rename: fields to rename before comparison
+    :param equal_keys: keys of b already known to match, which are not compared again
     :return: list of failures
     """
     if ignore is None:
-        ignore = ['particle_object', 'quality_flag', 'driver_timestamp', 'ingestion_timestamp',
-                  'stream_name', 'preferred_timestamp', 'port_timestamp', 'pk', 'timestamp', 'provenance']
+        ignore = DIFF_IGNORE
     if rename is None:
-        rename = {'particle_type': 'stream_name'}
+        rename = DIFF_RENAME
+    if equal_keys is None:
+        equal_keys = ()
 
     failures = []
     errors = []
@@ -529,6 +1039,9 @@ def diff(stream, a, b, metadata, ignore=None, rename=None, ignore_nulls=False, f
                 failures.append((FAILURES.MISSING_FIELD, message))
             continue
 
+        if k in equal_keys:
+            continue
+
         if type(v) == dict:
             v = v.get('value')
 
@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+"""
+Follow the EDEX log as it is written, across rotation to new log files, and hand each complete line to any number
+of subscribers.  Uses inotify through pyinotify when it is installed to wake up on changes, otherwise polls.
+"""
+import glob
+import os
+import re
+import threading
+import time
+from collections import deque, namedtuple, OrderedDict
+
+from logger import get_logger
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+log = get_logger()
+
+# log files of every date, unlike the today only glob of edex_tools.find_latest_log, so a tailer follows the daily
+# rotation past midnight; the latest file by modification time is followed, so older logs are never read
+LOG_PATTERN = 'edex-ooi-*.log*'
+
+# seconds between checks for new data when polling, or for rotation when woken by inotify
+POLL_INTERVAL = 0.1
+INOTIFY_INTERVAL = 1.0
+
+# number of recent lines kept so subscribers can start from a cursor taken before they subscribed
+HISTORY_LINES = 100000
+
+# name -> regex of the events counted by LogEvents, the optional file group is the full path of the ingested file
+LOG_EVENTS = OrderedDict([
+    ('ingest_complete', r'EDEX - Ingest complete for file[^/]*(?P<file>/\S+)?'),
+    ('ingest', r'Ingest: EDEX: Ingest[^/]*(?P<file>/\S+)?'),
+    ('exception', r'\b(?P<exception>[\w.$]*Exception)\b'),
+    ('purge', r'Purge Operation: (?P<table>\w+) completed'),
+])
+
+# thread name of the EDEX ingest queue consumer which logged a line
+QUEUE_PATTERN = re.compile(r'\[(?P<queue>Ingest\.[\w.-]+?)(?:-\d+)?\]')
+
+LogEvent = namedtuple('LogEvent', 'name file queue line')
+
+
+def latest_log(log_dir, pattern=LOG_PATTERN):
+    """
+    Find the most recently modified log file
+    :param log_dir:  directory holding the log files
+    :param pattern:  glob pattern matching the log files
+    :return:  path of the latest log file, or None if there are none
+    """
+    files = []
+    for f in glob.glob(os.path.join(log_dir, pattern)):
+        if f.endswith('lck'):
+            continue
+        try:
+            files.append((os.stat(f).st_mtime, f))
+        except OSError:
+            # rotated away since the glob
+            continue
+    if not files:
+        return None
+    return max(files)[1]
+
+
+class LogTailer(object):
+    """
+    Reads lines appended to the latest log file in a background thread.  A partial line at the end of the file is
+    held until the rest of it is written, and when a newer log file appears, or the file is replaced or truncated,
+    the rest of the current file is read before following the new one from its start.
+    """
+
+    def __init__(self, log_dir=None, pattern=LOG_PATTERN, fh=None, history=HISTORY_LINES):
+        """
+        :param log_dir:  directory holding the log files, the latest is followed from its current end
+        :param pattern:  glob pattern matching the log files
+        :param fh:  open log file to follow from its current position instead of finding the latest, it is left open
+                    for the caller to close
+        :param history:  number of recent lines kept for subscribers starting from an earlier cursor
+        """
+        # the tailer only closes the files it opened itself
+        self.own_fh = fh is None
+        # absolute paths, so the file followed compares equal to the latest log found in the directory
+        if fh is not None:
+            path = os.path.abspath(fh.name)
+            log_dir = os.path.dirname(path)
+        else:
+            log_dir = os.path.abspath(log_dir)
+            path = latest_log(log_dir, pattern)
+            if path is None:
+                raise OSError('No log files matching %s in %s' % (pattern, log_dir))
+            fh = open(path, 'r')
+            fh.seek(0, 2)
+        self.log_dir = log_dir
+        self.pattern = pattern
+        self.path = path
+        self.fh = fh
+        self.partial = ''
+        # sequence number of the next line, and the recent (sequence number, line) tuples
+        self.next_line = 0
+        self.history = deque(maxlen=history)
+        # lock for the history and subscribers, and lock held while handing lines to subscribers so each sees its
+        # lines in order, reentrant so a callback may subscribe
+        self.lock = threading.Lock()
+        self.delivery_lock = threading.RLock()
+        self.subscribers = {}
+        self.next_subscriber = 0
+        self.thread = None
+        self.stopped = threading.Event()
+        self.notifier = None
+
+    def start(self):
+        """
+        Start following the log in a background thread
+        :return:  self
+        """
+        if self.thread is None:
+            if pyinotify is not None:
+                watch_manager = pyinotify.WatchManager()
+                watch_manager.add_watch(self.log_dir, pyinotify.IN_MODIFY | pyinotify.IN_CREATE |
+                                        pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE)
+                self.notifier = pyinotify.Notifier(watch_manager, lambda event: None)
+            self.thread = threading.Thread(target=self.run, name='LogTailer')
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the background thread and close the log file if the tailer opened it
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.notifier is not None:
+            self.notifier.stop()
+            self.notifier = None
+        if self.own_fh:
+            self.fh.close()
+
+    def run(self):
+        """
+        Background thread, read new lines until stopped
+        """
+        while not self.stopped.is_set():
+            try:
+                self.poll()
+            except (IOError, OSError) as e:
+                log.error('Error reading log file %s - %s', self.path, e)
+            self.wait()
+
+    def wait(self):
+        """
+        Wait for the log directory to change, or for the poll interval when inotify is not available
+        """
+        if self.notifier is not None:
+            if self.notifier.check_events(int(INOTIFY_INTERVAL * 1000)):
+                self.notifier.read_events()
+                self.notifier.process_events()
+        else:
+            self.stopped.wait(POLL_INTERVAL)
+
+    def poll(self):
+        """
+        Read and dispatch any new complete lines, following the log to a new file if it has rotated
+        """
+        self.read()
+        rotated_to = self.rotated()
+        if rotated_to is not None:
+            # anything left of the old file, including a final line without a newline, comes first
+            self.read()
+            if self.partial:
+                self.dispatch([self.partial])
+                self.partial = ''
+            log.info('Following rotated log file %s', rotated_to)
+            if self.own_fh:
+                self.fh.close()
+            self.path = rotated_to
+            self.fh = open(rotated_to, 'r')
+            self.own_fh = True
+            self.read()
+
+    def read(self):
+        """
+        Read to the end of the current file, dispatching complete lines and holding any partial line
+        """
+        # seek in place to clear the end of file flag, or data appended since the last read is not seen
+        self.fh.seek(self.fh.tell())
+        data = self.fh.read()
+        if not data:
+            return
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        if lines:
+            self.dispatch(lines)
+
+    def rotated(self):
+        """
+        :return:  path of the file to follow next from its start if the log has rotated or been truncated, otherwise
+                  None
+        """
+        latest = latest_log(self.log_dir, self.pattern)
+        if latest is not None and latest != self.path:
+            return latest
+        try:
+            path_stat = os.stat(self.path)
+        except OSError:
+            # moved away, wait for the new file to appear
+            return None
+        if path_stat.st_ino != os.fstat(self.fh.fileno()).st_ino:
+            # replaced by a new file with the same name
+            return self.path
+        if path_stat.st_size < self.fh.tell():
+            # truncated, start again from the beginning
+            return self.path
+        return None
+
+    def dispatch(self, lines):
+        """
+        Record lines in the history and hand them to every subscriber.  Callbacks run outside the lock on the history
+        and subscribers, so they may use the tailer, but under the reentrant delivery lock, so every subscriber sees
+        the lines in order and a new subscriber is not handed lines twice
+        :param lines:  list of complete lines without newlines
+        """
+        with self.delivery_lock:
+            with self.lock:
+                for line in lines:
+                    self.history.append((self.next_line, line))
+                    self.next_line += 1
+                callbacks = self.subscribers.values()
+            for callback in callbacks:
+                for line in lines:
+                    callback(line)
+
+    def cursor(self):
+        """
+        :return:  cursor for the position in the log now, to subscribe from later
+        """
+        with self.lock:
+            return self.next_line
+
+    def subscribe(self, callback, since=None):
+        """
+        Call a function with every new line.  Callbacks are called from the tailer thread and should be quick, a slow
+        callback holds up the others.
+        :param callback:  function taking one line
+        :param since:  cursor to replay lines from, lines older than the history are lost
+        :return:  subscription id for unsubscribe
+        """
+        with self.delivery_lock:
+            with self.lock:
+                replay = [line for line_number, line in self.history if since is not None and line_number >= since]
+                subscription = self.next_subscriber
+                self.next_subscriber += 1
+                self.subscribers[subscription] = callback
+            for line in replay:
+                callback(line)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Stop calling a subscribed function
+        :param subscription:  subscription id returned by subscribe
+        """
+        with self.lock:
+            self.subscribers.pop(subscription, None)
+
+
+class LogEvents(object):
+    """
+    Matches each log line against all event patterns with one combined regex, counting the events in total, per
+    ingested file and per ingest queue.  Waiters block until their counts are reached, and an optional progress
+    callback is called with a LogEvent for each event.
+    """
+
+    def __init__(self, patterns=LOG_EVENTS, callback=None):
+        """
+        :param patterns:  ordered dictionary of event name -> regex, with optional file and queue groups
+        :param callback:  function called with each LogEvent, from the tailer thread
+        """
+        self.patterns = dict((name, re.compile(regex)) for name, regex in patterns.iteritems())
+        # the named groups of each pattern are made anonymous so the outer group names the event
+        self.combined = re.compile('|'.join('(?P<%s>%s)' % (name, re.sub(r'\(\?P<\w+>', '(?:', regex))
+                                            for name, regex in patterns.iteritems()))
+        self.callback = callback
+        self.condition = threading.Condition()
+        # event name -> count, event name -> normalised file path -> count, event name -> queue -> count
+        self.counts = dict((name, 0) for name in patterns)
+        self.files = dict((name, {}) for name in patterns)
+        self.queues = dict((name, {}) for name in patterns)
+        self.tailer = None
+        self.subscription = None
+        self.closed = False
+
+    def attach(self, tailer, since=None):
+        """
+        Start counting the lines from a tailer
+        :param tailer:  LogTailer to subscribe to
+        :param since:  cursor to count lines from, defaults to now
+        :return:  self
+        """
+        self.tailer = tailer
+        self.subscription = tailer.subscribe(self, since)
+        return self
+
+    def close(self):
+        """
+        Stop counting and wake any waiters
+        """
+        if self.tailer is not None:
+            self.tailer.unsubscribe(self.subscription)
+            self.tailer = None
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __call__(self, line):
+        """
+        Count the events in one log line
+        :param line:  log line without the newline
+        """
+        events = []
+        for match in self.combined.finditer(line):
+            name = match.lastgroup
+            groups = self.patterns[name].match(line, match.start()).groupdict()
+            queue = groups.get('queue')
+            if queue is None:
+                queue_match = QUEUE_PATTERN.search(line)
+                queue = queue_match.group('queue') if queue_match else None
+            events.append(LogEvent(name, groups.get('file'), queue, line))
+        if not events:
+            return
+        with self.condition:
+            for event in events:
+                self.counts[event.name] += 1
+                if event.file is not None:
+                    path = os.path.normpath(event.file)
+                    self.files[event.name][path] = self.files[event.name].get(path, 0) + 1
+                if event.queue is not None:
+                    self.queues[event.name][event.queue] = self.queues[event.name].get(event.queue, 0) + 1
+            self.condition.notify_all()
+        if self.callback is not None:
+            for event in events:
+                self.callback(event)
+
+    def count(self, name, filename=None):
+        """
+        :param name:  event name
+        :param filename:  full path of an ingested file, to count only the events for that file
+        :return:  number of events seen
+        """
+        with self.condition:
+            if filename is None:
+                return self.counts[name]
+            return self.files[name].get(os.path.normpath(filename), 0)
+
+    def unnamed(self, name):
+        """
+        :param name:  event name
+        :return:  number of events seen which did not name a file
+        """
+        with self.condition:
+            return self.counts[name] - sum(self.files[name].itervalues())
+
+    def files_done(self, name, filenames):
+        """
+        :param name:  event name
+        :param filenames:  full paths of ingested files, the same file may appear more than once
+        :return:  True if there has been an event for each of the files
+        """
+        needed = {}
+        for filename in filenames:
+            path = os.path.normpath(filename)
+            needed[path] = needed.get(path, 0) + 1
+        with self.condition:
+            return all(self.files[name].get(path, 0) >= n for path, n in needed.iteritems())
+
+    def wait(self, predicate, timeout):
+        """
+        Wait for a condition on the counters
+        :param predicate:  function of this LogEvents returning True when done, called with the counters locked
+        :param timeout:  maximum seconds to wait
+        :return:  True if the predicate became True before the timeout
+        """
+        end_time = time.time() + timeout
+        with self.condition:
+            while not predicate(self):
+                remaining = end_time - time.time()
+                if remaining <= 0 or self.closed:
+                    return False
+                # wait in short steps so KeyboardInterrupt is seen
+                self.condition.wait(min(1.0, remaining))
+            return True
+
+    def wait_count(self, name, count, timeout):
+        """
+        Wait for a number of events
+        :param name:  event name
+        :param count:  number of events expected
+        :param timeout:  maximum seconds to wait
+        :return:  True if the events were seen before the timeout
+        """
+        return self.wait(lambda events: events.counts[name] >= count, timeout)
+
+
+def log_event(event):
+    """
+    Report ingest progress and errors as they appear in the EDEX log, a progress callback for LogEvents
+    :param event:  LogEvent from the EDEX log
+    """
+    if event.name in ('ingest_complete', 'ingest'):
+        log.info('Ingested %s (%s)', event.file, event.queue)
+    elif event.name == 'exception':
+        log.error('EDEX exception (%s): %s', event.queue, event.line)
+
+
+# started tailers shared by all watchers, by log directory
+tailers = {}
+tailers_lock = threading.Lock()
+
+
+def get_tailer(log_dir):
+    """
+    Fetch the shared tailer for a log directory, starting it at the end of the latest log if not already running
+    :param log_dir:  directory holding the log files
+    :return:  started LogTailer
+    """
+    with tailers_lock:
+        if log_dir not in tailers:
+            tailers[log_dir] = LogTailer(log_dir).start()
+        return tailers[log_dir]
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Benchmark restoring the array parameters of edex records, comparing the original key scan, NaN loop and numpy round
+trip against the schema based restore_lists, which nests the lists directly, on ADCP and OPTAA style records with
+2-D parameters
+
+Usage:
+  restore_lists_benchmark.py [--records=<n>] [--nan=<f>]
+
+Options:
+  --records=<n>  Number of records of each kind [default: 2000]
+  --nan=<f>      Fraction of array values which are NaN [default: 0.05]
+
+"""
+__license__ = 'Apache 2.0'
+
+import copy
+import random
+import time
+
+import numpy
+
+import edex_tools
+
+# (parameter name, shape) of the array parameters in each kind of record
+RECORD_KINDS = {
+    'adcp': [('velocity_beam%d' % beam, [50]) for beam in range(1, 5)] +
+            [('echo_intensity', [4, 50]), ('correlation_magnitude', [4, 50]), ('percent_good', [4, 50])],
+    'optaa': [('a_signal_counts', [83]), ('c_signal_counts', [83]), ('a_reference_counts', [83]),
+              ('c_reference_counts', [83]), ('wavelength_pairs', [2, 83])],
+}
+
+# scalar parameters in each record
+SCALAR_KEYS = ['internal_timestamp', 'port_timestamp', 'driver_timestamp', 'temperature', 'pressure',
+               'serial_number', 'quality_flag', 'stream_name']
+
+
+def make_records(kind, n_records, nan_fraction, seed=0):
+    """
+    Generate records with flattened array parameters and shape keys, as edex returns them
+    :param kind:  'adcp' or 'optaa'
+    :param n_records:  number of records
+    :param nan_fraction:  fraction of array values sent as u'NaN'
+    :param seed:  random seed
+    :return:  list of records
+    """
+    rand = random.Random(seed)
+    records = []
+    for _ in xrange(n_records):
+        record = dict((key, rand.random() * 1000) for key in SCALAR_KEYS)
+        for name, shape in RECORD_KINDS[kind]:
+            size = int(numpy.product(shape))
+            record[name] = [u'NaN' if rand.random() < nan_fraction else rand.random() * 100 for _ in xrange(size)]
+            record[name + '_shape'] = shape
+        records.append(record)
+    return records
+
+
+def original_restore_lists(record):
+    """
+    The original restore_lists, scanning all keys and replacing NaN strings in a python loop
+    """
+    shapes = [k for k in record if k.endswith('_shape')]
+    for k in shapes:
+        array_key = k.replace('_shape', '')
+        array = numpy.array(edex_tools.nanize(record.get(array_key, [])))
+        if numpy.product(record[k]) == len(array):
+            array = array.reshape(record[k])
+        record[array_key] = array.tolist()
+        del record[k]
+
+
+def time_restore(restore, records):
+    """
+    Time restoring a copy of the records
+    :param restore:  function restoring one record
+    :param records:  records to copy and restore
+    :return:  elapsed seconds
+    """
+    records = copy.deepcopy(records)
+    now = time.time()
+    for record in records:
+        restore(record)
+    return time.time() - now
+
+
+def bench_restore(n_records=2000, nan_fraction=0.05):
+    """
+    Print the time taken to restore each kind of record with each method
+    :param n_records:  number of records of each kind
+    :param nan_fraction:  fraction of array values which are NaN
+    """
+    for kind in sorted(RECORD_KINDS):
+        records = make_records(kind, n_records, nan_fraction)
+        schema = edex_tools.RecordSchema()
+        original = time_restore(original_restore_lists, records)
+        lists = time_restore(lambda record: edex_tools.restore_lists(record, schema), records)
+        arrays = time_restore(lambda record: edex_tools.restore_lists(record, schema, keep_arrays=True), records)
+        print '%s: %d records' % (kind, n_records)
+        print '  original:     %8.4f secs' % original
+        print '  schema lists: %8.4f secs  (%.1fx)' % (lists, original / lists)
+        print '  keep arrays:  %8.4f secs  (%.1fx)' % (arrays, original / arrays)
+
+
+if __name__ == '__main__':
+    import docopt
+    options = docopt.docopt(__doc__)
+    bench_restore(int(options['--records']), float(options['--nan']))
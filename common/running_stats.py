@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""
+Single pass statistics over a stream of records, in constant memory: count, min and max, mean and standard deviation
+by Welford's method, and the median estimated with the P-squared algorithm (Jain and Chlamtac), or kept exactly
+when the values fit in memory.
+"""
+import math
+
+NUMBER_TYPES = (int, long, float)
+
+# values kept for an exact median before switching to the P-squared estimate, which is poor for small samples
+P2_BUFFER = 1000
+
+
+class P2Median(object):
+    """
+    Estimate of the median from five markers, adjusted by piecewise parabolic interpolation as values arrive.  The
+    first values are kept for an exact median, and the markers start at their quantiles once the buffer is full.
+    """
+
+    def __init__(self, buffer_size=P2_BUFFER):
+        """
+        :param buffer_size:  number of values kept before estimating, at least 5
+        """
+        self.buffer = []
+        self.buffer_size = buffer_size
+        # marker heights, actual positions, desired positions and desired position increments
+        self.heights = None
+        self.positions = None
+        self.desired = None
+        self.increments = [0.0, 0.25, 0.5, 0.75, 1.0]
+
+    def start(self):
+        """
+        Place the markers at the minimum, quartiles, median and maximum of the buffered values
+        """
+        values = sorted(self.buffer)
+        last = len(values) - 1
+        self.desired = [last * increment for increment in self.increments]
+        self.positions = [int(round(desired)) for desired in self.desired]
+        self.heights = [values[position] for position in self.positions]
+        self.buffer = None
+
+    def add(self, x):
+        """
+        :param x:  value to add, not NaN
+        """
+        if self.heights is None:
+            self.buffer.append(x)
+            if len(self.buffer) > self.buffer_size:
+                self.start()
+            return
+        heights = self.heights
+
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= heights[k + 1]:
+                k += 1
+
+        positions = self.positions
+        for i in xrange(k + 1, 5):
+            positions[i] += 1
+        for i in xrange(5):
+            self.desired[i] += self.increments[i]
+
+        for i in xrange(1, 4):
+            d = self.desired[i] - positions[i]
+            if (d >= 1 and positions[i + 1] - positions[i] > 1) or (d <= -1 and positions[i - 1] - positions[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self.parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + d * (heights[i + d] - heights[i]) / float(positions[i + d] - positions[i])
+                heights[i] = height
+                positions[i] += d
+
+    def parabolic(self, i, d):
+        """
+        :return:  the piecewise parabolic prediction for marker i moved by d
+        """
+        q = self.heights
+        n = self.positions
+        return q[i] + d / float(n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / float(n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / float(n[i] - n[i - 1]))
+
+    def result(self):
+        """
+        :return:  the median estimate, exact while the values fit in the buffer, None if there are none
+        """
+        if self.heights is None:
+            return exact_median(sorted(self.buffer))
+        return self.heights[2]
+
+
+class ExactMedian(object):
+    """
+    Exact median, keeping every value
+    """
+
+    def __init__(self):
+        self.values = []
+
+    def add(self, x):
+        self.values.append(x)
+
+    def result(self):
+        self.values.sort()
+        return exact_median(self.values)
+
+
+def exact_median(values):
+    """
+    :param values:  sorted list of values
+    :return:  the middle value, or the mean of the middle two as numpy.median, None if there are no values
+    """
+    n = len(values)
+    if n == 0:
+        return None
+    if n % 2:
+        return values[n / 2]
+    return (values[n / 2 - 1] + values[n / 2]) / 2.0
+
+
+class RunningStats(object):
+    """
+    Count, min, max, median, mean and population standard deviation of a stream of values.  As with numpy, any NaN
+    makes every statistic NaN.
+    """
+
+    def __init__(self, exact=False):
+        """
+        :param exact:  keep every value for an exact median instead of the P-squared estimate
+        """
+        self.count = 0
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.nan = False
+        self.median = ExactMedian() if exact else P2Median()
+
+    def add(self, x):
+        """
+        :param x:  value to add
+        """
+        self.count += 1
+        if x != x:
+            self.nan = True
+            return
+        if self.n == 0 or x < self.min:
+            self.min = x
+        if self.n == 0 or x > self.max:
+            self.max = x
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / float(self.n)
+        self.m2 += delta * (x - self.mean)
+        self.median.add(x)
+
+    def result(self):
+        """
+        :return:  (min, max, median, mean, sigma), all NaN if a NaN was added
+        """
+        if self.nan:
+            nan = float('nan')
+            return nan, nan, nan, nan, nan
+        return self.min, self.max, self.median.result(), self.mean, math.sqrt(self.m2 / self.n)
+
+
+class ParameterStats(object):
+    """
+    Statistics of one parameter over all records.  Scalar values are summarised together, equal length array values
+    per column and over every element.  A parameter with any value which is not a number, or an array of numbers of
+    the same length as the others, is not numeric and is not summarised.
+    """
+
+    def __init__(self, exact=False):
+        """
+        :param exact:  keep every value for exact medians
+        """
+        self.exact = exact
+        self.numeric = True
+        self.records = 0
+        # None for scalar values, otherwise the length of the array values and their per column statistics
+        self.width = None
+        self.columns = []
+        self.overall = RunningStats(exact)
+
+    def add(self, value):
+        """
+        :param value:  the parameter value from one record
+        """
+        if not self.numeric:
+            return
+        if isinstance(value, (list, tuple)):
+            width = len(value)
+            values = value
+        else:
+            width = None
+            values = (value,)
+        if self.records == 0:
+            self.width = width
+            if width is not None:
+                self.columns = [RunningStats(self.exact) for _ in xrange(width)]
+        if width != self.width or width == 0 or not all(type(v) in NUMBER_TYPES for v in values):
+            # mixed, ragged or not numbers, release the statistics gathered so far
+            self.numeric = False
+            self.columns = []
+            self.overall = None
+            return
+        self.records += 1
+        for column, v in zip(self.columns, values):
+            column.add(v)
+        for v in values:
+            self.overall.add(v)
+
+    def rows(self, param):
+        """
+        :param param:  the parameter name
+        :return:  list of (key, count, min, max, median, mean, sigma) rows, per column then overall for arrays
+        """
+        if self.width is None:
+            return [(param, self.records) + self.overall.result()]
+        rows = [('%s(%d)' % (param, i), self.records) + column.result() for i, column in enumerate(self.columns)]
+        # the overall row of array parameters has always given the number of columns as the count
+        rows.append((param, self.width) + self.overall.result())
+        return rows
+
+
+class RecordStats(object):
+    """
+    Statistics of every parameter over a stream of records
+    """
+
+    def __init__(self, exact=False):
+        """
+        :param exact:  keep every value for exact medians
+        """
+        self.exact = exact
+        self.params = {}
+
+    def add(self, record):
+        """
+        :param record:  dictionary of parameter name -> value
+        """
+        for param, value in record.iteritems():
+            stats = self.params.get(param)
+            if stats is None:
+                stats = self.params[param] = ParameterStats(self.exact)
+            stats.add(value)
+
+    def update(self, records):
+        """
+        :param records:  iterable of records
+        :return:  self
+        """
+        for record in records:
+            self.add(record)
+        return self
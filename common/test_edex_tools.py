@@ -0,0 +1,495 @@
+"""
+Tests for the edex_tools retrieval helpers: incremental decoding of streamed JSON arrays, and retrieval through the
+results cache and the MIO report with the HTTP session replaced by one returning canned responses.  Also tests
+that array parameters are restored as the original numpy based restore_lists did, and that compare finds the same failures as the original record at a time comparison.
+Usage: python -m unittest test_edex_tools
+"""
+__license__ = 'Apache 2.0'
+
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy
+
+import edex_tools
+from edex_tools import FAILURES, compare, diff, iter_json_array
+
+RECORDS = [{'pk': {'time': 3583861263.125, 'stream_name': 'ctdbp_cdef_instrument_recovered'}, 'temperature': 10.5,
+            'values': [1, 2, 3, 4], 'values_shape': [2, 2]},
+           {'pk': {'time': 3583861264.0, 'stream_name': 'ctdbp_cdef_instrument_recovered'}, 'temperature': 11.5,
+            'values': [5, 6, 7, 'NaN'], 'values_shape': [2, 2]}]
+
+
+def split(data, size):
+    """
+    :return:  list of the byte string data in chunks of the given size
+    """
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+class TestIterJsonArray(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [{u'pk': {u'time': 3583861263.125, u'stream_name': u'ctdbp_cdef_instrument_recovered'},
+                         u'temperature': 10.5, u'serial_number': u'caf\xe9 \u2603', u'values': [1, 2, u'NaN']},
+                        {u'empty': [], u'nested': {u'a': [[1, 2], [3, 4]]}, u'flag': None, u'ok': True},
+                        12,
+                        u'text',
+                        -1.5e-7]
+        self.data = json.dumps(self.records, ensure_ascii=False).encode('utf-8')
+
+    def test_split_records(self):
+        """
+        Test that records split across chunks at every position, including inside multi-byte characters, decode
+        to the same records
+        """
+        for position in xrange(len(self.data) + 1):
+            chunks = [self.data[:position], self.data[position:]]
+            self.assertEqual(list(iter_json_array(chunks)), self.records)
+        for size in (1, 2, 3, 7, 64):
+            self.assertEqual(list(iter_json_array(split(self.data, size))), self.records)
+
+    def test_long_value(self):
+        """
+        Test that a value much longer than the chunk size is decoded whole
+        """
+        records = [{u'values': range(20000)}, u'x' * 30000]
+        data = json.dumps(records).encode('utf-8')
+        self.assertEqual(list(iter_json_array(split(data, 100))), records)
+
+    def test_whitespace(self):
+        """
+        Test that whitespace around the array and its elements, and empty chunks, are skipped
+        """
+        chunks = [b'', b' \n[', b' 1 ', b'', b',\t', b'2\r\n', b']', b' ']
+        self.assertEqual(list(iter_json_array(chunks)), [1, 2])
+
+    def test_empty_array(self):
+        """
+        Test that an empty array yields no records
+        """
+        self.assertEqual(list(iter_json_array([b'[]'])), [])
+        self.assertEqual(list(iter_json_array([b' [', b' ', b'] '])), [])
+
+    def test_malformed(self):
+        """
+        Test that input which is not a well formed JSON array raises ValueError
+        """
+        for data in (b'', b'   ', b'{"a": 1}', b'1', b'[1,]', b'[,1]', b'[1 2]', b'[1,, 2]', b'[1, 2',
+                     b'[{"a": }]', b'["unterminated', b'[1, 2}'):
+            for size in (1, len(data) or 1):
+                with self.assertRaises(ValueError):
+                    list(iter_json_array(split(data, size)))
+
+
+class FakeResponse(object):
+    """
+    The parts of a requests response get_from_edex uses
+    """
+    def __init__(self, content):
+        self.content = content
+        self.url = 'http://localhost/fake'
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, size):
+        return split(self.content, size)
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    """
+    HTTP session returning the same response to every request after a delay, recording the requests
+    """
+    def __init__(self, content, delay=0.0):
+        self.content = content
+        self.delay = delay
+        self.requests = []
+
+    def get(self, url, params=None, stream=False):
+        self.requests.append(url)
+        time.sleep(self.delay)
+        return FakeResponse(self.content)
+
+
+class TestGetFromEdex(unittest.TestCase):
+
+    def setUp(self):
+        self.http_session = edex_tools.http_session
+        self.session = edex_tools.http_session = FakeSession(json.dumps(RECORDS))
+        edex_tools.results_cache.clear()
+
+    def tearDown(self):
+        edex_tools.http_session = self.http_session
+        edex_tools.results_cache.clear()
+
+    @staticmethod
+    def get(**kwargs):
+        return edex_tools.get_from_edex('localhost', 'RS10ENGC', 'XX00X', '00-CTDBPA002', 'recovered',
+                                        'ctdbp_cdef_instrument_recovered', 3583861000.0, 3583862000.0, **kwargs)
+
+    def check_records(self, d, timestamps):
+        """
+        Check the retrieved records are keyed by the given timestamps and have their lists restored
+        """
+        self.assertEqual(sorted(d), [('ctdbp_cdef_instrument_recovered', t) for t in timestamps])
+        for records in d.itervalues():
+            self.assertEqual(len(records), 1)
+            self.assertNotIn('values_shape', records[0])
+        first = d[('ctdbp_cdef_instrument_recovered', timestamps[0])][0]
+        self.assertEqual(first['values'], [[1, 2], [3, 4]])
+        self.assertEqual(first['timestamp'], timestamps[0])
+
+    def test_concurrent(self):
+        """
+        Test that concurrent callers share one request, and each gets records with their lists restored
+        """
+        self.session.delay = 0.2
+        for streaming in (False, True):
+            edex_tools.results_cache.clear()
+            del self.session.requests[:]
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(self.get(streaming=streaming)))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(self.session.requests), 1)
+            self.assertEqual(len(results), 4)
+            for d in results:
+                self.check_records(d, [3583861263.125, 3583861264.0])
+
+    def test_cached_records_unchanged(self):
+        """
+        Test that later calls, and changes made by callers, do not change the records returned to earlier calls
+        """
+        as_string = self.get(timestamp_as_string=True)
+        self.check_records(as_string, ['3583861263.125', '3583861264.000'])
+        as_number = self.get()
+        self.check_records(as_number, [3583861263.125, 3583861264.0])
+        self.check_records(as_string, ['3583861263.125', '3583861264.000'])
+
+        as_number[('ctdbp_cdef_instrument_recovered', 3583861263.125)][0]['temperature'] = 0.0
+        again = self.get()
+        self.assertEqual(again[('ctdbp_cdef_instrument_recovered', 3583861263.125)][0]['temperature'], 10.5)
+        self.assertEqual(len(self.session.requests), 1)
+
+    def test_keep_arrays(self):
+        """
+        Test that records retrieved with and without keep_arrays are cached apart, and streamed and not streamed
+        records together
+        """
+        lists = self.get()
+        arrays = self.get(keep_arrays=True)
+        self.assertEqual(len(self.session.requests), 2)
+        self.check_records(lists, [3583861263.125, 3583861264.0])
+        values = arrays[('ctdbp_cdef_instrument_recovered', 3583861263.125)][0]['values']
+        self.assertIsInstance(values, numpy.ndarray)
+        self.assertEqual(values.tolist(), [[1, 2], [3, 4]])
+        self.assertTrue(numpy.isnan(arrays[('ctdbp_cdef_instrument_recovered', 3583861264.0)][0]['values'][1, 1]))
+
+        self.check_records(self.get(streaming=True), [3583861263.125, 3583861264.0])
+        self.assertIsInstance(self.get(streaming=True, keep_arrays=True)[
+            ('ctdbp_cdef_instrument_recovered', 3583861263.125)][0]['values'], numpy.ndarray)
+        self.assertEqual(len(self.session.requests), 2)
+
+    def test_mio_report(self):
+        """
+        Test that the MIO report retrieves the stream of the instrument and writes its records and statistics
+        without holding them in the results cache
+        """
+        output_dir = tempfile.mkdtemp()
+        try:
+            edex_tools.edex_mio_report('localhost', 'ctdbp_cdef_instrument_recovered', 'RS10ENGC-XX00X-00-CTDBPA002',
+                                       'recovered', output_dir)
+            self.assertEqual(self.session.requests, [edex_tools.EDEX_BASE_URL % (
+                'localhost', 'RS10ENGC', 'XX00X', '00-CTDBPA002') + '/recovered/ctdbp_cdef_instrument_recovered'])
+
+            base = os.path.join(output_dir, 'ctdbp_cdef_instrument_recovered-RS10ENGC-XX00X-00-CTDBPA002')
+            with open(base + '.json') as fh:
+                self.assertEqual([record['temperature'] for record in json.load(fh)], [10.5, 11.5])
+            with open(base + '.csv') as fh:
+                lines = fh.read().splitlines()
+            self.assertEqual(lines[0], 'key,count,min,max,median,mean,sigma')
+            self.assertIn('temperature,2,10.500000,11.500000,11.000000,11.000000,0.500000', lines)
+            self.assertFalse([line for line in lines if line.startswith('timestamp,')])
+            self.assertEqual(edex_tools.results_cache.stats()['entries'], 0)
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_many(self):
+        """
+        Test that many queries are retrieved with each result under its own query, sharing the requests for equal
+        queries
+        """
+        queries = [('RS10ENGC', 'XX00X', '00-CTDBPA00%d' % i, 'recovered', 'ctdbp_cdef_instrument_recovered',
+                    3583861000.0, 3583862000.0) for i in range(5)]
+        self.session.delay = 0.1
+        now = time.time()
+        results = edex_tools.get_from_edex_many('localhost', queries + queries[:2], max_requests=5, streaming=True)
+        self.assertTrue(time.time() - now < 0.4)
+        self.assertEqual(sorted(results), sorted(queries))
+        self.assertEqual(sorted(self.session.requests), [edex_tools.EDEX_BASE_URL % (
+            'localhost', 'RS10ENGC', 'XX00X', '00-CTDBPA00%d' % i) + '/recovered/ctdbp_cdef_instrument_recovered'
+            for i in range(5)])
+        for d in results.itervalues():
+            self.check_records(d, [3583861263.125, 3583861264.0])
+        self.assertEqual(edex_tools.get_from_edex_many('localhost', []), {})
+
+
+def original_restore_lists(record):
+    """
+    The original restore_lists, restoring every array through numpy
+    """
+    for k in [k for k in record if k.endswith('_shape')]:
+        array_key = k.replace('_shape', '')
+        array = numpy.array(edex_tools.nanize(record.get(array_key, [])))
+        if numpy.product(record[k]) == len(array):
+            array = array.reshape(record[k])
+        record[array_key] = array.tolist()
+        del record[k]
+
+
+class TestRestoreLists(unittest.TestCase):
+
+    def test_original(self):
+        """
+        Test that the lists nested without numpy match those the original restore_lists built through numpy,
+        except that integers are left as integers rather than made floats by a NaN in the same array
+        """
+        rand = random.Random(3)
+        shapes = [[], [1], [7], [3, 4], [2, 3, 4], [0], [0, 3], [3, 0], [5]]
+        for shape in shapes:
+            for nan_fraction in (0, 0.3, 1):
+                size = int(numpy.product(shape))
+                for values in ([rand.random() * 100 for _ in xrange(size)],
+                               [rand.randint(-1000, 1000) for _ in xrange(size)]):
+                    values = [u'NaN' if rand.random() < nan_fraction else x for x in values]
+                    record = {'param': values, 'param_shape': shape, 'other': 1}
+                    expected = dict(record)
+                    original_restore_lists(expected)
+                    edex_tools.restore_lists(record, edex_tools.RecordSchema())
+                    numpy.testing.assert_equal(record, expected, str((shape, values)))
+                    self.assertEqual(sorted(record), sorted(expected))
+
+        # wrong shape, left flat
+        record = {'param': [1, 2, u'NaN'], 'param_shape': [2, 2]}
+        edex_tools.restore_lists(record)
+        self.assertEqual(repr(record), repr({'param': [1.0, 2.0, float('nan')]}))
+
+    def test_strings(self):
+        """
+        Test that NaN strings mixed with other strings are replaced without converting the numbers to strings
+        """
+        for keep_arrays in (False, True):
+            record = {'param': [0.1 + 0.2, u'NaN', u'text', 'bytes'], 'param_shape': [2, 2]}
+            edex_tools.restore_lists(record, keep_arrays=keep_arrays)
+            self.assertEqual(repr(numpy.array(record['param']).tolist() if keep_arrays else record['param']),
+                             repr([[0.1 + 0.2, float('nan')], [u'text', 'bytes']]))
+
+        values = [1.5, 2]
+        self.assertIs(edex_tools.nanize_list(values), values)
+
+
+class TestHttpSession(unittest.TestCase):
+
+    def setUp(self):
+        self.http_session = edex_tools.http_session
+        edex_tools.http_session = None
+
+    def tearDown(self):
+        edex_tools.http_session = self.http_session
+
+    def test_shared(self):
+        """
+        Test that every thread gets the one session, pooling the configured number of connections per host
+        """
+        sessions = []
+        threads = [threading.Thread(target=lambda: sessions.append(edex_tools.get_http_session()))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(sessions), 8)
+        self.assertTrue(all(session is sessions[0] for session in sessions))
+        self.assertIs(edex_tools.get_http_session(), sessions[0])
+
+        for url in ('http://localhost:12575/sensor/inv', 'https://localhost/'):
+            adapter = sessions[0].get_adapter(url)
+            self.assertIsInstance(adapter, edex_tools.HTTPAdapter)
+            self.assertEqual(adapter._pool_connections, edex_tools.HTTP_POOL_SIZE)
+            self.assertEqual(adapter._pool_maxsize, edex_tools.HTTP_POOL_SIZE)
+
+
+def original_compare(stored, expected, metadata, ignore_nulls=False):
+    """
+    The original compare, diffing each expected record with every candidate stored record
+    """
+    failures = []
+    for record in expected:
+        timestamp = '%12.3f' % record.get('internal_timestamp', 0.0)
+        stream_name = record.get('particle_type') or record.get('stream_name')
+
+        matches = []
+        for each in stored.get((stream_name, timestamp), []):
+            stored_name = each.get('stream_name')
+            if stored_name is None:
+                stored_name = each.get('pk', {}).get('stream_name')
+            if stored_name == stream_name and each['timestamp'] == timestamp:
+                f, errors = diff(stream_name, record, each, metadata, ignore_nulls=ignore_nulls)
+                matches.append((len(f), each, f, errors))
+
+        matches.sort()
+        if len(matches) == 0:
+            m = 'Unable to find a matching sample: %s %s' % (stream_name, timestamp)
+            failures.append((FAILURES.MISSING_SAMPLE, m))
+        if len(matches) > 0:
+            failcount, match, f, errors = matches[0]
+            if failcount > 0:
+                failures.append(f)
+
+    return failures
+
+
+class TestCompare(unittest.TestCase):
+
+    stream = 'ctdbp_cdef_instrument_recovered'
+    metadata = {'fill_int': {'fillValue': '-999'}, 'fill_float': {'fillValue': '-9999999.0'}}
+
+    def setUp(self):
+        self.random = random.Random(3)
+
+    def stored(self, records):
+        """
+        :return:  retrieved records keyed by (stream, timestamp) as get_from_edex returns them
+        """
+        d = {}
+        for record in records:
+            record = dict(record, stream_name=self.stream, timestamp='%12.3f' % record['internal_timestamp'])
+            d.setdefault((self.stream, record['timestamp']), []).append(record)
+        return d
+
+    def expected(self, **values):
+        return dict(values, particle_type=self.stream, internal_timestamp=1.0)
+
+    def check(self, expected, retrieved, kinds, ignore_nulls=False):
+        """
+        Check compare finds the same failures as the original, and of the given kinds
+        """
+        stored = self.stored(retrieved)
+        failures = compare(stored, expected, self.metadata, ignore_nulls=ignore_nulls)
+        self.assertEqual(failures, original_compare(stored, expected, self.metadata, ignore_nulls=ignore_nulls))
+        found = []
+        for failure in failures:
+            if type(failure) is list:
+                found.extend(kind for kind, _ in failure)
+            else:
+                found.append(failure[0])
+        self.assertEqual(sorted(found), sorted(kinds))
+        return failures
+
+    def test_nan(self):
+        """
+        Test that NaN matches NaN and nothing else
+        """
+        nan = float('nan')
+        self.check([self.expected(a=nan, b=nan, c=1.5)], [dict(self.expected(a=nan, b=1.5, c=nan), pk={})],
+                   [FAILURES.BAD_VALUE, FAILURES.BAD_VALUE])
+
+    def test_mixed_types(self):
+        """
+        Test ints and floats compared with each other, within the float tolerance and across the int sizes
+        """
+        self.check([self.expected(a=1, b=1.0, c=1.0004, d=2 ** 70, e=3, f=2.5, g='2.5', h=1.005)],
+                   [self.expected(a=1.0, b=1, c=1.0, d=2 ** 70, e=4, f=2, g=2.5, h=1.0)],
+                   [FAILURES.BAD_VALUE, FAILURES.BAD_VALUE, FAILURES.BAD_VALUE])
+
+    def test_lists(self):
+        """
+        Test list valued parameters, including nested lists holding NaN and mixed ints and floats
+        """
+        nan = float('nan')
+        self.check([self.expected(a=[1, 2.5, nan], b=[[1, 2], [3, 4]], c=[1, 2], d=[1.0, 2.0])],
+                   [self.expected(a=[1.0, 2.5004, nan], b=[[1, 2], [3, 5]], c=[1, 2, 3], d=[1, 2])],
+                   [FAILURES.BAD_VALUE, FAILURES.BAD_VALUE])
+
+    def test_missing_keys(self):
+        """
+        Test keys missing from the retrieved records, with and without ignoring nulls, extra retrieved keys, fill
+        values and missing records
+        """
+        expected = [self.expected(a=1, b=None, fill_int=5, value={'value': 2.0}),
+                    dict(self.expected(a=2), internal_timestamp=2.0)]
+        retrieved = [self.expected(fill_int=-999, value=2.0, extra=1, fill_float=-9999999.0)]
+        self.check(expected, retrieved, [FAILURES.MISSING_FIELD, FAILURES.MISSING_FIELD, FAILURES.UNEXPECTED_VALUE,
+                                         FAILURES.MISSING_SAMPLE])
+        self.check(expected, retrieved, [FAILURES.MISSING_FIELD, FAILURES.UNEXPECTED_VALUE, FAILURES.MISSING_SAMPLE],
+                   ignore_nulls=True)
+
+    def test_closest_candidate(self):
+        """
+        Test that the failures of the closest of several retrieved records with the same timestamp are reported
+        """
+        failures = self.check([self.expected(a=1, b=2.0, c=3)],
+                              [self.expected(a=0, b=0.0, c=3), self.expected(a=1, b=0.0, c=3),
+                               self.expected(a=0, b=0.0, c=0)],
+                              [FAILURES.BAD_VALUE])
+        self.assertIn("key='b'", failures[0][0][1])
+
+    def random_value(self):
+        choice = self.random.randint(0, 9)
+        if choice == 0:
+            return float('nan')
+        if choice == 1:
+            return self.random.choice([float('inf'), float('-inf')])
+        if choice == 2:
+            return self.random.randint(-3, 3)
+        if choice == 3:
+            return self.random.choice([-999, -9999999.0, None, True, 'text', u'1.5 '])
+        if choice == 4:
+            return [self.random_value() for _ in xrange(self.random.randint(0, 3))]
+        if choice == 5:
+            return {'value': self.random.choice([1, 1.0, 1.5])}
+        return self.random.choice([0.0, 1.0, 1.0005, 1.005, 1.5, 2.0])
+
+    def random_record(self, keys, timestamp):
+        record = {'internal_timestamp': timestamp, 'particle_type': self.stream}
+        for key in keys:
+            if self.random.random() < 0.9:
+                record[key] = self.random_value()
+        return record
+
+    def test_random(self):
+        """
+        Test that compare finds the same failures as the original on random records of mixed types, NaN, inf, lists
+        and fill values, with retrieved records missing, duplicated, changed or with missing and extra keys
+        """
+        keys = ['a', 'b', 'c', 'd', 'fill_int', 'fill_float']
+        for _ in xrange(200):
+            expected = [self.random_record(keys, float(timestamp)) for timestamp in xrange(self.random.randint(1, 8))]
+            retrieved = []
+            for record in expected:
+                for _ in xrange(self.random.choice([0, 1, 1, 1, 2, 3])):
+                    if self.random.random() < 0.5:
+                        each = dict(record)
+                        if each and self.random.random() < 0.5:
+                            each[self.random.choice(keys)] = self.random_value()
+                    else:
+                        each = self.random_record(keys + ['extra'], record['internal_timestamp'])
+                    each.pop('particle_type')
+                    retrieved.append(each)
+            stored = self.stored(retrieved)
+            ignore_nulls = self.random.random() < 0.5
+            self.assertEqual(compare(stored, expected, self.metadata, ignore_nulls=ignore_nulls),
+                             original_compare(stored, expected, self.metadata, ignore_nulls=ignore_nulls))
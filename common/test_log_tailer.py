@@ -0,0 +1,229 @@
+"""
+Tests for following the EDEX log with LogTailer, driven by calling poll directly rather than from its thread, and
+for counting log events with LogEvents, fed lines directly.
+Usage: python -m unittest test_log_tailer
+"""
+__license__ = 'Apache 2.0'
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from log_tailer import LogEvents, LogTailer
+
+
+class TestLogTailer(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.write('edex-ooi-20150101.log', 'before the tailer started\n')
+        self.tailer = LogTailer(self.log_dir)
+        self.lines = []
+        self.tailer.subscribe(self.lines.append)
+
+    def tearDown(self):
+        self.tailer.stop()
+        shutil.rmtree(self.log_dir)
+
+    def write(self, filename, data, mode='a', mtime=None):
+        """
+        Write to a log file, optionally setting its modification time
+        """
+        path = os.path.join(self.log_dir, filename)
+        with open(path, mode) as fid:
+            fid.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_partial_line(self):
+        """
+        Test that a line written in pieces is only handed on once its newline is written
+        """
+        self.write('edex-ooi-20150101.log', 'one\ntw')
+        self.tailer.poll()
+        self.assertEqual(self.lines, ['one'])
+
+        self.write('edex-ooi-20150101.log', 'o\nthr')
+        self.tailer.poll()
+        self.write('edex-ooi-20150101.log', 'ee\n')
+        self.tailer.poll()
+        self.assertEqual(self.lines, ['one', 'two', 'three'])
+
+    def test_rotate(self):
+        """
+        Test that the rest of the old file, including a final partial line, is read before following a newer file
+        from its start
+        """
+        self.write('edex-ooi-20150101.log', 'one\nunfinished')
+        self.tailer.poll()
+        self.write('edex-ooi-20150102.log', 'two\n', mtime=time.time() + 10)
+        self.tailer.poll()
+        self.assertEqual(self.lines, ['one', 'unfinished', 'two'])
+
+        self.write('edex-ooi-20150102.log', 'three\n')
+        self.tailer.poll()
+        self.assertEqual(self.lines, ['one', 'unfinished', 'two', 'three'])
+
+    def test_replace(self):
+        """
+        Test that a log file replaced by a new file with the same name is followed from its start
+        """
+        path = os.path.join(self.log_dir, 'edex-ooi-20150101.log')
+        os.rename(path, path + '.1')
+        os.utime(path + '.1', (time.time() - 10, time.time() - 10))
+        self.write('edex-ooi-20150101.log', 'one\n', mtime=time.time() + 10)
+        self.tailer.poll()
+        self.assertEqual(self.lines, ['one'])
+
+    def test_truncate(self):
+        """
+        Test that a truncated log file is followed from its start
+        """
+        self.write('edex-ooi-20150101.log', 'one\n')
+        self.tailer.poll()
+        self.write('edex-ooi-20150101.log', 'two\n', mode='w')
+        self.tailer.poll()
+        self.assertEqual(self.lines, ['one', 'two'])
+
+    def test_cursor(self):
+        """
+        Test that a subscriber starting from a cursor sees the lines written since the cursor once, and a
+        subscriber without one only sees new lines
+        """
+        self.write('edex-ooi-20150101.log', 'one\n')
+        self.tailer.poll()
+        cursor = self.tailer.cursor()
+        self.write('edex-ooi-20150101.log', 'two\nthree\n')
+        self.tailer.poll()
+
+        from_cursor = []
+        from_now = []
+        self.tailer.subscribe(from_cursor.append, cursor)
+        self.tailer.subscribe(from_now.append)
+        self.write('edex-ooi-20150101.log', 'four\n')
+        self.tailer.poll()
+        self.assertEqual(from_cursor, ['two', 'three', 'four'])
+        self.assertEqual(from_now, ['four'])
+
+    def test_callback_uses_tailer(self):
+        """
+        Test that a callback can unsubscribe and take a cursor without deadlocking the tailer
+        """
+        seen = []
+
+        def once(line):
+            seen.append((line, self.tailer.cursor()))
+            self.tailer.unsubscribe(subscription)
+
+        subscription = self.tailer.subscribe(once)
+        self.write('edex-ooi-20150101.log', 'one\ntwo\n')
+        self.tailer.poll()
+        self.write('edex-ooi-20150101.log', 'three\n')
+        self.tailer.poll()
+        self.assertEqual(seen[0], ('one', 2))
+        self.assertEqual(self.lines, ['one', 'two', 'three'])
+
+    def test_caller_file(self):
+        """
+        Test that a tailer following a caller's file reads from its position and leaves it open
+        """
+        fh = open(os.path.join(self.log_dir, 'edex-ooi-20150101.log'))
+        fh.seek(0, 2)
+        tailer = LogTailer(fh=fh).start()
+        lines = []
+        tailer.subscribe(lines.append)
+        self.write('edex-ooi-20150101.log', 'one\n')
+        end_time = time.time() + 5
+        while not lines and time.time() < end_time:
+            time.sleep(0.05)
+        tailer.stop()
+        self.assertEqual(lines, ['one'])
+        self.assertFalse(fh.closed)
+        fh.close()
+
+    def test_relative_path(self):
+        """
+        Test that a tailer following a file opened by a relative path does not see it as rotated
+        """
+        cwd = os.getcwd()
+        os.chdir(self.log_dir)
+        try:
+            fh = open('edex-ooi-20150101.log')
+            tailer = LogTailer(fh=fh)
+            self.assertIsNone(tailer.rotated())
+            tailer = LogTailer('.')
+            self.assertIsNone(tailer.rotated())
+            tailer.stop()
+            fh.close()
+        finally:
+            os.chdir(cwd)
+
+
+class TestLogEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.seen = []
+        self.events = LogEvents(callback=self.seen.append)
+
+    def test_counters(self):
+        """
+        Test that events are counted in total, per full file path and per queue, including hyphenated queues
+        """
+        self.events('INFO 2015-01-01 [Ingest.adcpa-m-glider_recovered-3] EDEX - Ingest complete for file: '
+                    '/data/adcpa_m/glider/resource/subset_reduced.csv')
+        self.events('INFO 2015-01-01 [Ingest.ctdav-n-auv_telemetered-12] EDEX - Ingest complete for file: '
+                    '/data/ctdav_n/auv/resource/subset_reduced.csv')
+        self.events('ERROR 2015-01-01 [Ingest.adcpa-m-glider_recovered-1] java.lang.NullPointerException: none')
+        self.events('INFO 2015-01-01 [Ingest.flort] Purge Operation: PURGE_ALL_DATA completed')
+        self.events('INFO 2015-01-01 nothing to see here')
+
+        self.assertEqual(self.events.count('ingest_complete'), 2)
+        self.assertEqual(self.events.count('exception'), 1)
+        self.assertEqual(self.events.count('purge'), 1)
+        self.assertEqual(self.events.count('ingest'), 0)
+        self.assertEqual(self.events.count('ingest_complete', '/data/adcpa_m/glider/resource/subset_reduced.csv'), 1)
+        self.assertEqual(self.events.count('ingest_complete', '/data/ctdav_n/auv/resource//subset_reduced.csv'), 1)
+        self.assertEqual(self.events.count('ingest_complete', '/data/dosta_ln/auv/resource/subset_reduced.csv'), 0)
+        self.assertEqual(self.events.queues['ingest_complete'],
+                         {'Ingest.adcpa-m-glider_recovered': 1, 'Ingest.ctdav-n-auv_telemetered': 1})
+        self.assertEqual(self.events.queues['exception'], {'Ingest.adcpa-m-glider_recovered': 1})
+        self.assertEqual(self.events.queues['purge'], {'Ingest.flort': 1})
+        self.assertEqual([event.name for event in self.seen], ['ingest_complete', 'ingest_complete', 'exception',
+                                                                'purge'])
+
+    def test_files_done(self):
+        """
+        Test that files are only done once each has been ingested as many times as it appears
+        """
+        files = ['/data/a/first.dat', '/data/a/second.dat', '/data/a/second.dat']
+        self.assertFalse(self.events.files_done('ingest_complete', files))
+        self.events('EDEX - Ingest complete for file /data/a/first.dat')
+        self.events('EDEX - Ingest complete for file /data/a/second.dat')
+        # the same name in another directory is a different file
+        self.events('EDEX - Ingest complete for file /data/b/second.dat')
+        self.assertFalse(self.events.files_done('ingest_complete', files))
+        self.events('EDEX - Ingest complete for file /data/a/second.dat')
+        self.assertTrue(self.events.files_done('ingest_complete', files))
+        self.assertTrue(self.events.files_done('ingest_complete', []))
+
+    def test_wait_count(self):
+        """
+        Test that waiting for a count returns once the lines arrive, and times out when they do not
+        """
+        def feed():
+            for _ in range(3):
+                time.sleep(0.05)
+                self.events('Ingest: EDEX: Ingest /data/a/first.dat')
+
+        thread = threading.Thread(target=feed)
+        thread.start()
+        self.assertTrue(self.events.wait_count('ingest', 3, 5))
+        thread.join()
+        self.assertFalse(self.events.wait_count('ingest', 4, 0.1))
+
+        self.events.close()
+        self.assertFalse(self.events.wait_count('ingest', 4, 5))
@@ -0,0 +1,124 @@
+"""
+Tests for the single pass statistics of running_stats, checked against numpy on random data with fewer and more
+values than the exact median buffer.
+Usage: python -m unittest test_running_stats
+"""
+__license__ = 'Apache 2.0'
+
+import math
+import random
+import unittest
+
+import numpy
+
+from running_stats import P2_BUFFER, P2Median, ParameterStats, RecordStats, RunningStats
+
+
+class TestRunningStats(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(1)
+
+    def samples(self):
+        """
+        :return:  list of (name, values) of random data of several distributions and sizes around the buffer size
+        """
+        samples = []
+        for n in (1, 2, 5, 999, P2_BUFFER, P2_BUFFER + 1, 5000, 50000):
+            samples.append(('uniform %d' % n, [self.random.uniform(-10, 10) for _ in xrange(n)]))
+            samples.append(('normal %d' % n, [self.random.gauss(5, 2) for _ in xrange(n)]))
+            samples.append(('exponential %d' % n, [self.random.expovariate(0.5) for _ in xrange(n)]))
+            samples.append(('integers %d' % n, [self.random.randint(-1000, 1000) for _ in xrange(n)]))
+        return samples
+
+    def test_numpy(self):
+        """
+        Test that count, min, max, mean and standard deviation match numpy, and the median is exact while the values
+        fit in the buffer and close to numpy's beyond it
+        """
+        for name, values in self.samples():
+            stats = RunningStats()
+            for x in values:
+                stats.add(x)
+            v_min, v_max, median, mean, sigma = stats.result()
+            array = numpy.array(values)
+            self.assertEqual(stats.count, len(values), name)
+            self.assertEqual(v_min, numpy.min(array), name)
+            self.assertEqual(v_max, numpy.max(array), name)
+            self.assertAlmostEqual(mean, numpy.mean(array), delta=1e-9 * max(1, abs(numpy.mean(array))), msg=name)
+            self.assertAlmostEqual(sigma, numpy.std(array), delta=1e-9 * max(1, numpy.std(array)), msg=name)
+            if len(values) <= P2_BUFFER:
+                self.assertEqual(median, numpy.median(array), name)
+            else:
+                # the P-squared estimate is within a few percent of the spread of the data
+                self.assertAlmostEqual(median, numpy.median(array), delta=0.05 * numpy.std(array), msg=name)
+
+            exact = RunningStats(exact=True)
+            for x in values:
+                exact.add(x)
+            self.assertEqual(exact.result()[2], numpy.median(array), name)
+
+    def test_sorted(self):
+        """
+        Test the median estimate of values arriving in increasing and decreasing order
+        """
+        values = range(20000)
+        for ordered in (values, values[::-1]):
+            median = P2Median()
+            for x in ordered:
+                median.add(x)
+            self.assertAlmostEqual(median.result(), numpy.median(values), delta=0.01 * len(values))
+
+    def test_empty(self):
+        """
+        Test that the median of no values is None
+        """
+        self.assertIsNone(P2Median().result())
+        self.assertIsNone(RunningStats(exact=True).median.result())
+
+    def test_nan(self):
+        """
+        Test that a NaN makes every statistic NaN, as with numpy
+        """
+        stats = RunningStats()
+        for x in (1.0, float('nan'), 2.0):
+            stats.add(x)
+        self.assertEqual(stats.count, 3)
+        self.assertTrue(all(math.isnan(x) for x in stats.result()))
+
+
+class TestParameterStats(unittest.TestCase):
+
+    def test_arrays(self):
+        """
+        Test that array values are summarised per column and over every element as numpy does
+        """
+        rand = random.Random(2)
+        values = [[rand.gauss(0, 1), rand.uniform(0, 10), rand.randint(0, 1000)] for _ in xrange(3000)]
+        stats = ParameterStats()
+        for value in values:
+            stats.add(value)
+        rows = stats.rows('param')
+
+        array = numpy.array(values)
+        self.assertEqual([row[:2] for row in rows], [('param(0)', 3000), ('param(1)', 3000), ('param(2)', 3000),
+                                                     ('param', 3)])
+        for row, column in zip(rows, list(array.T) + [array]):
+            self.assertEqual(row[2], numpy.min(column))
+            self.assertEqual(row[3], numpy.max(column))
+            self.assertAlmostEqual(row[4], numpy.median(column), delta=0.05 * numpy.std(column))
+            self.assertAlmostEqual(row[5], numpy.mean(column))
+            self.assertAlmostEqual(row[6], numpy.std(column))
+
+    def test_not_numeric(self):
+        """
+        Test that parameters with strings, bools, ragged or mixed array and scalar values are not summarised
+        """
+        for values in (['a', 'b'], [1, 'a'], [True, False], [1, True], [[1, 2], [1]], [[1, 2], 3], [3, [1, 2]],
+                       [[]], [None]):
+            stats = RecordStats().update({'param': value} for value in values)
+            self.assertFalse(stats.params['param'].numeric, values)
+
+        stats = RecordStats().update([{'a': 1, 'b': 'x'}, {'a': 2.5, 'b': 'y'}])
+        self.assertTrue(stats.params['a'].numeric)
+        self.assertEqual(stats.params['a'].rows('a'), [('a', 2, 1, 2.5, 1.75, 1.75, 0.75)])
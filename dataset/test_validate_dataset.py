@@ -0,0 +1,314 @@
+"""
+Tests for the validate_dataset test scheduler, with the EDEX log replaced by LogEvents fed lines directly and the
+sending and comparison of test cases replaced by recording functions, and for the expected results cache.
+Usage: python -m unittest test_validate_dataset
+"""
+__license__ = 'Apache 2.0'
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import validate_dataset
+from common import edex_tools
+from common.log_tailer import LogEvents
+
+
+class FakeTestCase(object):
+    """
+    The parts of a validate_dataset.TestCase the scheduler uses
+    """
+    def __init__(self, instrument, files, timeout=10, delays=None):
+        self.instrument = instrument
+        self.input_files = files
+        self.timeout = timeout
+        # seconds to wait before sending each file
+        self.delays = delays or [0] * len(files)
+        self.files = []
+        self.count = 0
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.execute_test = validate_dataset.execute_test
+        self.evaluate_test_case = validate_dataset.evaluate_test_case
+        self.send_file_to_queue = edex_tools.send_file_to_queue
+        edex_tools.send_file_to_queue = lambda path, queue, delivery, sensor, count: None
+        validate_dataset.execute_test = self.fake_execute_test
+        validate_dataset.evaluate_test_case = self.fake_evaluate_test_case
+        self.events = LogEvents()
+        self.evaluated = []
+        self.started = time.time()
+
+    def tearDown(self):
+        validate_dataset.execute_test = self.execute_test
+        validate_dataset.evaluate_test_case = self.evaluate_test_case
+        edex_tools.send_file_to_queue = self.send_file_to_queue
+
+    @staticmethod
+    def fake_execute_test(tc, send_file):
+        tc.files = []
+        for path, delay in zip(tc.input_files, tc.delays):
+            time.sleep(delay)
+            send_file(path, 'Ingest.%s' % tc.instrument, 'recovered', None, 1)
+            tc.files.append(path)
+        tc.count = len(tc.files)
+
+    def fake_evaluate_test_case(self, tc):
+        self.evaluated.append((tc.instrument, time.time() - self.started))
+        return {tc.instrument: 'done'}
+
+    def ingest(self, path):
+        self.events('INFO [Ingest.ctdbp-cdef_recovered-1] EDEX - Ingest complete for file: %s' % path)
+
+    def wait_evaluated(self, count, timeout=5):
+        end_time = time.time() + timeout
+        while len(self.evaluated) < count and time.time() < end_time:
+            time.sleep(0.01)
+        return [instrument for instrument, _ in self.evaluated]
+
+    def start(self, test_cases, submit_threads=1):
+        """
+        Run the scheduler in a thread
+        :return:  (thread, dictionary the scorecard is put in)
+        """
+        scheduler = validate_dataset.TestScheduler(submit_threads=submit_threads, events=self.events)
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(scheduler.run(test_cases, poll_interval=0.05)))
+        thread.start()
+        return thread, result
+
+    def test_ingested(self):
+        """
+        Test that each test case is compared once its own files are ingested, with the ingestion of a file sent by
+        more than one test case claimed in the order it was sent
+        """
+        test_cases = [FakeTestCase('a', ['/d/a/first.dat', '/d/a/second.dat']),
+                      FakeTestCase('b', ['/d/b/first.dat']),
+                      FakeTestCase('shared_1', ['/d/shared/subset.csv']),
+                      FakeTestCase('shared_2', ['/d/shared/subset.csv']),
+                      FakeTestCase('empty', [])]
+        thread, result = self.start(test_cases)
+
+        self.assertEqual(self.wait_evaluated(1), ['empty'])
+        self.ingest('/d/a/first.dat')
+        self.ingest('/d/b/first.dat')
+        self.assertEqual(self.wait_evaluated(2), ['empty', 'b'])
+        self.ingest('/d/shared/subset.csv')
+        self.assertEqual(self.wait_evaluated(3), ['empty', 'b', 'shared_1'])
+        self.ingest('/d/a/second.dat')
+        self.assertEqual(self.wait_evaluated(4), ['empty', 'b', 'shared_1', 'a'])
+        self.ingest('/d/shared//subset.csv')
+        self.assertEqual(self.wait_evaluated(5), ['empty', 'b', 'shared_1', 'a', 'shared_2'])
+
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(sorted(result.keys()), ['a', 'b', 'empty', 'shared_1', 'shared_2'])
+
+    def test_claim_order(self):
+        """
+        Test that a file sent by two test cases is claimed in the order the sends were made, not the order the test
+        cases finished sending
+        """
+        test_cases = [FakeTestCase('first', ['/d/shared/subset.csv', '/d/first/last.dat'], delays=[0, 0.3]),
+                      FakeTestCase('second', ['/d/shared/subset.csv'], delays=[0.1])]
+        thread, result = self.start(test_cases, submit_threads=2)
+
+        # second finishes sending before first
+        time.sleep(0.5)
+        self.ingest('/d/shared/subset.csv')
+        self.ingest('/d/first/last.dat')
+        self.assertEqual(self.wait_evaluated(1), ['first'])
+        time.sleep(0.2)
+        self.assertEqual(len(self.evaluated), 1)
+        self.ingest('/d/shared/subset.csv')
+        self.assertEqual(self.wait_evaluated(2), ['first', 'second'])
+        thread.join(5)
+        self.assertEqual(sorted(result.keys()), ['first', 'second'])
+
+    def test_timeout(self):
+        """
+        Test that a test case only times out once EDEX has made no ingest progress for its timeout
+        """
+        test_cases = [FakeTestCase('slow', ['/d/slow/never.dat'], timeout=0.5)]
+        thread, result = self.start(test_cases)
+
+        # other test cases' files keep being ingested for a second
+        for n in range(10):
+            time.sleep(0.1)
+            self.ingest('/d/other/%d.dat' % n)
+        self.assertEqual(self.evaluated, [])
+
+        self.assertEqual(self.wait_evaluated(1), ['slow'])
+        self.assertTrue(self.evaluated[0][1] >= 1.4)
+        thread.join(5)
+        self.assertEqual(result, {'slow': 'done'})
+
+    def test_unnamed(self):
+        """
+        Test that when the log does not name the ingested files, test cases are compared once the number of files
+        sent by all of them have been ingested
+        """
+        test_cases = [FakeTestCase('a', ['/d/a/first.dat', '/d/a/second.dat']), FakeTestCase('b', ['/d/b/first.dat'])]
+        thread, result = self.start(test_cases)
+
+        for _ in range(2):
+            self.events('INFO [Ingest.ctdbp-cdef_recovered-1] EDEX - Ingest complete for file')
+        time.sleep(0.2)
+        self.assertEqual(self.evaluated, [])
+        self.events('INFO [Ingest.ctdbp-cdef_recovered-1] EDEX - Ingest complete for file')
+        self.assertEqual(sorted(self.wait_evaluated(2)), ['a', 'b'])
+        thread.join(5)
+
+
+class TestEvaluate(unittest.TestCase):
+
+    def setUp(self):
+        self.get_from_edex_many = edex_tools.get_from_edex_many
+        self.get_edex_metadata = edex_tools.get_edex_metadata
+        edex_tools.get_from_edex_many = self.fake_get_from_edex_many
+        edex_tools.get_edex_metadata = lambda hostname, subsite, node, sensor: {}
+        self.calls = []
+
+    def tearDown(self):
+        edex_tools.get_from_edex_many = self.get_from_edex_many
+        edex_tools.get_edex_metadata = self.get_edex_metadata
+
+    def fake_get_from_edex_many(self, hostname, queries, **kwargs):
+        queries = list(queries)
+        self.calls.append(queries)
+        return {query: {} for query in queries}
+
+    def test_retrieve_many(self):
+        """
+        Test that every stream of a test case is retrieved in one call, and each compared with its expected results
+        """
+        tc = FakeTestCase('ctdbp_cdef_recovered', [])
+        tc.pairs = [('first.dat', 'first.yml'), ('second.dat', 'second.yml'), ('missing.dat', 'missing.yml')]
+        tc.sensor_ids = ['RS10ENGC-XX00X-00', 'RS10ENGC-XX00X-01', None]
+        record = {'particle_type': 'ctdbp_cdef_instrument_recovered', 'internal_timestamp': 1.0}
+        tc.expected = [{'ctdbp_cdef_instrument_recovered': [record], 'ctdbp_cdef_metadata_recovered': [record]},
+                       {'ctdbp_cdef_instrument_recovered': [record]},
+                       None]
+
+        sc = validate_dataset.evaluate_test_case(tc)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(sorted(query[:5] for query in self.calls[0]),
+                         [('RS10ENGC', 'XX00X', '00', 'recovered', 'ctdbp_cdef_instrument_recovered'),
+                          ('RS10ENGC', 'XX00X', '00', 'recovered', 'ctdbp_cdef_metadata_recovered'),
+                          ('RS10ENGC', 'XX00X', '01', 'recovered', 'ctdbp_cdef_instrument_recovered')])
+
+        results = sc['ctdbp_cdef_recovered']
+        self.assertEqual(sorted(results), ['first.dat', 'second.dat'])
+        self.assertEqual(sorted(results['first.dat']['first.yml']),
+                         ['ctdbp_cdef_instrument_recovered', 'ctdbp_cdef_metadata_recovered'])
+        retrieved_count, expected_count, failures = results['second.dat']['second.yml'][
+            'ctdbp_cdef_instrument_recovered']
+        self.assertEqual((retrieved_count, expected_count), (0, 1))
+        self.assertEqual([failure[0] for failure in failures], [edex_tools.FAILURES.MISSING_SAMPLE])
+
+
+EXPECTED_YML = """
+header:
+  particle_object: MULTIPLE
+  particle_type: MULTIPLE
+data:
+  - _index: 1
+    particle_type: ctdbp_cdef_instrument_recovered
+    internal_timestamp: 3583861263.0
+    temperature: %s
+    serial_number: '1234'
+  - _index: 2
+    particle_type: ctdbp_cdef_metadata_recovered
+    internal_timestamp: 3583861264.0
+    sensor_flags: [1, 2.5, null]
+"""
+
+
+class TestExpectedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+        self.yml = os.path.join(self.temp_dir, 'expected.yml')
+        self.msgpack = validate_dataset.msgpack
+        self.load = validate_dataset.load
+        self.expected = {None: [{u'_index': 1, 'uni': u'caf\xe9', 'bytes': 'abc', 'flags': [1, 2.5, None],
+                                 'nested': {'depth': -1.25}}],
+                         'ctdbp_cdef_instrument_recovered': [{'internal_timestamp': 3583861263.0}]}
+
+    def tearDown(self):
+        validate_dataset.msgpack = self.msgpack
+        validate_dataset.load = self.load
+        shutil.rmtree(self.temp_dir)
+
+    def write_yml(self, temperature):
+        with open(self.yml, 'w') as fh:
+            fh.write(EXPECTED_YML % temperature)
+
+    def cached_files(self):
+        return sorted(filename for _, _, filenames in os.walk(self.cache_dir) for filename in filenames)
+
+    def round_trip(self, fmt):
+        validate_dataset.write_cache('ab' * 20, self.cache_dir, self.expected)
+        self.assertEqual(self.cached_files(), ['ab' * 20 + '.' + fmt])
+        cached = validate_dataset.read_cache('ab' * 20, self.cache_dir)
+        self.assertEqual(cached, self.expected)
+        self.assertEqual(type(cached[None][0]['uni']), unicode)
+        self.assertEqual(type(cached[None][0]['bytes']), str)
+
+    def test_round_trip_pickle(self):
+        """
+        Test that expected results read back from a pickle cache file are those written
+        """
+        validate_dataset.msgpack = None
+        self.round_trip('pickle')
+
+    @unittest.skipIf(validate_dataset.msgpack is None, 'msgpack is not installed')
+    def test_round_trip_msgpack(self):
+        """
+        Test that expected results read back from a msgpack cache file are those written, including the None
+        particle type key and unicode and byte strings
+        """
+        self.round_trip('msgpack')
+
+    @unittest.skipIf(validate_dataset.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_fallback(self):
+        """
+        Test that expected results with values msgpack cannot represent are cached as a pickle instead
+        """
+        self.expected['ctdbp_cdef_instrument_recovered'][0]['counter'] = 2 ** 70
+        self.expected[None][0]['set'] = set([1, 2])
+        self.round_trip('pickle')
+
+    def test_not_cached(self):
+        """
+        Test that a hash with no cache file reads as not cached
+        """
+        self.assertIsNone(validate_dataset.read_cache('cd' * 20, self.cache_dir))
+
+    def test_invalidate(self):
+        """
+        Test that expected results are read from the cache until the YAML file changes, and are then parsed again
+        """
+        self.write_yml(10.5)
+        expected = validate_dataset.get_expected(self.yml, self.cache_dir)
+        self.assertEqual([record['temperature'] for record in expected['ctdbp_cdef_instrument_recovered']], [10.5])
+        self.assertEqual(expected['ctdbp_cdef_metadata_recovered'][0]['sensor_flags'], [1, 2.5, None])
+        self.assertEqual(len(self.cached_files()), 1)
+
+        def fail(_):
+            raise AssertionError('parsed a cached YAML file')
+
+        validate_dataset.load = fail
+        self.assertEqual(validate_dataset.get_expected(self.yml, self.cache_dir), expected)
+
+        validate_dataset.load = self.load
+        self.write_yml(11.5)
+        expected = validate_dataset.get_expected(self.yml, self.cache_dir)
+        self.assertEqual([record['temperature'] for record in expected['ctdbp_cdef_instrument_recovered']], [11.5])
+        self.assertEqual(len(self.cached_files()), 2)
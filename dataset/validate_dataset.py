@@ -4,9 +4,12 @@
 Usage:
   validate_dataset.py [--ignore_null]
   validate_dataset.py [--ignore_null] <test_case>...
+  validate_dataset.py --warm_cache [--processes=<n>] [<test_case>...]
 
 Options:
-  --ignore_null  Don't fail on missing null values
+  --ignore_null      Don't fail on missing null values
+  --warm_cache       Parse the expected results of the test cases into the cache and exit
+  --processes=<n>    Number of processes parsing expected results, defaults to the number of CPUs
 
 """
 import os
@@ -17,8 +20,11 @@ tools_dir = os.path.dirname(dataset_dir)
 
 sys.path.append(tools_dir)
 
-import json
 import time
+import errno
+import hashlib
+import tempfile
+import cPickle
 import pprint
 import ntplib
 import random
@@ -30,16 +36,37 @@ from datetime import datetime
 from yaml import load
 from common import logger
 from common import edex_tools
+from common.log_tailer import log_event
 
+from multiprocessing import Pool
 from multiprocessing.pool import ThreadPool
-from threading import RLock
-
-rlock = RLock()
+from Queue import Queue, Empty
+from threading import Event, Lock, RLock
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# unpack strings to unicode as packed, and allow the None particle type as a key: msgpack 0.5.2 replaced encoding
+# with raw, and 1.0 only allows str and bytes keys unless strict_map_key is off
+if msgpack is None:
+    MSGPACK_UNPACK_OPTIONS = None
+elif msgpack.version >= (1, 0):
+    MSGPACK_UNPACK_OPTIONS = {'raw': False, 'strict_map_key': False}
+elif msgpack.version >= (0, 5, 2):
+    MSGPACK_UNPACK_OPTIONS = {'raw': False}
+else:
+    MSGPACK_UNPACK_OPTIONS = {'encoding': 'utf-8'}
 
 IGNORE_NULLS = False
 VALIDATE_TIMESTAMP = time.strftime('%Y%m%d.%H:%M:%S', time.localtime())
 
-MAX_THREADS = 30
+# workers sending test files to the ingest queues, and workers retrieving and comparing ingested results
+MAX_SUBMIT_THREADS = 30
+MAX_VERIFY_THREADS = 8
+# streams of a test case retrieved at once, so the verify workers together stay within the HTTP connection pool
+MAX_RETRIEVE_REQUESTS = max(1, edex_tools.HTTP_POOL_SIZE / MAX_VERIFY_THREADS)
 
 startdir = os.path.join(edex_tools.edex_dir, 'data/utility/edex_static/base/ooi/parsers/mi-dataset/mi')
 drivers_dir = os.path.join(startdir, 'dataset/driver')
@@ -67,6 +94,7 @@ class TestCase(object):
         self.sensor = config.get('sensor')
         self.sensor_ids = []
         self.expected = []
+        self.files = []
         self.count = 0
 
     def __str__(self):
@@ -87,22 +115,92 @@ def read_test_cases(f):
         yield TestCase(config)
 
 
+def cache_paths(digest, cache_dir):
+    """
+    :param digest:  hash of the YAML file
+    :param cache_dir:  directory holding the cache
+    :return:  list of (path, format) the expected results may be cached at, the preferred format first
+    """
+    base = os.path.join(cache_dir, digest[:2], digest)
+    paths = [(base + '.pickle', 'pickle')]
+    if msgpack is not None:
+        paths.insert(0, (base + '.msgpack', 'msgpack'))
+    return paths
+
+
+def read_cache(digest, cache_dir):
+    """
+    :return:  the cached expected results for a YAML file hash, or None if not cached
+    """
+    for path, fmt in cache_paths(digest, cache_dir):
+        try:
+            with open(path, 'rb') as fh:
+                if fmt == 'msgpack':
+                    return msgpack.unpackb(fh.read(), **MSGPACK_UNPACK_OPTIONS)
+                return cPickle.load(fh)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                log.warn('Exception reading cache %s, parsing YML: %s', path, e)
+        except Exception as e:
+            log.warn('Exception reading cache %s, parsing YML: %s', path, e)
+    return None
+
+
+def write_cache(digest, cache_dir, expected):
+    """
+    Cache expected results under the YAML file hash.  Each file is written to a temporary file and renamed into
+    place, so concurrent writers and readers never see a partial file.
+    """
+    for path, fmt in cache_paths(digest, cache_dir):
+        try:
+            if fmt == 'msgpack':
+                data = msgpack.packb(expected, use_bin_type=True)
+            else:
+                data = cPickle.dumps(expected, cPickle.HIGHEST_PROTOCOL)
+        except (TypeError, OverflowError, ValueError):
+            # values msgpack cannot represent, such as integers of 2**64 or more, fall back to pickle
+            continue
+
+        dirname = os.path.dirname(path)
+        try:
+            if not os.path.exists(dirname):
+                log.info('creating dir: %s', dirname)
+                os.makedirs(dirname)
+        except OSError:
+            # created by another writer
+            pass
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=dirname, prefix='.' + digest)
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+            os.rename(temp_path, path)
+        except (IOError, OSError) as e:
+            log.warn('Exception writing cache %s: %s', path, e)
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+        return
+
+
 def get_expected(filename, cache_dir='.cache'):
     """
-    Loads expected results from the supplied YAML file
+    Loads expected results from the supplied YAML file, cached by the hash of the file so changes to it are seen
     :param filename:
     :return: list of records containing the expected results
     """
-    cached_path = os.path.join(cache_dir, filename.split('mi-dataset/')[1])
-    if os.path.exists(cached_path):
-        try:
-            return json.load(open(cached_path))
-        except:
-            log.warn('Exception reading JSON cache, parsing YML')
+    try:
+        with open(filename, 'r') as fh:
+            text = fh.read()
+    except IOError:
+        return {}
+
+    digest = hashlib.sha1(text).hexdigest()
+    expected_dictionary = read_cache(digest, cache_dir)
+    if expected_dictionary is not None:
+        return expected_dictionary
 
     try:
-        fh = open(filename, 'r')
-        data = load(fh)
+        data = load(text)
         log.debug('Raw data from YAML: %s', data)
         header = data.get('header')
         data = data.get('data')
@@ -138,39 +236,74 @@ def get_expected(filename, cache_dir='.cache'):
     for record in data:
         expected_dictionary.setdefault(record.get('particle_type'), []).append(record)
 
-    dirname = os.path.dirname(cached_path)
     log.info('caching yml results for faster testing next run...')
-    # only allow one thread to write a cache file at a time
-    with rlock:
-        try:
-            if not os.path.exists(dirname):
-                log.info('creating dir: %s', dirname)
-                os.makedirs(dirname)
-            json.dump(expected_dictionary, open(cached_path, 'wb'))
-        except OSError:
-            pass
+    write_cache(digest, cache_dir, expected_dictionary)
 
     return expected_dictionary
 
 
-def test_results(expected, stream_name, sensor, method):
+def cache_expected(filename):
+    """
+    Parse one YAML file into the cache, in a worker process
+    :return:  number of records
+    """
+    return sum(len(records) for records in get_expected(filename).itervalues())
+
+
+def warm_cache(test_cases, processes=None):
+    """
+    Parse the expected results of every test case into the cache, in parallel processes
+    :param test_cases:  test cases whose YAML files are cached
+    :param processes:  number of processes, defaults to the number of CPUs
+    """
+    filenames = set()
+    for tc in test_cases:
+        for test_file, yaml_file in tc.pairs:
+            output_filepath = os.path.join(drivers_dir, tc.resource, yaml_file)
+            if os.path.exists(output_filepath):
+                filenames.add(output_filepath)
+            else:
+                log.error('Missing test results: %s', output_filepath)
+
+    now = time.time()
+    pool = Pool(processes)
+    try:
+        counts = pool.map(cache_expected, sorted(filenames))
+    finally:
+        pool.close()
+        pool.join()
+    log.info('Cached %d records from %d YML files in %.4f secs', sum(counts), len(filenames), time.time() - now)
+
+
+def stream_query(stream_name, sensor, method):
+    """
+    :param stream_name:  stream to retrieve
+    :param sensor:  reference designator the test files were sent with
+    :param method:  delivery method
+    :return:  edex_tools.get_from_edex_many query for all the records of the stream
+    """
     subsite, node, sensor = sensor.split('-', 3)
     start = ntplib.system_to_ntp_time(1)
     stop = 1e10
+    return subsite, node, sensor, method, stream_name, start, stop
+
+
+def test_results(expected, stream_name, sensor, method, retrieved):
+    """
+    Compare the records retrieved for a stream with the expected results
+    :param retrieved:  records retrieved by stream_query and edex_tools.get_from_edex_many
+    :return:  (number of records retrieved, number of records expected, list of failures)
+    """
+    subsite, node, sensor = sensor.split('-', 3)
 
     stream_code = '%s_%s_%s' % (stream_name, sensor, method)
 
-    log.info('Retrieving data (%s)', stream_code)
-    now = time.time()
     metadata = edex_tools.get_edex_metadata('localhost', subsite, node, sensor)
-    retrieved = edex_tools.get_from_edex('localhost', subsite, node, sensor, method,
-                                         stream_name, start, stop, timestamp_as_string=True)
-    elapsed = time.time() - now
     retrieved_count = 0
     for each in retrieved.itervalues():
         retrieved_count += len(each)
 
-    log.info('Retrieved %d records (%s) in %.4f secs', retrieved_count, stream_code, elapsed)
+    log.info('Retrieved %d records (%s)', retrieved_count, stream_code)
 
     log.debug(pprint.pformat(retrieved, depth=3))
     log.debug('Retrieved %d records from expected data file:', len(expected))
@@ -195,10 +328,18 @@ def dump_csv(data):
     fh.close()
 
 
-def execute_test(test_case):
+def execute_test(test_case, send_file=None):
+    """
+    Send the test files of a test case to EDEX and read their expected results
+    :param test_case:  test case to send
+    :param send_file:  function called as edex_tools.send_file_to_queue to send each file, defaults to it
+    """
+    if send_file is None:
+        send_file = edex_tools.send_file_to_queue
     index = random.randint(0, 999)
     log.debug('Processing test case: %s index: %d', test_case, index)
     test_case.count = 0
+    test_case.files = []
 
     for test_file, yaml_file in test_case.pairs:
         input_filepath = os.path.join(drivers_dir, test_case.resource, test_file)
@@ -219,7 +360,7 @@ def execute_test(test_case):
 
             try:
                 log.info('Sending file (%s) to queue (%s)', test_file, queue)
-                edex_tools.send_file_to_queue(input_filepath, queue, delivery, sensor, 1)
+                send_file(input_filepath, queue, delivery, sensor, 1)
             except NotFound:
                 log.warn('Queue not found: %s', queue)
                 return None
@@ -227,6 +368,7 @@ def execute_test(test_case):
             log.info('Fetching expected results from YML file: %s', yaml_file)
             test_case.sensor_ids.append(sensor)
             test_case.expected.append(get_expected(output_filepath))
+            test_case.files.append(input_filepath)
             test_case.count += 1
 
         else:
@@ -240,11 +382,23 @@ def evaluate_test_case(tc):
     sc = {}
     method = tc.instrument.split('_')[-1]
     try:
+        queries = set()
+        for index, sensor in enumerate(tc.sensor_ids):
+            if sensor is not None:
+                queries.update(stream_query(stream, sensor, method) for stream in tc.expected[index])
+
+        log.info('Retrieving data (%s) for %d streams', tc.instrument, len(queries))
+        now = time.time()
+        retrieved = edex_tools.get_from_edex_many('localhost', queries, timestamp_as_string=True,
+                                                  max_requests=MAX_RETRIEVE_REQUESTS, streaming=True)
+        log.info('Retrieved data (%s) for %d streams in %.4f secs', tc.instrument, len(queries), time.time() - now)
+
         for index, sensor in enumerate(tc.sensor_ids):
             expected = tc.expected[index]
             if sensor is not None:
                 for stream in expected:
-                    results = test_results(expected[stream], stream, sensor, method)
+                    results = test_results(expected[stream], stream, sensor, method,
+                                           retrieved[stream_query(stream, sensor, method)])
                     sc.setdefault(tc.instrument, {}) \
                         .setdefault(tc.pairs[index][0], {}) \
                         .setdefault(tc.pairs[index][1], {})[stream] = results
@@ -256,33 +410,166 @@ def evaluate_test_case(tc):
     return sc
 
 
+class TestScheduler(object):
+    """
+    Runs each test case through sending, ingestion, retrieval and comparison on its own.  A test case is handed to
+    the verify workers as soon as the EDEX log shows its files ingested, so the whole run takes as long as the
+    slowest test case rather than the sum of the timeouts.  A test case times out when EDEX has made no ingest
+    progress for its timeout, so cases queued behind slower ones in EDEX are not given up on early.
+    """
+
+    def __init__(self, logfile=None, submit_threads=MAX_SUBMIT_THREADS, verify_threads=MAX_VERIFY_THREADS,
+                 events=None):
+        """
+        :param logfile:  cursor from edex_tools.log_cursor to watch the log from
+        :param submit_threads:  number of workers sending test files
+        :param verify_threads:  number of workers retrieving and comparing results
+        :param events:  LogEvents to count ingestion with instead of watching the EDEX log
+        """
+        self.submit_pool = ThreadPool(submit_threads)
+        self.verify_pool = ThreadPool(verify_threads)
+        self.lock = RLock()
+        # test cases sent and waiting for ingestion -> time they were sent
+        self.waiting = {}
+        # file path -> number of times sent, and test case -> [(file path, number of earlier sends of the path)]
+        self.sends = {}
+        self.claims = {}
+        # file path -> lock held while sending the path, so its sends are claimed in the order they are made
+        self.send_locks = {}
+        self.unsent = 0
+        self.sent_files = 0
+        self.last_progress = time.time()
+        self.results = Queue()
+        # set to have the run loop check the waiting test cases, rather than checking on the log tailer thread
+        self.wakeup = Event()
+        if events is None:
+            events = edex_tools.watch_log_events(logfile, callback=self.log_event)
+        else:
+            events.callback = self.log_event
+        self.events = events
+
+    def log_event(self, event):
+        """
+        Report progress from the EDEX log and wake the run loop to check for test cases which are now ingested
+        :param event:  LogEvent from the EDEX log
+        """
+        log_event(event)
+        if event.name == 'ingest_complete':
+            self.last_progress = time.time()
+            self.wakeup.set()
+
+    def ingested(self, tc):
+        """
+        Ingest events for a file sent more than once, by the same or different test cases, are claimed in the order
+        the file was sent
+        :return:  True if the log shows all files of the test case ingested, or all files of every test case if the
+                  log does not name the files
+        """
+        if all(self.events.count('ingest_complete', path) > earlier for path, earlier in self.claims[tc]):
+            return True
+        return self.unsent == 0 and self.events.unnamed('ingest_complete') >= self.sent_files
+
+    def check(self):
+        """
+        Hand test cases which are ingested, or have timed out, to the verify workers
+        """
+        now = time.time()
+        with self.lock:
+            for tc, sent_time in self.waiting.items():
+                ingested = self.ingested(tc)
+                if ingested or now >= max(sent_time, self.last_progress) + tc.timeout:
+                    del self.waiting[tc]
+                    self.verify_pool.apply_async(self.verify, (tc, ingested))
+
+    def send_file(self, tc, path, *args):
+        """
+        Send a file of a test case, claiming the next ingestion of the path as the send is made rather than when the
+        test case has finished sending, so a file sent by several test cases is claimed in the order it was sent
+        :param tc:  test case sending the file
+        :param path:  file path, followed by the remaining arguments of edex_tools.send_file_to_queue
+        """
+        key = os.path.normpath(path)
+        with self.lock:
+            send_lock = self.send_locks.setdefault(key, Lock())
+        with send_lock:
+            edex_tools.send_file_to_queue(path, *args)
+            with self.lock:
+                self.claims[tc].append((key, self.sends.get(key, 0)))
+                self.sends[key] = self.sends.get(key, 0) + 1
+
+    def send(self, tc):
+        """
+        Send the files of a test case and start waiting for their ingestion
+        """
+        with self.lock:
+            self.claims[tc] = []
+        try:
+            execute_test(tc, lambda *args: self.send_file(tc, *args))
+        except Exception as e:
+            log.error('Exception sending test case %r: %s', tc, e)
+        with self.lock:
+            self.waiting[tc] = time.time()
+            self.unsent -= 1
+            self.sent_files += tc.count
+        self.wakeup.set()
+
+    def verify(self, tc, ingested):
+        """
+        Retrieve and compare the results of a test case
+        """
+        sc = {}
+        try:
+            if not ingested:
+                log.error('Timed out waiting for ingest complete message (%s)', tc.instrument)
+            sc = evaluate_test_case(tc)
+        finally:
+            self.results.put(sc)
+            self.wakeup.set()
+
+    def run(self, test_cases, poll_interval=1.0):
+        """
+        :param test_cases:  test cases to run
+        :param poll_interval:  longest time between checks for test cases timing out while the log is quiet
+        :return:  the scorecard of all test cases
+        """
+        sc = {}
+        with self.lock:
+            self.unsent += len(test_cases)
+        for tc in test_cases:
+            self.submit_pool.apply_async(self.send, (tc,))
+
+        remaining = len(test_cases)
+        while remaining:
+            self.wakeup.wait(poll_interval)
+            self.wakeup.clear()
+            self.check()
+            while True:
+                try:
+                    sc.update(self.results.get_nowait())
+                    remaining -= 1
+                except Empty:
+                    break
+
+        self.events.close()
+        self.submit_pool.close()
+        self.verify_pool.close()
+        self.submit_pool.join()
+        self.verify_pool.join()
+        log.info('Ingest complete per queue: %s', self.events.queues['ingest_complete'])
+        log.info('EDEX exceptions per queue: %s', self.events.queues['exception'])
+        return sc
+
+
 def test(my_test_cases):
     try:
-        logfile = edex_tools.find_latest_log()
+        scheduler = TestScheduler(edex_tools.log_cursor())
     except OSError as e:
         log.error('Error fetching latest log file - %s', e)
         return {}
 
-    total_timeout = 0
-    count = 0
-    sc = {}
-    pool = ThreadPool(MAX_THREADS)
-
-    pool.map(execute_test, my_test_cases)
+    sc = scheduler.run(my_test_cases)
 
-    for tc in my_test_cases:
-        total_timeout += tc.timeout
-        count += tc.count
-
-    # wait for all ingestion to complete
-    if not edex_tools.watch_log_for('EDEX - Ingest complete for file', logfile=logfile,
-                                    expected_count=count, timeout=total_timeout):
-        log.error('Timed out waiting for ingest complete message')
-
-    log.info('All files ingested, testing results')
-
-    for tc in pool.map(evaluate_test_case, test_cases):
-        sc.update(tc)
+    log.info('Results cache: %s', edex_tools.results_cache.stats())
 
     return sc
 
@@ -299,6 +586,11 @@ if __name__ == '__main__':
         for each in options['<test_case>']:
             test_cases.extend(list(read_test_cases(each)))
 
+    if options['--warm_cache']:
+        processes = options['--processes']
+        warm_cache(test_cases, int(processes) if processes else None)
+        sys.exit(0)
+
     scorecard = test(test_cases)
 
     result, table_data = edex_tools.parse_scorecard(scorecard)
@@ -15,6 +15,7 @@ import yaml
 import time
 import pprint
 from common import edex_tools
+from common.log_tailer import log_event
 from common import logger
 
 omc_dir = os.getenv('OMC_HOME')
@@ -106,7 +107,8 @@ def purge_edex(logfile=None):
 
 def test(test_cases):
     try:
-        logfile = edex_tools.find_latest_log()
+        logfile = edex_tools.log_cursor()
+        events = edex_tools.watch_log_events(logfile, callback=log_event)
     except OSError as e:
         log.error('Error fetching latest log file - %s', e)
         return
@@ -129,10 +131,12 @@ def test(test_cases):
         for source in test_case.source_data:
             num_files += load_files(test_case.resource, test_case.endpoint, source, sensor)
 
-    if not edex_tools.watch_log_for('Ingest: EDEX: Ingest', logfile=logfile,
-                                    timeout=total_timeout, expected_count=num_files):
+    if not events.wait_count('ingest', num_files, total_timeout):
         log.error('Timed out waiting for ingest complete message')
         time.sleep(1)
+    events.close()
+    log.info('Ingested per queue: %s', events.queues['ingest'])
+    log.info('EDEX exceptions per queue: %s', events.queues['exception'])
 
     mio_analysis(hostname='localhost', output_dir=output_dir)
 
@@ -148,9 +152,9 @@ def mio_analysis(hostname='localhost', output_dir='./'):
     instruments = edex_tools.edex_get_instruments(hostname)
 
     for stream in instruments:
-        for instrument in instruments[stream]:
+        for instrument, method in instruments[stream]:
             log.info('calculating results for %s:%s...' % (stream, instrument))
-            edex_tools.edex_mio_report(hostname, stream, instrument, output_dir)
+            edex_tools.edex_mio_report(hostname, stream, instrument, method, output_dir)
             log.info('fetching netcdf file for %s:%s...' % (stream, instrument))
             edex_tools.get_netcdf(hostname, stream, instrument, output_dir=output_dir)
     log.info('done')
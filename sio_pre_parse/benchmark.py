@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Benchmark the .mdd tag scanner against the original find based parser, or procall over synthetic .mdd files
+generated at increasing multiples of a base size
+
+Usage:
+  benchmark.py [--repeat=<n>]
+  benchmark.py procall [--scales=<list>] [--files=<n>] [--sections=<n>] [--section-size=<n>] [--escape=<f>]
+                       [--gaps=<f>] [--workers=<n>] [--seed=<n>]
+
+Options:
+  --repeat=<n>        Number of times to parse each fixture [default: 20]
+  --scales=<list>     Comma separated multiples of the base number of .mdd files [default: 1,10,100]
+  --files=<n>         Base number of .mdd files [default: 10]
+  --sections=<n>      Sections in each .mdd file [default: 20]
+  --section-size=<n>  Bytes in each section [default: 2048]
+  --escape=<f>        Fraction of sio data bytes which are escaped [default: 0.01]
+  --gaps=<f>          Fraction of sections left out of the .mdd files [default: 0.05]
+  --workers=<n>       Number of processes parsing node files in parallel [default: 1]
+  --seed=<n>          Random seed for the generated files [default: 0]
+
+"""
+__license__ = 'Apache 2.0'
+
+import glob
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import mdd
+import mdd_config
+import mdd_data
+import mdd_synth
+
+FIXTURE_DIRS = ['gp02hypm_mdd', 'gp03flmb_mdd', 'gi_mdd']
+
+
+def time_parser(parse, datas, repeat):
+    """
+    Time a parser over all the fixture data
+    :param parse: Function taking an mdd object and returning its sections
+    :param datas: List of mdd objects to parse
+    :param repeat: Number of times to parse each one
+    :return: (elapsed seconds, number of sections found)
+    """
+    nsections = 0
+    now = time.time()
+    for _ in xrange(repeat):
+        for d in datas:
+            nsections += len(parse(d))
+    return time.time() - now, nsections / repeat
+
+
+def bench_scan(repeat=20):
+    """
+    Parse each fixture directory with both parsers and print the time taken
+    :param repeat: Number of times to parse each file
+    """
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    for fixture_dir in FIXTURE_DIRS:
+        fns = glob.glob(os.path.join(base_dir, fixture_dir, '*.mdd'))
+        datas = [mdd.mdd(fn) for fn in fns]
+        nbytes = sum(len(d.data) for d in datas)
+
+        find_secs, find_count = time_parser(lambda d: list(d.iter_sections_find()), datas, repeat)
+        scan_secs, scan_count = time_parser(lambda d: list(d.iter_sections()), datas, repeat)
+
+        print '%s: %d files, %d bytes, %d sections' % (fixture_dir, len(fns), nbytes, scan_count)
+        print '  find: %8.4f secs %8.2f MB/s' % (find_secs, nbytes * repeat / find_secs / 1e6)
+        print '  scan: %8.4f secs %8.2f MB/s  (%.1fx)' % (scan_secs, nbytes * repeat / scan_secs / 1e6,
+                                                         find_secs / scan_secs)
+        if find_count != scan_count:
+            print '  section counts differ: find %d scan %d' % (find_count, scan_count)
+
+
+def peak_rss_mb():
+    """
+    :return: The peak resident set size of this process and its waited for children in MB
+    """
+    # ru_maxrss is in kB on linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.0
+
+
+def run_procall(fns, data_path, workers, result_queue):
+    """
+    Process target, run procall into a fresh data directory and report the time taken and peak memory
+    :param fns: The .mdd files to process
+    :param data_path: The data directory to write the node files and state into
+    :param workers: Number of processes parsing node files in parallel
+    :param result_queue: Queue to put the (elapsed seconds, peak RSS MB) result on
+    """
+    mdd_config.data_path = data_path
+    mdd_data.mdd_data.close()
+    now = time.time()
+    mdd.procall(fns, workers=workers)
+    result_queue.put((time.time() - now, peak_rss_mb()))
+
+
+def bench_procall(scales=(1, 10, 100), n_files=10, sections_per_file=20, section_size=2048, escape_density=0.01,
+                  gap_fraction=0.05, workers=1, seed=0):
+    """
+    Generate synthetic .mdd files at each scale and time procall over them, each in its own process so the peak
+    memory is that of the one run
+    :param scales: Multiples of the base number of .mdd files
+    :param n_files: Base number of .mdd files
+    :param sections_per_file: Sections in each .mdd file
+    :param section_size: Bytes in each section
+    :param escape_density: Fraction of sio data bytes which are escaped
+    :param gap_fraction: Fraction of sections left out of the .mdd files
+    :param workers: Number of processes parsing node files in parallel
+    :param seed: Random seed for the generated files
+    :return: List of (scale, number of files, bytes, sio blocks, elapsed seconds, peak RSS MB) tuples
+    """
+    results = []
+    for scale in scales:
+        work_dir = tempfile.mkdtemp()
+        try:
+            mdd_dir = os.path.join(work_dir, 'mdd')
+            data_path = os.path.join(work_dir, 'data')
+            os.mkdir(mdd_dir)
+            os.mkdir(data_path)
+            deployment = mdd_synth.SyntheticDeployment(escape_density=escape_density, gap_fraction=gap_fraction,
+                                                       seed=seed)
+            fns = deployment.generate(mdd_dir, n_files * scale, sections_per_file, section_size)
+            nbytes = sum(os.path.getsize(fn) for fn in fns)
+
+            result_queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=run_procall, args=(fns, data_path, workers, result_queue))
+            proc.start()
+            secs, rss = result_queue.get()
+            proc.join()
+
+            nblocks = sum(deployment.blocks.values())
+            results.append((scale, len(fns), nbytes, nblocks, secs, rss))
+            print '%4dx: %5d files %10d bytes %8d blocks %8.3f secs %8.2f MB/s %8.0f blocks/s %8.1f MB peak RSS' % \
+                (scale, len(fns), nbytes, nblocks, secs, nbytes / secs / 1e6, nblocks / secs, rss)
+        finally:
+            shutil.rmtree(work_dir)
+    return results
+
+
+if __name__ == '__main__':
+    import docopt
+    options = docopt.docopt(__doc__)
+    if options['procall']:
+        bench_procall([int(scale) for scale in options['--scales'].split(',')], int(options['--files']),
+                      int(options['--sections']), int(options['--section-size']), float(options['--escape']),
+                      float(options['--gaps']), int(options['--workers']), int(options['--seed']))
+    else:
+        bench_scan(int(options['--repeat']))
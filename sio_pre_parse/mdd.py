@@ -6,13 +6,37 @@
 # 5jun2014	dpingal@teledyne.com	Fix compatability with 7.14 glider firmware
 # 9dec2014  ehahn@bbn.com           Add sio parsing into individual instrument group files
 # 24feb2015 ehahn@bbn.com           Fixed handling old and new .mdd header format
+"""
+Parse .mdd files into node files, then sio blocks from the node files into instrument group files
+
+Usage:
+  mdd.py [--workers=<n>] [--stats] [--profile=<json_file>] <mdd_file>...
+  mdd.py watch [--workers=<n>] [--poll=<secs>] [--flush=<secs>] [--existing] [<glider>...]
+
+Options:
+  --workers=<n>          Number of processes parsing node files in parallel [default: 1]
+  --poll=<secs>          Seconds between scans of the from-glider directories [default: 10]
+  --flush=<secs>         Seconds between saves of the parser state [default: 300]
+  --stats                Print the node file write stats
+  --profile=<json_file>  Write stage, node file and instrument timings and throughput to a JSON file
+  --existing             Also process the .mdd files already in the directories when watching starts
+
+Watch mode runs until interrupted, processing .mdd files as they arrive in the from-glider directories of the
+listed gliders, or of all configured gliders if none are listed.
+
+"""
 
 import calendar
+import glob
 import mdd_config
 import mdd_data
+import mmap
+import os
 import re
 import time
+import traceback
 
+from pipeline_profile import NullProfile, PipelineProfile
 from sio_unpack import SioParse
 
 subunder = re.compile('_+')
@@ -20,20 +44,103 @@ subunder = re.compile('_+')
 MDD_TAGS = ['NODE:', 'PORT:', 'STARTOFFSET:', 'ENDOFFSET:']
 
 
+def scan_tags(data):
+    """
+    Walk the tags in .mdd data once, yielding a record for each tag group once all four tags have values.  Tag
+    values carry over between groups, and the search for the next group continues from the start of the payload,
+    the same as get_next_tag_group.  The next position of each tag is kept and only searched for again once the
+    scan has passed it, so each tag is found with one forward pass of the fast string search, rather than searching
+    to the end of the file for every group.
+    :param data: The .mdd file data, a string or memory map
+    :return: generator of (node, port, startoffset, endoffset, payload start, payload end) tuples
+    """
+    values = {'node': None, 'port': None, 'startoffset': None, 'endoffset': None}
+    # tag -> position of its next occurrence at or after offset, -1 once there are no more
+    positions = dict((tag, data.find(tag)) for tag in MDD_TAGS)
+    offset = 0
+    while True:
+        for tag, position in positions.items():
+            if 0 <= position < offset:
+                positions[tag] = data.find(tag, offset)
+        # a group is only read if start and end offset tags are still to come
+        if positions[MDD_TAGS[2]] < 0 or positions[MDD_TAGS[3]] < 0:
+            break
+
+        # read tags on consecutive lines starting at one of the tags found
+        tag_starts = set(position for position in positions.itervalues() if position >= 0)
+        start_line = min(tag_starts)
+        while start_line in tag_starts:
+            end_line = data.find('\n', start_line)
+            if end_line < 0:
+                # a tag on the last line with no payload after it
+                return
+            (tag, value) = data[start_line:end_line].split(':')
+            values[tag.lower()] = int(value.strip())
+            start_line = end_line + 1
+
+        offset = start_line
+        if None not in values.values():
+            dlen = 1 + values['endoffset'] - values['startoffset']
+            yield (values['node'], values['port'], values['startoffset'], values['endoffset'],
+                   offset, offset + dlen)
+
+
 class mdd(object):
-    def __init__(self, fn):
-        self.data = open(fn, 'rb').read()
-        offset = 0
-        self.sections = []
-        self.glider = self.gettag('full_filename').split('-')[0]
-        asctime = self.gettag('fileopen_time')
-        wstime = subunder.sub(' ', asctime)
-        self.time = calendar.timegm(time.strptime(wstime, '%a %b %d %H:%M:%S %Y'))
+    def __init__(self, fn, use_mmap=False):
+        """
+        Open an .mdd file and read its header
+        :param fn: The .mdd file name
+        :param use_mmap: If True, memory map the file and only yield sections through iter_sections, each
+                         section's data is then a zero-copy view into the map which is valid until close()
+        """
+        self.use_mmap = use_mmap
+        self.fid = open(fn, 'rb')
+        if use_mmap:
+            try:
+                self.data = mmap.mmap(self.fid.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # an empty file cannot be mapped
+                self.data = ''
+        else:
+            self.data = self.fid.read()
+            self.fid.close()
+        try:
+            self.glider = self.gettag('full_filename').split('-')[0]
+            asctime = self.gettag('fileopen_time')
+            wstime = subunder.sub(' ', asctime)
+            self.time = calendar.timegm(time.strptime(wstime, '%a %b %d %H:%M:%S %Y'))
+        except Exception:
+            # a file without a valid header, release it before giving up
+            self.close()
+            raise
+        if use_mmap:
+            self.sections = None
+        else:
+            self.sections = list(self.iter_sections())
+
+    def iter_sections(self):
+        """
+        Scan the tag groups in the file and yield a data section for each one
+        """
+        for (node, port, start, end, payload_start, payload_end) in scan_tags(self.data):
+            if self.use_mmap:
+                # buffer slices the map without copying, bad offsets give an empty section like slicing
+                sdata = buffer(self.data, payload_start, max(payload_end - payload_start, 0))
+            else:
+                sdata = self.data[payload_start:payload_end]
+            yield mdd_data.data_section(node, port, start, end, sdata)
+
+    def iter_sections_find(self):
+        """
+        Find each tag group with repeated searches, the original parser which scan_tags replaced.  Kept to check
+        and benchmark the scanner against.
+        """
         # initialize tags
         self.endoffset = None
         self.startoffset = None
         self.node = None
         self.port = None
+        offset = 0
         while True:
             # find and set tag values for the next group, overwriting previous values
             offset = self.get_next_tag_group(offset)
@@ -45,9 +152,20 @@ class mdd(object):
             if self.port is not None and self.node is not None and self.endoffset is not None and \
                     self.startoffset is not None:
                 dlen = 1 + self.endoffset - self.startoffset
-                sdata = self.data[offset:offset + dlen]
-                s = mdd_data.data_section(self.node, self.port, self.startoffset, self.endoffset, sdata)
-                self.sections.append(s)
+                if self.use_mmap:
+                    # buffer slices the map without copying, bad offsets give an empty section like slicing
+                    sdata = buffer(self.data, offset, max(dlen, 0))
+                else:
+                    sdata = self.data[offset:offset + dlen]
+                yield mdd_data.data_section(self.node, self.port, self.startoffset, self.endoffset, sdata)
+
+    def close(self):
+        """
+        Release the file, any memory mapped section data is no longer valid after this
+        """
+        if self.use_mmap and isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.fid.close()
 
     def get_next_tag_group(self, offset):
         """
@@ -118,23 +236,121 @@ class mdd(object):
         return self.data[found:end].strip()
 
 
-def procall(fns):
+class NodeFileWriter(object):
     """
-    Process a list of .mdd files
-    :param fns: List of .mdd files to process
-    :return: sections
+    Writes sections into the node files, keeping each file open until close.  A section starting past the end of
+    its file extends the file with truncate, leaving a sparse hole rather than writing zeros, and sections which
+    continue exactly where the previous write to the same file ended are batched into one write.
     """
-    # Prepare object to collect data into
-    db = mdd_data.mdd_data()
-    db.reset()
-    sects = db.sects()
+    def __init__(self):
+        # node file name -> [file object, file size, start of pending write, end of pending write, pending data]
+        self.files = {}
+        self.stats = {'sections': 0, 'opens': 0, 'writes': 0, 'extends': 0, 'bytes': 0, 'zero_bytes': 0}
+
+    def write(self, filename, start, data):
+        """
+        Write section data into a node file at its address
+        :param filename: The node file name in the data directory
+        :param start: The offset of the data in the node file
+        :param data: The section data, a string or buffer
+        """
+        if filename not in self.files:
+            try:
+                fid = open(mdd_config.datafile(filename), 'r+b')
+            except IOError:
+                fid = open(mdd_config.datafile(filename), 'wb')
+            fid.seek(0, 2)
+            self.files[filename] = [fid, fid.tell(), start, start, []]
+            self.stats['opens'] += 1
+        node_file = self.files[filename]
+        if node_file[4] and start != node_file[3]:
+            self._flush(node_file)
+        if not node_file[4]:
+            node_file[2] = start
+        node_file[4].append(data)
+        node_file[3] = start + len(data)
+        self.stats['sections'] += 1
+
+    def _flush(self, node_file):
+        """
+        Write out the pending data for one node file
+        :param node_file: The open node file entry
+        """
+        fid, size, start, _, chunks = node_file
+        if start > size:
+            # extend the file, the gap reads back as zeros without being written
+            fid.truncate(start)
+            self.stats['extends'] += 1
+            self.stats['zero_bytes'] += start - size
+        fid.seek(start)
+        if len(chunks) == 1:
+            data = chunks[0]
+        else:
+            data = bytearray()
+            for chunk in chunks:
+                data += chunk
+        fid.write(data)
+        self.stats['writes'] += 1
+        self.stats['bytes'] += len(data)
+        node_file[1] = max(size, start + len(data))
+        node_file[4] = []
+
+    def flush(self):
+        """
+        Write out all pending data, which must be done before the memory map the data came from is closed
+        """
+        for node_file in self.files.itervalues():
+            if node_file[4]:
+                self._flush(node_file)
+
+    def close(self):
+        """
+        Write out all pending data and close the node files
+        """
+        self.flush()
+        for node_file in self.files.itervalues():
+            node_file[0].close()
+        self.files = {}
+
+    def syscalls_saved(self):
+        """
+        :return: The number of system calls saved compared to opening, seeking, writing and closing the node file
+        for every section, with zero fills written out
+        """
+        stats = self.stats
+        # one open and close per node file instead of per section, one write per batch and no zero fill writes
+        return 2 * (stats['sections'] - stats['opens']) + stats['sections'] - stats['writes']
+
+    def report(self):
+        """
+        :return: A one line summary of the data written
+        """
+        return '%d sections, %d bytes written in %d writes, %d zero bytes left sparse, %d syscalls saved' % \
+            (self.stats['sections'], self.stats['bytes'], self.stats['writes'], self.stats['zero_bytes'],
+             self.syscalls_saved())
+
+
+def ingest(db, writer, fn, use_mmap=True, profile=None):
+    """
+    Write the sections of one .mdd file into the node files and merge them into the section indexes
+    :param db: The mdd_data object to collect sections and stats into
+    :param writer: The NodeFileWriter to write sections with
+    :param fn: The .mdd file to process
+    :param use_mmap: Memory map the .mdd file and write sections straight from the map
+    :param profile: Optional PipelineProfile to collect the tag scan and node file write timings in
+    :return: List of the port 1 node files which changed
+    """
+    if profile is None:
+        profile = NullProfile()
     stats = db.stats()
     changed_files = []
-    
-    # Ingest all sections in all input files
-    for fn in fns:
-        d = mdd(fn)
-        for sect in d.sections:
+    scan_start = time.time()
+    d = mdd(fn, use_mmap)
+    try:
+        sections = d.iter_sections() if use_mmap else d.sections
+        profile.stage('tag_scan', scan_start, len(d.data))
+        sections = profile.timed_iter('tag_scan', sections)
+        for sect in sections:
             sect.glider = d.glider
             sect.time = d.time
             #print fn, sect.node, sect.start, sect.end
@@ -142,62 +358,236 @@ def procall(fns):
             if sect.end <= sect.start:
                 #print 'start > end?? node %d port %d start %d end %d' % (sect.node, sect.port, sect.start, sect.end)
                 continue
-            # Create new or open existing output file
+            # Write each section out at its address, in a new or existing output file
             filename = 'node%dp%d.dat' % (sect.node, sect.port)
-            ofn = mdd_config.datafile(filename)
             # keep track of which port 1 node files change so sio block parsing can be done on them
             if sect.port == 1 and filename not in changed_files:
                 changed_files.append(filename)
-            try:
-                of = open(ofn, 'r+b')
-            except IOError:
-                of = open(ofn, 'wb')
-            # If we are past end of file, fill with zeroes
-            of.seek(0, 2)
-            if sect.start > of.tell():
-                of.write('\0' * (sect.start - of.tell()))
-            # Write each section out at its address
-            of.seek(sect.start)
-            of.write(sect.data)
-            of.close()
-            # Keep metadata for what we have processed
-            sects.append(sect)
+            write_start = time.time()
+            writer.write(filename, sect.start, sect.data)
+            profile.stage('node_write', write_start, len(sect.data))
+            # the data now lives in the node file, only keep metadata for what we have processed,
+            # merged into the sections already known for this node and port
+            sect.data = None
+            db.index(sect.node, sect.port).insert(sect)
             stats.accumulate(sect.node, sect.glider, 'bytes', 1 + sect.end - sect.start)
             stats.max(sect.node, sect.glider, 'last', sect.time)
-        
-    # Merge adjacent sections into one, start sorted by node/port/start
-    sects.sort(lambda a, b: cmp(a.node, b.node) or cmp(a.port, b.port) or cmp(a.start, b.start))
-    n = 0
-    while n < len(sects) - 1:
-        curr = sects[n]
-        # Merge subsequent sections into this one until we can't anymore
-        while n < len(sects) - 1:
-            next_sect = sects[n + 1]
-            if curr.node != next_sect.node or curr.port != next_sect.port:
-                break
-            elif curr.end < next_sect.start - 1:
-                break
-            curr.end = max(curr.end, next_sect.end)
-            curr.time = max(curr.time, next_sect.time)
-            del sects[n + 1]
-        n += 1
-    #print '\n'.join([repr(s) for s in sects])
+    finally:
+        # pending writes may refer to the memory map, write them out before it is closed, even if parsing failed
+        try:
+            flush_start = time.time()
+            writer.flush()
+            profile.stage('node_write', flush_start)
+        finally:
+            d.close()
+    return changed_files
+
+
+def procall(fns, use_mmap=True, workers=1, writer=None, profile=None):
+    """
+    Process a list of .mdd files
+    :param fns: List of .mdd files to process
+    :param use_mmap: Memory map the .mdd files and write sections straight from the map
+    :param workers: Number of processes parsing changed node files in parallel
+    :param writer: Optional NodeFileWriter to write the node files with, to collect its stats
+    :param profile: Optional PipelineProfile to collect stage, node file and instrument timings in
+    :return: sections
+    """
+    if profile is None:
+        profile = NullProfile()
+    # Prepare object to collect data into
+    db = mdd_data.mdd_data()
+    db.reset()
+    changed_files = []
+    if writer is None:
+        writer = NodeFileWriter()
+
+    # Ingest all sections in all input files
+    for fn in fns:
+        for filename in ingest(db, writer, fn, use_mmap, profile):
+            if filename not in changed_files:
+                changed_files.append(filename)
+    # the node files must be complete before their sio blocks are parsed
+    close_start = time.time()
+    writer.close()
+    profile.stage('node_write', close_start)
+
+    save_start = time.time()
     db.save()
+    profile.stage('mdd_state_save', save_start)
 
     # the following section of code was added to parse the initially created node files,
     # locate complete sio blocks, and copy those into fixed instrument specific files
-    sio_parse = SioParse()
+    sio_parse = SioParse(profile=profile)
 
-    # loop over each node file that has changed with this run and parse it
-    for changed_file in changed_files:
-        sio_parse.parse_file(changed_file)
+    # parse each node file that has changed with this run
+    sio_parse.parse_files(changed_files, workers)
 
     # save the sio parse database
+    save_start = time.time()
     sio_parse.save()
+    profile.stage('sio_state_save', save_start)
+    sio_parse.close()
+
+    return db.sects()
+
+
+class MddWatcher(object):
+    """
+    Process .mdd files as they arrive in a set of directories, keeping the mdd and sio parser state in memory
+    between files and only saving it every flush interval.
+    """
+    def __init__(self, dirs, workers=1, flush_interval=300, existing=False):
+        """
+        :param dirs: List of directories to watch for .mdd files
+        :param workers: Number of processes parsing changed node files in parallel
+        :param flush_interval: Seconds between saves of the parser state
+        :param existing: Process .mdd files already in the directories, otherwise they are skipped
+        """
+        self.dirs = dirs
+        self.workers = workers
+        self.flush_interval = flush_interval
+        self.db = mdd_data.mdd_data()
+        self.sio_parse = SioParse()
+        # .mdd files in the directories already processed or skipped
+        self.done = set()
+        # .mdd files seen but not yet processed, file name -> (size, mtime, time first seen)
+        self.pending = {}
+        # .mdd files which failed to process, file name -> (size, mtime), retried if they change
+        self.failed = {}
+        self.last_flush = time.time()
+        if not existing:
+            self.done.update(self.list_files())
+
+    def list_files(self):
+        """
+        :return: List of .mdd files currently in the watched directories
+        """
+        fns = []
+        for dir_name in self.dirs:
+            fns.extend(glob.glob(os.path.join(dir_name, '*.mdd')))
+        return fns
+
+    def poll(self):
+        """
+        Scan the directories once, processing any new .mdd file whose size and modification time have not
+        changed since the previous scan, so files still being written are left for a later scan.  A file which
+        fails to process is reported and skipped until it changes.
+        :return: List of (file name, seconds since the file was first seen, seconds processing) for each file
+        processed
+        """
+        now = time.time()
+        files = self.list_files()
+        # forget files removed from the directories, so only the files still there are remembered
+        listed = set(files)
+        self.done.intersection_update(listed)
+        for files_seen in (self.pending, self.failed):
+            for fn in files_seen.keys():
+                if fn not in listed:
+                    del files_seen[fn]
+
+        ready = []
+        for fn in sorted(files):
+            if fn in self.done:
+                continue
+            try:
+                fstat = os.stat(fn)
+            except OSError:
+                # removed since the directory was listed
+                continue
+            if self.failed.get(fn) == (fstat.st_size, fstat.st_mtime):
+                continue
+            self.failed.pop(fn, None)
+            first_seen = self.pending[fn][2] if fn in self.pending else now
+            if fn in self.pending and self.pending[fn][:2] == (fstat.st_size, fstat.st_mtime):
+                ready.append((fn, first_seen))
+            else:
+                self.pending[fn] = (fstat.st_size, fstat.st_mtime, first_seen)
+
+        processed = []
+        for fn, first_seen in ready:
+            start = time.time()
+            size, mtime, _ = self.pending.pop(fn)
+            try:
+                writer = NodeFileWriter()
+                try:
+                    changed_files = ingest(self.db, writer, fn)
+                finally:
+                    writer.close()
+                self.sio_parse.parse_files(changed_files, self.workers)
+            except Exception as e:
+                traceback.print_exc()
+                print '%s: failed, skipping until it changes: %s' % (fn, e)
+                self.failed[fn] = (size, mtime)
+                continue
+            self.done.add(fn)
+            end = time.time()
+            processed.append((fn, end - first_seen, end - start))
+
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+        return processed
+
+    def flush(self):
+        """
+        Save the mdd and sio parser state
+        """
+        self.db.save()
+        self.sio_parse.save()
+        self.last_flush = time.time()
+
+    def close(self):
+        """
+        Save the parser state and release the sio state store
+        """
+        self.flush()
+        self.sio_parse.close()
+
+    def run(self, poll_interval=10):
+        """
+        Poll the directories until interrupted, printing the latency of each processed file
+        :param poll_interval: Seconds between scans of the directories
+        """
+        try:
+            while True:
+                for fn, latency, elapsed in self.poll():
+                    print '%s: processed in %.3f secs, %.3f secs after arrival' % (fn, elapsed, latency)
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+
+def watch(gliders=None, workers=1, poll_interval=10, flush_interval=300, existing=False):
+    """
+    Watch the from-glider directories and process .mdd files as they arrive, until interrupted
+    :param gliders: List of glider names, defaults to all gliders in the system configuration
+    :param workers: Number of processes parsing changed node files in parallel
+    :param poll_interval: Seconds between scans of the directories
+    :param flush_interval: Seconds between saves of the parser state
+    :param existing: Also process the .mdd files already in the directories
+    """
+    if not gliders:
+        import mdp_config
+        gliders = mdp_config.getGliders()
+    dirs = [mdd_config.from_glider(glider) for glider in gliders]
+    MddWatcher(dirs, workers, flush_interval, existing).run(poll_interval)
 
-    return sects
 
 if __name__ == '__main__':
-    import sys
-    procall(sys.argv[1:])
+    import docopt
+    options = docopt.docopt(__doc__)
+    if options['watch']:
+        watch(options['<glider>'], int(options['--workers']), float(options['--poll']), float(options['--flush']),
+              options['--existing'])
+    else:
+        node_writer = NodeFileWriter()
+        run_profile = PipelineProfile() if options['--profile'] else None
+        procall(options['<mdd_file>'], workers=int(options['--workers']), writer=node_writer, profile=run_profile)
+        if options['--stats']:
+            print node_writer.report()
+        if run_profile is not None:
+            with open(options['--profile'], 'w') as fid:
+                fid.write(run_profile.to_json())
 
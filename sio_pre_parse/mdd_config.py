@@ -6,6 +6,8 @@ import os
 data_path = os.path.join(os.path.dirname(__file__), 'data')
 dockserver_path = '/var/opt/gmc/gliders/'
 host_name = 'test-dockserver.webbresearch.com/default'
+# parser state store, 'sqlite' or 'journal'
+state_backend = 'sqlite'
 
 def datafile(fn):
     return os.path.join(data_path, fn)
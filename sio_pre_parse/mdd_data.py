@@ -3,12 +3,12 @@
 # 08jul2013 dpingal@teledyne.com  Initial
 # 04sep2013 dpingal@teledyne.com  only one database object, added offsets
 
+import bisect
 import mdd_config
-import os
-import pickle
+import state_store
 
-# Where we save data
-dbfile = mdd_config.datafile('mdd.pckl')
+# Where data used to be saved in the data directory, migrated into the state store on first use
+dbfile_name = 'mdd.pckl'
 db = None
 
 class matrix(object):
@@ -67,29 +67,97 @@ class data_section(object):
         return 'data_section node: ' + str(self.node) + ' port: ' + str(self.port) \
                 + ' start: ' + str(self.start) + ' end: ' + str(self.end)
 
+# Sorted, merged sections for one node and port
+class section_index(object):
+    def __init__(self):
+        # starts are kept alongside the sections to bisect on
+        self.starts = []
+        self.sections = []
+
+    # Add a section, merging it with any it overlaps or is adjacent to
+    def insert(self, sect):
+        n = bisect.bisect_right(self.starts, sect.start)
+        if n > 0 and self.sections[n - 1].end >= sect.start - 1:
+            n -= 1
+            curr = self.sections[n]
+            curr.end = max(curr.end, sect.end)
+            curr.time = max(curr.time, sect.time)
+        else:
+            curr = sect
+            self.starts.insert(n, sect.start)
+            self.sections.insert(n, sect)
+        # Swallow following sections until there is a gap
+        last = n + 1
+        while last < len(self.sections) and self.sections[last].start <= curr.end + 1:
+            curr.end = max(curr.end, self.sections[last].end)
+            curr.time = max(curr.time, self.sections[last].time)
+            last += 1
+        del self.starts[n + 1:last]
+        del self.sections[n + 1:last]
+
+    def __len__(self):
+        return len(self.sections)
+
+    def __iter__(self):
+        return iter(self.sections)
+
 class mdddb(object):
     def __init__(self):
         self.stats = matrix()
-        self.sects = []
+        self.index = {}
         self.offsets = {}
                 
 class mdd_data(object):
     # There is only one actual database, ever
     db = None
+    store = None
+    # (node, port) keys of the section indexes handed out since the last save
+    dirty = set()
     def __init__(self):
         if not mdd_data.db:
-            try:
-                mdd_data.db = pickle.load(open(dbfile))
-            except IOError:
-                mdd_data.db = mdddb()
+            mdd_data.store = state_store.open_store('mdd')
+            # One time migration of the old pickled database
+            state_store.migrate_pickle(mdd_data.store, mdd_config.datafile(dbfile_name), mdd_data.migrate)
+            mdd_data.db = mdddb()
+            stats = mdd_data.store.get('meta', 'stats')
+            if stats is not None:
+                mdd_data.db.stats = stats
+            offsets = mdd_data.store.get('meta', 'offsets')
+            if offsets is not None:
+                mdd_data.db.offsets = offsets
+            mdd_data.dirty = set()
 
+    @staticmethod
+    def migrate(old_db, store):
+        # Migrate old data: build the section index from the old flat list
+        if not hasattr(old_db, 'index'):
+            old_db.index = {}
+            old_sects = old_db.__dict__.pop('sects', [])
+            old_sects.sort(key=lambda s: s.start)
+            for sect in old_sects:
+                sect.data = None
+                old_db.index.setdefault((sect.node, sect.port), section_index()).insert(sect)
+        for key, index in old_db.index.items():
+            store.put('index', key, index)
+        store.put('meta', 'stats', old_db.stats)
+        store.put('meta', 'offsets', getattr(old_db, 'offsets', {}))
+
+    # Only write the section indexes which may have changed
     def save(self):
-        import warnings
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            tempfn = os.tempnam(mdd_config.data_path, 'mdd.')
-        pickle.dump(mdd_data.db, open(tempfn, 'w'))
-        os.rename(tempfn, dbfile)
+        for key in mdd_data.dirty:
+            mdd_data.store.put('index', key, mdd_data.db.index[key])
+        mdd_data.store.put('meta', 'stats', mdd_data.db.stats)
+        mdd_data.store.put('meta', 'offsets', mdd_data.db.offsets)
+        mdd_data.store.commit()
+        mdd_data.dirty = set()
+
+    # Drop the in memory database, the next mdd_data() reopens the store
+    @staticmethod
+    def close():
+        if mdd_data.store is not None:
+            mdd_data.store.close()
+        mdd_data.store = None
+        mdd_data.db = None
 
     def reset(self):
         mdd_data.db.stats = matrix()
@@ -97,14 +165,31 @@ class mdd_data(object):
     def stats(self):
         return mdd_data.db.stats
     
+    # Section index for a node and port, loaded from the store on first use
+    def index(self, node, port):
+        key = (node, port)
+        if key not in mdd_data.db.index:
+            index = mdd_data.store.get('index', key)
+            if index is None:
+                index = section_index()
+            mdd_data.db.index[key] = index
+        mdd_data.dirty.add(key)
+        return mdd_data.db.index[key]
+
+    # Section indexes for all nodes and ports, keyed by (node, port)
+    def indexes(self):
+        for key, index in mdd_data.store.items('index').iteritems():
+            if key not in mdd_data.db.index:
+                mdd_data.db.index[key] = index
+        return mdd_data.db.index
+
+    # All merged sections, sorted by node, port and start
     def sects(self):
-        return mdd_data.db.sects
+        indexes = self.indexes()
+        sects = []
+        for key in sorted(indexes.keys()):
+            sects.extend(indexes[key].sections)
+        return sects
     
     def offsets(self):
-        # Migrate old data: add member if its not there
-        try:
-            return mdd_data.db.offsets
-        except AttributeError:
-            mdd_data.db.offsets = {}
-            return mdd_data.db.offsets
- 
\ No newline at end of file
+        return mdd_data.db.offsets
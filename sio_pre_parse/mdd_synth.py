@@ -0,0 +1,149 @@
+"""
+Generate synthetic .mdd files carrying sio blocks, for benchmarking the pre-parse at sizes beyond the fixtures.
+Each node has a stream of escaped sio blocks from a mix of instruments, which is cut into sections spread over the
+.mdd files in order, with some sections left out as gaps.
+"""
+__license__ = 'Apache 2.0'
+
+import calendar
+import os
+import random
+import time
+
+from sio_unpack import ID_MAP, SIO_BLOCK_END
+
+# bytes which are escaped by the modem, and the byte following the escape character for each
+ESCAPED_BYTES = {0x2b: b'\x18\x6b', 0x18: b'\x18\x58'}
+
+# the start of an sio header only appears at the start of a header
+SIO_HEADER_START = 0x01
+
+# start time of the generated files, in seconds since the epoch
+SYNTH_START_TIME = calendar.timegm((2015, 1, 1, 0, 0, 0))
+
+
+class SyntheticDeployment(object):
+    """
+    Generates the node streams and .mdd files for one glider.  The counts of generated sio blocks are kept
+    per node and instrument ID in blocks.
+    """
+
+    def __init__(self, nodes=(14, 16), instruments=None, block_size=(64, 512), escape_density=0.01,
+                 gap_fraction=0.05, glider='synth', seed=0):
+        """
+        :param nodes: The node IDs to generate streams for
+        :param instruments: Dictionary of sio instrument ID -> relative weight, defaults to all IDs in ID_MAP
+                            equally weighted
+        :param block_size: (minimum, maximum) number of unescaped data bytes in a block
+        :param escape_density: Fraction of data bytes which need to be escaped
+        :param gap_fraction: Fraction of sections left out of the .mdd files
+        :param glider: The glider name in the .mdd headers
+        :param seed: The random seed, the same arguments and seed give the same files
+        """
+        self.nodes = nodes
+        if instruments is None:
+            instruments = dict((instrument_id, 1) for instrument_id in ID_MAP)
+        self.instruments = sorted(instruments.items())
+        self.block_size = block_size
+        self.escape_density = escape_density
+        self.gap_fraction = gap_fraction
+        self.glider = glider
+        self.rand = random.Random(seed)
+        # node -> escaped stream not yet cut into sections, and the node file offset of its start
+        self.streams = dict((node, bytearray()) for node in nodes)
+        self.offsets = dict((node, 0) for node in nodes)
+        # (node, instrument ID) -> number of sio blocks generated
+        self.blocks = {}
+        # number of sections left out as gaps
+        self.gaps = 0
+
+    def sio_block(self, node):
+        """
+        Generate one escaped sio block
+        :param node: The node the block is for
+        :return: The block as a bytearray
+        """
+        rand = self.rand
+        instrument_id = self.choose_instrument()
+        self.blocks[(node, instrument_id)] = self.blocks.get((node, instrument_id), 0) + 1
+        data_len = rand.randint(*self.block_size)
+        block = bytearray(b'\x01%s%05d%02d_%04xA%08x_%02x_%04x\x02' % (
+            instrument_id, node, rand.randint(0, 99), data_len, SYNTH_START_TIME + rand.randint(0, 10000000),
+            rand.randint(0, 255), rand.randint(0, 65535)))
+        for _ in xrange(data_len):
+            if rand.random() < self.escape_density:
+                block += ESCAPED_BYTES[rand.choice((0x2b, 0x18))]
+            else:
+                byte = rand.randint(0, 255)
+                while byte in ESCAPED_BYTES or byte == SIO_HEADER_START:
+                    byte = rand.randint(0, 255)
+                block.append(byte)
+        block += SIO_BLOCK_END
+        return block
+
+    def choose_instrument(self):
+        """
+        :return: An instrument ID chosen by weight
+        """
+        pick = self.rand.uniform(0, sum(weight for _, weight in self.instruments))
+        for instrument_id, weight in self.instruments:
+            pick -= weight
+            if pick <= 0:
+                return instrument_id
+        return self.instruments[-1][0]
+
+    def next_section(self, node, size):
+        """
+        Cut the next section from a node stream, generating blocks as needed
+        :param node: The node ID
+        :param size: The number of bytes in the section
+        :return: (start offset, section data)
+        """
+        stream = self.streams[node]
+        while len(stream) < size:
+            stream += self.sio_block(node)
+        data = bytes(stream[:size])
+        del stream[:size]
+        start = self.offsets[node]
+        self.offsets[node] += size
+        return start, data
+
+    def write_mdd(self, fn, file_time, sections_per_file, section_size):
+        """
+        Write one .mdd file, with sections taken from each node in turn
+        :param fn: The .mdd file name
+        :param file_time: The file open time, in seconds since the epoch
+        :param sections_per_file: The number of sections in the file, including those left out as gaps
+        :param section_size: The number of bytes in each section
+        """
+        name = os.path.splitext(os.path.basename(fn))[0]
+        with open(fn, 'wb') as fid:
+            fid.write('the8x3_filename: %s\n' % name[-8:])
+            fid.write('full_filename: %s\n' % name)
+            fid.write('filename_extension: mdl\n')
+            fid.write('fileopen_time: %s\n' % time.strftime('%a_%b_%d_%H:%M:%S_%Y', time.gmtime(file_time)))
+            fid.write('mission_name: SYNTH.MI\n')
+            for n in xrange(sections_per_file):
+                node = self.nodes[n % len(self.nodes)]
+                start, data = self.next_section(node, section_size)
+                if self.rand.random() < self.gap_fraction:
+                    self.gaps += 1
+                    continue
+                fid.write('NODE: %d\nSTARTOFFSET: %d\nENDOFFSET: %d\nPORT: 1\n' % (node, start, start + len(data) - 1))
+                fid.write(data)
+
+    def generate(self, out_dir, n_files=10, sections_per_file=20, section_size=2048):
+        """
+        Write a sequence of .mdd files
+        :param out_dir: The directory to write them in
+        :param n_files: The number of .mdd files
+        :param sections_per_file: The number of sections in each file, including those left out as gaps
+        :param section_size: The number of bytes in each section
+        :return: List of the .mdd file names, in order
+        """
+        fns = []
+        for n in xrange(n_files):
+            fn = os.path.join(out_dir, '%s-2015-%03d-%d-0.mdd' % (self.glider, 1 + n / 10, n % 10))
+            self.write_mdd(fn, SYNTH_START_TIME + n * 3600, sections_per_file, section_size)
+            fns.append(fn)
+        return fns
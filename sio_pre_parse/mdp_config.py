@@ -10,6 +10,8 @@ xml_config_fn = mdd_config.datafile('ooi.xml')
 
 # All info about a node in an object (just data)
 class nodeInfo(object):
+    __slots__ = ('id', 'lat', 'lon', 'depth', 'name', 'rate')
+
     def __init__(self, n, posn, name, rate):
         self.id = int(n)
         self.lat = posn[0]
@@ -18,13 +20,32 @@ class nodeInfo(object):
         self.name = name
         self.rate = rate
 
+# Parsed configuration with lookups by node id and glider name
+class sysConfig(object):
+    def __init__(self, deployments):
+        self.deployments = deployments
+        # node id -> nodeInfo, glider name -> (gliders, nodes) deployment, node id -> glider names
+        self.nodes = {}
+        self.gliders = {}
+        self.node_gliders = {}
+        for deployment in deployments:
+            (gliders, nodes) = deployment
+            for glider in gliders:
+                self.gliders[glider] = deployment
+            for node in nodes:
+                self.nodes[node.id] = node
+                self.node_gliders.setdefault(node.id, []).extend(gliders)
+
+# The last configuration read, along with the file and modification time it was read from
+cache = {'key': None, 'config': None}
+
 # Shortcut to get subelement from a node
 def getElementData(doc, name):
     return str(doc.getElementsByTagName(name)[0].childNodes[0].data)
 
-# Read xml config file into usable glider and node lists
-def getSysConfig():
-    config = parse(xml_config_fn).getElementsByTagName('modemConfig')[0]
+# Parse the xml config file into glider and node lists
+def readSysConfig(fn):
+    config = parse(fn).getElementsByTagName('modemConfig')[0]
     deployments = config.getElementsByTagName('deployment')
     result = []
     for data in deployments:
@@ -41,3 +62,32 @@ def getSysConfig():
             nodes.append(nodeInfo(n, fposn, name, rate))
         result.append((gliders, nodes))
     return result
+
+# Parsed config file, only read again when the file changes
+def loadSysConfig():
+    fstat = os.stat(xml_config_fn)
+    key = (xml_config_fn, fstat.st_mtime, fstat.st_size)
+    if cache['key'] != key:
+        cache['config'] = sysConfig(readSysConfig(xml_config_fn))
+        cache['key'] = key
+    return cache['config']
+
+# Read xml config file into usable glider and node lists, shared between callers so not to be modified
+def getSysConfig():
+    return loadSysConfig().deployments
+
+# nodeInfo for a node id, or None if it is not configured
+def getNode(node_id):
+    return loadSysConfig().nodes.get(node_id)
+
+# (gliders, nodes) deployment a glider belongs to, or None if it is not configured
+def getDeployment(glider):
+    return loadSysConfig().gliders.get(glider)
+
+# Names of the gliders in the same deployment as a node
+def getNodeGliders(node_id):
+    return loadSysConfig().node_gliders.get(node_id, [])
+
+# Names of all configured gliders
+def getGliders():
+    return sorted(loadSysConfig().gliders.keys())
@@ -3,53 +3,111 @@
 # 08jul2013 dpingal@teledyne.com  Initial
 # 04sep2013 dpingal@teledyne.com  added starting offset
 
+import bisect
+import mdd_config
 import mdd_data
+import mdp_config
 import os
 
 final = 9999999
-db = mdd_data.mdd_data()
-sects = db.sects()
 
 class mdrfile(object):
     def __init__(self, fn):
         self.file = open(fn, 'w')
-    
+
     def sect(self, start, end, port):
         self.file.write('STARTOFFSET: %d\n' % start)
         self.file.write('ENDOFFSET: %d\n' % end)
         self.file.write('PORT: %d\n' % port)
-        
+
     def close(self):
         self.file.close()
-    
-def port(f, node, port, minval = 0, maxval = final):
-    posn = minval
-    for s in sects:
-        if s.node != node or s.port != port:
-            continue
-        
-        if s.start > posn:
-            f.sect(posn, s.start, port)
-        posn = max(minval, s.end + 1)
-    f.sect(posn, maxval, port)
-
-def mdr(node, path):
+
+# Missing ranges for every node and port, computed once from the section indexes
+class gap_index(object):
+    def __init__(self, indexes):
+        # (node, port) -> section starts, the position after each section and the gap before each section
+        self.starts = {}
+        self.nexts = {}
+        self.gaps = {}
+        for key, index in indexes.iteritems():
+            self.starts[key] = [s.start for s in index]
+            self.nexts[key] = [s.end + 1 for s in index]
+            # merged sections always have a gap between them
+            self.gaps[key] = [None] + [(prev.end + 1, s.start) for prev, s in zip(index.sections, index.sections[1:])]
+
+    # Missing ranges from minval, ending with the open range from the last known data to maxval
+    def missing(self, node, port, minval = 0, maxval = final):
+        key = (node, port)
+        if key not in self.nexts:
+            return [(minval, maxval)]
+        starts = self.starts[key]
+        nexts = self.nexts[key]
+        # sections ending before minval don't affect the result
+        n = bisect.bisect_right(nexts, minval)
+        if n == len(nexts):
+            return [(minval, maxval)]
+        ranges = []
+        if starts[n] > minval:
+            ranges.append((minval, starts[n]))
+        ranges.extend(self.gaps[key][n + 1:])
+        ranges.append((nexts[-1], maxval))
+        return ranges
+
+# Gap index for the current state of the database
+def gaps():
+    return gap_index(mdd_data.mdd_data().indexes())
+
+def port(f, node, port, minval = 0, maxval = final, index = None):
+    if index is None:
+        index = gaps()
+    for start, end in index.missing(node, port, minval, maxval):
+        f.sect(start, end, port)
+
+def mdr(node, path, index = None):
+    if index is None:
+        index = gaps()
     ofile = mdrfile(os.path.join(path, str(node) + '.mdr'))
-    start = db.offsets().setdefault(node, 0)
-    port(ofile, node, 1, start)
-    port(ofile, node, 2)
+    start = mdd_data.mdd_data().offsets().setdefault(node, 0)
+    port(ofile, node, 1, start, index = index)
+    port(ofile, node, 2, index = index)
     ofile.close()
 
-def genmdr(node, path, max):
+def genmdr(node, path, max, index = None):
+    if index is None:
+        index = gaps()
     ofile = mdrfile(os.path.join(path, str(node) + '.mdr'))
-    start = db.offsets().setdefault(node, 0)
-    port(ofile, node, 1, start, max)
+    start = mdd_data.mdd_data().offsets().setdefault(node, 0)
+    port(ofile, node, 1, start, max, index)
     ofile.close()
 
 def genmdrs(path, nodes):
+    index = gaps()
     for (id, max) in nodes.items():
-        genmdr(id, path, max)
+        genmdr(id, path, max, index)
+
+# Write .mdr files for every node of every deployment into the to-glider directory of each of its gliders,
+# or into path if given
+def genall(path = None):
+    index = gaps()
+    for (gliders, nodes) in mdp_config.getSysConfig():
+        paths = [path] if path else [mdd_config.to_glider(glider) for glider in gliders]
+        for opath in paths:
+            for node in nodes:
+                mdr(node.id, opath, index)
+
+# Write .mdr files for the nodes of the deployment a glider belongs to, into its to-glider directory or path
+def genglider(glider, path = None):
+    deployment = mdp_config.getDeployment(glider)
+    if deployment is None:
+        raise ValueError('Glider %s is not configured' % glider)
+    index = gaps()
+    for node in deployment[1]:
+        mdr(node.id, path or mdd_config.to_glider(glider), index)
 
 if __name__ == '__main__':
     import sys
-    mdr(int(sys.argv[1]), '.')
\ No newline at end of file
+    if sys.argv[1] == 'all':
+        genall(sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        mdr(int(sys.argv[1]), '.')
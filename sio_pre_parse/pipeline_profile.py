@@ -0,0 +1,125 @@
+"""
+Opt-in counters and wall clock timers for the .mdd and sio pre-parse pipeline, kept per stage, per node file and
+per sio instrument ID, and reported as JSON with the throughput of each.
+"""
+__license__ = 'Apache 2.0'
+
+import json
+import time
+
+
+class PipelineProfile(object):
+    """
+    Accumulates seconds, calls, bytes and sio blocks.  Counters from profiles in other processes are combined with
+    merge, so pool workers return their counters rather than the profile.
+    """
+    TABLES = ('stages', 'nodes', 'instruments')
+    enabled = True
+
+    def __init__(self):
+        self.started = time.time()
+        # table -> key -> {'secs', 'calls', 'bytes', 'blocks'}
+        self.tables = dict((table, {}) for table in self.TABLES)
+
+    def add(self, table, key, secs, nbytes=0, blocks=0, calls=1):
+        """
+        Add to the counters for one key
+        :param table: 'stages', 'nodes' or 'instruments'
+        :param key: The stage name, node file name or instrument ID
+        :param secs: Seconds spent
+        :param nbytes: Bytes processed
+        :param blocks: Sio blocks processed
+        :param calls: Number of calls the time was spent over
+        """
+        counters = self.tables[table].get(key)
+        if counters is None:
+            counters = self.tables[table][key] = {'secs': 0.0, 'calls': 0, 'bytes': 0, 'blocks': 0}
+        counters['secs'] += secs
+        counters['calls'] += calls
+        counters['bytes'] += nbytes
+        counters['blocks'] += blocks
+
+    def stage(self, stage, start, nbytes=0, blocks=0):
+        """
+        Add the time since start to a stage
+        :param stage: The stage name
+        :param start: The time.time() the stage started
+        :param nbytes: Bytes processed
+        :param blocks: Sio blocks processed
+        :return: The seconds added
+        """
+        secs = time.time() - start
+        self.add('stages', stage, secs, nbytes, blocks)
+        return secs
+
+    def timed_iter(self, stage, iterable, item_blocks=0):
+        """
+        Wrap an iterable, adding the time spent getting each item to a stage
+        :param stage: The stage name
+        :param iterable: The iterable to wrap, such as a generator doing the work of the stage
+        :param item_blocks: Number of sio blocks to count for each item
+        :return: generator of the items of the iterable
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add('stages', stage, time.time() - start, calls=0)
+                return
+            self.add('stages', stage, time.time() - start, blocks=item_blocks)
+            yield item
+
+    def counters(self):
+        """
+        :return: The raw counters, to be handed to merge in another process
+        """
+        return self.tables
+
+    def merge(self, tables):
+        """
+        Add the raw counters from another profile
+        :param tables: Counters returned by counters()
+        """
+        for table, keys in tables.iteritems():
+            for key, counters in keys.iteritems():
+                self.add(table, key, counters['secs'], counters['bytes'], counters['blocks'], counters['calls'])
+
+    def report(self):
+        """
+        :return: Dictionary of the counters with MB/s and blocks/s added for each key, and the total wall clock
+        seconds since the profile was created
+        """
+        result = {'wall_secs': time.time() - self.started}
+        for table, keys in self.tables.iteritems():
+            result[table] = {}
+            for key, counters in keys.iteritems():
+                entry = dict(counters)
+                secs = counters['secs']
+                entry['mb_per_sec'] = counters['bytes'] / secs / 1e6 if secs > 0 else None
+                entry['blocks_per_sec'] = counters['blocks'] / secs if secs > 0 else None
+                result[table][str(key)] = entry
+        return result
+
+    def to_json(self):
+        """
+        :return: The report as a JSON string
+        """
+        return json.dumps(self.report(), indent=2, sort_keys=True)
+
+
+class NullProfile(PipelineProfile):
+    """
+    A profile which collects nothing, used when profiling is off so the pipeline has one code path
+    """
+    enabled = False
+
+    def add(self, table, key, secs, nbytes=0, blocks=0, calls=1):
+        pass
+
+    def stage(self, stage, start, nbytes=0, blocks=0):
+        return 0.0
+
+    def timed_iter(self, stage, iterable, item_blocks=0):
+        return iterable
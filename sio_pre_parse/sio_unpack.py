@@ -3,9 +3,14 @@ __license__ = 'Apache 2.0'
 
 import re
 import os
-import pickle
+import bisect
+import multiprocessing
+import time
+from collections import OrderedDict
 
 import mdd_config
+import state_store
+from pipeline_profile import NullProfile, PipelineProfile
 
 # SIO block end sentinel:
 SIO_BLOCK_END = b'\x03'
@@ -33,7 +38,18 @@ SIO_HEADER_GROUP_ID = 1           # Instrument ID
 SIO_HEADER_GROUP_DATA_LENGTH = 3  # Number of Data Bytes
 SIO_HEADER_GROUP_CTRL_ID = 2      # controller and instrument number
 
-sio_db_file = mdd_config.datafile('sio.pckl')
+sio_db_file_name = 'sio.pckl'
+
+# modem escape character, and map of the character following it to the unescaped byte
+SIO_ESCAPE_CHAR = b'\x18'
+SIO_ESCAPE_MAP = {b'\x6b': 0x2b, b'\x58': 0x18}
+
+# number of bytes of a node file read at a time when scanning for sio blocks
+SIO_SCAN_WINDOW = 1048576
+
+# maximum number of instrument group output files held open at once, and their write buffer size
+MAX_OPEN_OUTPUT_FILES = 32
+OUTPUT_BUFFER_SIZE = 65536
 
 # constants for accessing unprocessed data
 START_IDX = 0
@@ -54,6 +70,128 @@ ID_MAP = {
     'WE': 'we_wfp'}  # dosta_ln_wfp, flord_l_wfp, wfp_eng
 
 
+def unescape_block(data, start, out_len):
+    """
+    Undo the modem escape sequences (0x18 0x6b -> 0x2b, 0x18 0x58 -> 0x18) in a single pass.  The out_len input
+    bytes from the start index are decoded into a preallocated output, copying the runs between escape characters
+    directly.  Each replaced sequence leaves the output one byte short, and those bytes are filled straight from the
+    input following the decoded window, without unescaping, which is how blocks have always been extracted.
+    :param data: The escaped input data
+    :param start: The index in data to start decoding at
+    :param out_len: The number of bytes wanted
+    :return: (unescaped bytearray, number of input bytes consumed), the bytearray is shorter than out_len if the
+             input ran out
+    """
+    out = bytearray(out_len)
+    window_end = min(start + out_len, len(data))
+    in_idx = start
+    out_idx = 0
+    while in_idx < window_end:
+        esc_idx = data.find(SIO_ESCAPE_CHAR, in_idx, window_end)
+        if esc_idx == -1:
+            esc_idx = window_end
+
+        # copy the run of data up to the escape character
+        run_len = esc_idx - in_idx
+        out[out_idx:out_idx + run_len] = buffer(data, in_idx, run_len)
+        out_idx += run_len
+        in_idx = esc_idx
+
+        if in_idx < window_end:
+            # at an escape character, decode it if it starts an escape sequence within the window
+            escaped = None
+            if in_idx + 1 < window_end:
+                escaped = SIO_ESCAPE_MAP.get(data[in_idx + 1])
+            if escaped is None:
+                out[out_idx] = ord(SIO_ESCAPE_CHAR)
+                in_idx += 1
+            else:
+                out[out_idx] = escaped
+                in_idx += 2
+            out_idx += 1
+
+    # fill the bytes removed by escape sequences from the following input
+    tail_len = min(out_len - out_idx, len(data) - in_idx)
+    out[out_idx:out_idx + tail_len] = buffer(data, in_idx, tail_len)
+    out_idx += tail_len
+    in_idx += tail_len
+
+    if out_idx < out_len:
+        del out[out_idx:]
+    return out, in_idx - start
+
+
+class IntervalSet(object):
+    """
+    Sorted set of [start, end) index intervals, where intervals which overlap or touch are combined into one
+    i.e adding [a,b] and [b,c] -> [[a,c]].  Adding and subtracting bisect to the affected intervals.
+    """
+
+    def __init__(self, intervals=None):
+        """
+        :param intervals: Optional list of [start, end] intervals to add
+        """
+        self.starts = []
+        self.ends = []
+        if intervals:
+            for start, end in intervals:
+                self.add(start, end)
+
+    def add(self, start, end):
+        """
+        Add an interval, combining it with any intervals it overlaps or touches
+        :param start: The start index
+        :param end: The end index, not included in the interval
+        """
+        if start >= end:
+            return
+        # the intervals from the first ending at or after start up to the last starting at or before end are combined
+        first = bisect.bisect_left(self.ends, start)
+        last = bisect.bisect_right(self.starts, end)
+        if first < last:
+            start = min(start, self.starts[first])
+            end = max(end, self.ends[last - 1])
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+
+    def subtract(self, start, end):
+        """
+        Remove an interval, splitting any interval it falls within
+        :param start: The start index
+        :param end: The end index, not included in the interval
+        """
+        if start >= end:
+            return
+        # the intervals from the first ending after start up to the last starting before end overlap it
+        first = bisect.bisect_right(self.ends, start)
+        last = bisect.bisect_left(self.starts, end)
+        if first >= last:
+            return
+        # keep any part of the overlapping intervals on either side
+        starts = []
+        ends = []
+        if self.starts[first] < start:
+            starts.append(self.starts[first])
+            ends.append(start)
+        if self.ends[last - 1] > end:
+            starts.append(end)
+            ends.append(self.ends[last - 1])
+        self.starts[first:last] = starts
+        self.ends[first:last] = ends
+
+    def to_list(self):
+        """
+        :return: The intervals as a list of [start, end] lists, as stored in the file state
+        """
+        return [[start, end] for start, end in zip(self.starts, self.ends)]
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __len__(self):
+        return len(self.starts)
+
+
 class StateKey(object):
     UNPROCESSED_DATA = 'unprocessed_data'
     FILE_SIZE = 'file_size'
@@ -69,23 +207,39 @@ class SioState(object):
 
     def __init__(self):
         """
-        Either load the file state from the pickle, or initialize it
+        Open the state store, migrating the old pickle file into it if needed.  File states are loaded
+        from the store as they are requested.
         """
-        try:
-            self.sio_db = pickle.load(open(sio_db_file))
-        except IOError:
-            self.sio_db = SioFileStateInit()
+        self.store = state_store.open_store('sio')
+        state_store.migrate_pickle(self.store, mdd_config.datafile(sio_db_file_name), SioState._migrate)
+        self.sio_db = SioFileStateInit()
+        # file names whose state has been handed out since the last save
+        self.dirty = set()
+
+    @staticmethod
+    def _migrate(old_db, store):
+        """
+        Put each file state from the old pickled database into the store
+        :param old_db: The unpickled SioFileStateInit
+        :param store: The state store to migrate into
+        """
+        for filename, file_state in old_db.file_state.iteritems():
+            store.put('file_state', filename, file_state)
 
     def save(self):
         """
-        Save the sio db using pickle to store the object
+        Write the file states which may have changed to the state store
         """
-        import warnings
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            tempfn = os.tempnam(mdd_config.data_path, 'sio.')
-        pickle.dump(self.sio_db, open(tempfn, 'w'))
-        os.rename(tempfn, sio_db_file)
+        for filename in self.dirty:
+            self.store.put('file_state', filename, self.sio_db.file_state[filename])
+        self.store.commit()
+        self.dirty = set()
+
+    def close(self):
+        """
+        Close the state store, any unsaved changes are lost
+        """
+        self.store.close()
 
     def get_file_state(self, filename):
         """
@@ -93,9 +247,13 @@ class SioState(object):
         :param filename: The file name to return the state for
         :return: The file state dictionary
         """
-        if filename in self.sio_db.file_state:
-            return self.sio_db.file_state.get(filename)
-        return None
+        if filename not in self.sio_db.file_state:
+            file_state = self.store.get('file_state', filename)
+            if file_state is None:
+                return None
+            self.sio_db.file_state[filename] = file_state
+        self.dirty.add(filename)
+        return self.sio_db.file_state.get(filename)
 
     def init_file_state(self, filename):
         """
@@ -106,13 +264,115 @@ class SioState(object):
         self.sio_db.file_state[filename] = {StateKey.UNPROCESSED_DATA: None,
                                             StateKey.FILE_SIZE: 0,
                                             StateKey.OUTPUT_INDEX: 0}
+        self.dirty.add(filename)
         return self.sio_db.file_state.get(filename)
 
+    def set_file_state(self, filename, file_state):
+        """
+        Replace the file state for the specified file name, such as with one updated by a parse worker
+        :param filename: The file name to set the state for
+        :param file_state: The new file state dictionary
+        """
+        self.sio_db.file_state[filename] = file_state
+        self.dirty.add(filename)
+
+
+class OutputFilePool(object):
+    """
+    Least recently used pool of buffered output files opened for appending.  An evicted file is flushed and closed,
+    and appended to again if it is written after that.
+    """
+
+    def __init__(self, max_open=MAX_OPEN_OUTPUT_FILES, buffer_size=OUTPUT_BUFFER_SIZE):
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        # open files in least to most recently used order, key -> file
+        self.files = OrderedDict()
+        # file name -> [number of opens, bytes written]
+        self.stats = {}
+
+    def write(self, key, file_name, data):
+        """
+        Append data to an output file, opening it if it is not already open
+        :param key: The key identifying this output file in the pool
+        :param file_name: The output file name in the data directory
+        :param data: The data to append
+        """
+        fid_out = self.files.pop(key, None)
+        if fid_out is None:
+            if len(self.files) >= self.max_open:
+                # evict the least recently used file
+                self.files.popitem(last=False)[1].close()
+            fid_out = open(mdd_config.datafile(file_name), 'ab', self.buffer_size)
+            self.stats.setdefault(file_name, [0, 0])[0] += 1
+        self.files[key] = fid_out
+        fid_out.write(data)
+        self.stats[file_name][1] += len(data)
+
+    def close(self):
+        """
+        Flush and close all open output files
+        """
+        while self.files:
+            self.files.popitem(last=False)[1].close()
+
+
+def _parse_file_worker(args):
+    """
+    Process pool worker, parse one node file starting from the file state handed to it
+    :param args: (file name, file state, scan window size, profile flag) tuple
+    :return: (file name, updated file state, output stats, profile counters) tuple for the parent to merge
+    """
+    file_name, file_state, window_size, profiled = args
+    profile = PipelineProfile() if profiled else NullProfile()
+    sio_parse = SioParse(open_state=False, window_size=window_size, profile=profile)
+    sio_parse.parse_file_state(file_name, file_state)
+    return file_name, file_state, sio_parse.output_stats, profile.counters()
+
 
 class SioParse(object):
-    def __init__(self):
-        # initialize the object used to store the sio parser state
-        self.sio_db = SioState()
+    def __init__(self, open_state=True, window_size=SIO_SCAN_WINDOW, profile=None):
+        # initialize the object used to store the sio parser state, parse workers are handed their file
+        # state instead so do not open it
+        self.sio_db = None
+        if open_state:
+            self.sio_db = SioState()
+        # output file name -> [number of opens, bytes written] for all files parsed
+        self.output_stats = {}
+        self.window_size = window_size
+        # PipelineProfile to collect stage, node file and instrument timings in, a NullProfile if not profiling
+        self.profile = profile if profile is not None else NullProfile()
+
+    def parse_files(self, file_names, workers=1):
+        """
+        Parse a list of node files.  Node files are independent, so with more than one worker they are parsed in
+        a process pool, and the updated file states are merged back here once all of them have succeeded.
+        :param file_names: The input file names to parse
+        :param workers: The number of worker processes
+        """
+        if workers <= 1 or len(file_names) <= 1:
+            for file_name in file_names:
+                self.parse_file(file_name)
+            return
+
+        jobs = []
+        for file_name in file_names:
+            file_state = self.sio_db.get_file_state(file_name)
+            if file_state is None:
+                file_state = self.sio_db.init_file_state(file_name)
+            jobs.append((file_name, file_state, self.window_size, self.profile.enabled))
+
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        try:
+            results = pool.map(_parse_file_worker, jobs, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+        for file_name, file_state, output_stats, profile_counters in results:
+            self.sio_db.set_file_state(file_name, file_state)
+            self._add_output_stats(output_stats)
+            self.profile.merge(profile_counters)
 
     def parse_file(self, file_name):
         """
@@ -125,6 +385,17 @@ class SioParse(object):
         if file_state is None:
             file_state = self.sio_db.init_file_state(file_name)
 
+        self.parse_file_state(file_name, file_state)
+
+    def parse_file_state(self, file_name, file_state):
+        """
+        Find any complete sio blocks in input file and copy them to their respective output files, updating
+        the file state passed in
+        :param file_name: The input file name to parse
+        :param file_state: The file state dictionary for this file
+        """
+        profile = self.profile
+        parse_start = time.time()
         # insert the file index at the end of the file name before the extension
         file_out_start = file_name[:-4] + '_' + str(file_state[StateKey.OUTPUT_INDEX])
         file_out_end = file_name[-4:]
@@ -133,83 +404,129 @@ class SioParse(object):
         full_path_in = mdd_config.datafile(file_name)
         file_len = os.stat(full_path_in).st_size
 
-        # update the file size and unprocessed data based on the input file length
+        # update the file size and unprocessed data based on the input file length, the unprocessed data is
+        # handled as an interval set while parsing
         if file_state[StateKey.UNPROCESSED_DATA] is None:
-            file_state[StateKey.UNPROCESSED_DATA] = [[0, file_len]]
+            file_state[StateKey.UNPROCESSED_DATA] = IntervalSet([[0, file_len]])
             file_state[StateKey.FILE_SIZE] = file_len
         else:
+            file_state[StateKey.UNPROCESSED_DATA] = IntervalSet(file_state[StateKey.UNPROCESSED_DATA])
             self.update_state_file_length(file_state, file_len)
 
         fid_in = open(full_path_in, 'rb')
+        output_files = OutputFilePool()
 
-        newly_processed_blocks = []
+        found_blocks = False
+        n_blocks = 0
+        n_scanned = 0
         # loop over unprocessed blocks
-        for unproc in file_state[StateKey.UNPROCESSED_DATA]:
-            # read the next unprocessed data block from the file
-            fid_in.seek(unproc[START_IDX])
-            block_len = unproc[END_IDX] - unproc[START_IDX]
-            data_block = fid_in.read(block_len)
+        for unproc in file_state[StateKey.UNPROCESSED_DATA].to_list():
+            n_scanned += unproc[END_IDX] - unproc[START_IDX]
 
-            # loop and find each sio header in this unprocessed block
-            for match in SIO_HEADER_MATCHER.finditer(data_block):
+            # loop over each complete sio block in this unprocessed block
+            for match, match_block, start_file_idx, end_file_idx in \
+                    self._scan_blocks(fid_in, unproc[START_IDX], unproc[END_IDX]):
 
                 # get the file string associated with this instrument ID from the sio header
                 file_type = ID_MAP.get(match.group(SIO_HEADER_GROUP_ID))
 
-                # get length of data packet carried within this sio header
-                data_len = int(match.group(SIO_HEADER_GROUP_DATA_LENGTH), 16)
-                # end index relative to the unprocessed block
-                end_block_idx = match.end(0) + data_len + 1
-                # end index relative to the match
-                end_match_idx = SIO_HEADER_LENGTH - 1 + data_len
-
-                match_block = data_block[match.start(0):end_block_idx]
-                orig_len = len(match_block)
-                # replace escape modem chars
-                match_block = match_block.replace(b'\x18\x6b', b'\x2b')
-                match_block = match_block.replace(b'\x18\x58', b'\x18')
-                # store how many chars were replaced in this block for updating the state
-                n_replaced = orig_len - len(match_block)
-                # need to increase block length if replaced characters to include the rest of the block
-                match_block += data_block[end_block_idx:end_block_idx + n_replaced]
-
-                if end_match_idx < len(match_block) and match_block[end_match_idx] == SIO_BLOCK_END:
-                    # found the matching end of the packet, this block is complete
-
-                    # include controller / instrument number in file name so different instruments are in
-                    # different files
-                    ctrl_id = match.group(SIO_HEADER_GROUP_CTRL_ID)
-                    file_out = file_out_start + '.' + file_type + '_' + ctrl_id + file_out_end
-
-                    # insert the file type into the file name
-                    full_path_out = mdd_config.datafile(file_out)
-
-                    # open the output file in append mode, creating if it doesn't exist
-                    fid_out = open(full_path_out, 'a+')
+                # include controller / instrument number in file name so different instruments are in
+                # different files
+                ctrl_id = match.group(SIO_HEADER_GROUP_CTRL_ID)
+                file_out = file_out_start + '.' + file_type + '_' + ctrl_id + file_out_end
+
+                # write it to the output file, which is opened in append mode if it isn't already open
+                output_key = (file_type, ctrl_id, file_state[StateKey.OUTPUT_INDEX])
+                write_start = time.time()
+                output_files.write(output_key, file_out, match_block)
+                secs = profile.stage('output_write', write_start, len(match_block), 1)
+                profile.add('instruments', match.group(SIO_HEADER_GROUP_ID), secs, len(match_block), 1)
+                n_blocks += 1
+
+                # remove the processed block from the unprocessed file state
+                self.update_processed_file_state(file_state, start_file_idx, end_file_idx)
+                found_blocks = True
+
+        close_start = time.time()
+        output_files.close()
+        profile.stage('output_write', close_start)
+        self._add_output_stats(output_files.stats)
+
+        if found_blocks:
+            # increment output index if we have found new data to parse in this file
+            file_state[StateKey.OUTPUT_INDEX] += 1
 
-                    # write it to output file
-                    fid_out.write(match_block[:end_match_idx + 1])
+        # store the unprocessed data as a plain list
+        file_state[StateKey.UNPROCESSED_DATA] = file_state[StateKey.UNPROCESSED_DATA].to_list()
 
-                    # adjust the start and end indices to be relative to the file rather than the block
-                    start_file_idx = match.start(0) + unproc[START_IDX]
-                    end_file_idx = end_block_idx + n_replaced + unproc[START_IDX]
-                    newly_processed_blocks.append([start_file_idx, end_file_idx])
+        fid_in.close()
 
-                    fid_out.close()
+        profile.add('nodes', file_name, time.time() - parse_start, n_scanned, n_blocks)
 
-        # check for newly processed blocks
-        if newly_processed_blocks:
-            # increment output index if we have found new data to parse in this file
-            file_state[StateKey.OUTPUT_INDEX] += 1
+    def _scan_blocks(self, fid_in, range_start, range_end):
+        """
+        Find the complete sio blocks in a range of the input file, reading it in windows of window_size bytes so
+        memory use does not depend on the size of the range.  A block which is not complete at the end of a window
+        is carried into the next one, along with the tail of the window where a header may be cut off.
+        :param fid_in: The input file
+        :param range_start: The file index to start at
+        :param range_end: The file index to stop at
+        :return: generator of (header match, unescaped block, file start index, file end index) tuples, the match
+                 is relative to the current window
+        """
+        profile = self.profile
+        fid_in.seek(range_start)
+        # file index of the start of the window
+        window_start = range_start
+        read_idx = range_start
+        data_block = b''
+        while True:
+            # read the next chunk onto the end of the carried data
+            read_start = time.time()
+            chunk = fid_in.read(min(self.window_size, range_end - read_idx))
+            profile.stage('sio_read', read_start, len(chunk))
+            read_idx += len(chunk)
+            data_block += chunk
+            at_end = read_idx >= range_end or not chunk
+
+            # index in the window to carry on from
+            carry_idx = None
+            last_match_idx = -1
+            # loop and find each sio header in this window
+            matches = profile.timed_iter('header_match', SIO_HEADER_MATCHER.finditer(data_block), 1)
+            for match in matches:
 
-            # pre combine blocks so there aren't so many to loop over
-            newly_processed_blocks = SioParse._combine_adjacent_packets(newly_processed_blocks)
+                # get length of data packet carried within this sio header
+                data_len = int(match.group(SIO_HEADER_GROUP_DATA_LENGTH), 16)
+                # length of the sio header, data and end sentinel
+                match_len = SIO_HEADER_LENGTH + data_len
+
+                # replace escape modem chars, consuming extra input for each replaced escape sequence
+                unescape_start = time.time()
+                match_block, n_consumed = unescape_block(data_block, match.start(0), match_len)
+                secs = profile.stage('unescape', unescape_start, n_consumed)
+                profile.add('instruments', match.group(SIO_HEADER_GROUP_ID), secs, calls=0)
+
+                if len(match_block) < match_len and not at_end:
+                    # the block runs past the end of this window, come back to it in the next one
+                    carry_idx = match.start(0)
+                    break
+                last_match_idx = match.start(0)
+
+                if len(match_block) == match_len and match_block[-1] == ord(SIO_BLOCK_END):
+                    # found the matching end of the packet, this block is complete
+                    # adjust the start and end indices to be relative to the file rather than the window
+                    start_file_idx = match.start(0) + window_start
+                    yield match, match_block, start_file_idx, start_file_idx + n_consumed
 
-            # remove the processed blocks from the unprocessed file state
-            for new_block in newly_processed_blocks:
-                self.update_processed_file_state(file_state, new_block[START_IDX], new_block[END_IDX])
+            if at_end:
+                break
 
-        fid_in.close()
+            if carry_idx is None:
+                # keep enough of the end of the window to find a header cut off by it
+                carry_idx = max(len(data_block) - SIO_HEADER_LENGTH + 1, last_match_idx + 1, 0)
+            data_block = data_block[carry_idx:]
+            window_start += carry_idx
 
     def save(self):
         """
@@ -217,85 +534,43 @@ class SioParse(object):
         """
         self.sio_db.save()
 
+    def close(self):
+        """
+        Close the sio database
+        """
+        self.sio_db.close()
+
+    def _add_output_stats(self, output_stats):
+        """
+        Add output file open and byte counts into the totals for this parser
+        :param output_stats: Dictionary of output file name -> [number of opens, bytes written]
+        """
+        for file_out, (n_opens, n_bytes) in output_stats.iteritems():
+            file_stats = self.output_stats.setdefault(file_out, [0, 0])
+            file_stats[0] += n_opens
+            file_stats[1] += n_bytes
+
     def update_state_file_length(self, file_state, file_len):
         """
-        Update the file state based on any changes in the file length, appending or
-         changing the last unprocessed data indices to include any appended file data.
-        :param file_state: Current file state
+        Update the file state based on any changes in the file length, adding any appended file data
+        to the unprocessed data.
+        :param file_state: Current file state, with the unprocessed data as an IntervalSet
         :param file_len: Length of file
         """
         last_size = file_state[StateKey.FILE_SIZE]
-        # check if the file length has changed
-        if last_size != file_len:
-            if file_state[StateKey.UNPROCESSED_DATA] == [] and last_size < file_len:
-                # we have processed up to the last file size, append a new block that
-                # goes from the last file size to the new file size
-                file_state[StateKey.UNPROCESSED_DATA].append([last_size, file_len])
-                file_state[StateKey.FILE_SIZE] = file_len
-
-            elif file_state[StateKey.UNPROCESSED_DATA] != [] and \
-                    file_state[StateKey.UNPROCESSED_DATA][-1][END_IDX] < file_len:
-
-                if last_size > file_state[StateKey.UNPROCESSED_DATA][-1][END_IDX]:
-                    # the previous file size is greater than the last unprocessed index so
-                    # we have processed up to the last file size, append a new block
-                    # that goes from the last file size to the new file size
-                    file_state[StateKey.UNPROCESSED_DATA].append([last_size, file_len])
-                    file_state[StateKey.FILE_SIZE] = file_len
-
-                elif last_size == file_state[StateKey.UNPROCESSED_DATA][-1][END_IDX]:
-                    # if the last unprocessed is the last file size, just increase the last index
-                    file_state[StateKey.UNPROCESSED_DATA][-1][1] = file_len
-                    file_state[StateKey.FILE_SIZE] = file_len
+        if file_len > last_size:
+            # data from the last file size to the new file size is unprocessed, this combines
+            # with any unprocessed data that ran up to the last file size
+            file_state[StateKey.UNPROCESSED_DATA].add(last_size, file_len)
+            file_state[StateKey.FILE_SIZE] = file_len
 
     def update_processed_file_state(self, file_state, start_idx, end_idx):
         """
         Update the file state dictionary after the block starting at start idx
         and ending at end idx has been processed
-        :param file_state: current file state
+        :param file_state: current file state, with the unprocessed data as an IntervalSet
         :param start_idx: start of processed block
         :param end_idx: end of processed block
         """
-        for unproc in file_state[StateKey.UNPROCESSED_DATA]:
-
-            if start_idx >= unproc[START_IDX] and end_idx <= unproc[END_IDX]:
-                # packet is within this unprocessed data, remove it
-                file_state[StateKey.UNPROCESSED_DATA].remove(unproc)
-
-                # add back any data still unprocessed on either side
-                if start_idx > unproc[START_IDX]:
-                    file_state[StateKey.UNPROCESSED_DATA].append([unproc[START_IDX], start_idx])
-                if end_idx < unproc[END_IDX]:
-                    file_state[StateKey.UNPROCESSED_DATA].append([end_idx, unproc[END_IDX]])
-
-                # once we have found which unprocessed section this packet is in,
-                # move on to next packet
-                break
-
-        file_state[StateKey.UNPROCESSED_DATA] = sorted(file_state[StateKey.UNPROCESSED_DATA])
-        file_state[StateKey.UNPROCESSED_DATA] = SioParse._combine_adjacent_packets(
-            file_state[StateKey.UNPROCESSED_DATA])
-
-    @staticmethod
-    def _combine_adjacent_packets(packets):
-        """
-        Combine packets which are adjacent and have the same start/end into one packet
-        i.e [[a,b], [b,c]] -> [[a,c]]
-        :param packets An array of packets, with the form [[start, end], [next_start, next_end], ...]
-        :retval A new array of packets where adjacent packets will have their indices combined into one
-        """
-        combined_packets = []
-        idx = 0
-        while idx < len(packets):
-            start_idx = packets[idx][START_IDX]
-            # loop until the end of this packet doesn't equal the start of the following packet
-            next_inc = 0
-            while idx + next_inc + 1 < len(packets) and \
-                    packets[idx + next_inc][END_IDX] == packets[idx + next_inc + 1][START_IDX]:
-                next_inc += 1
-
-            end_idx = packets[idx + next_inc][END_IDX]
-            # append the new combined packet indices
-            combined_packets.append([start_idx, end_idx])
-            idx = idx + next_inc + 1
-        return combined_packets
+        # remove the packet from the unprocessed data, leaving any data still unprocessed on either side
+        file_state[StateKey.UNPROCESSED_DATA].subtract(start_idx, end_idx)
@@ -0,0 +1,242 @@
+"""
+Incremental stores for the mdd and sio parser state.  State is kept as pickled values in named tables, and only
+the keys that were put since the last commit are written.
+"""
+__license__ = 'Apache 2.0'
+
+import ast
+import cPickle as pickle
+import cStringIO
+import os
+import sqlite3
+
+import mdd_config
+
+
+class StateStore(object):
+    """
+    Base class for a state store, values put are staged until commit writes them
+    """
+    def __init__(self):
+        self.pending = {}
+
+    def get(self, table, key):
+        """
+        Get a value from the store, including any staged value
+        :param table: The table name
+        :param key: The key within the table, a string, number or tuple of them
+        :return: The stored value, or None if the key is not stored
+        """
+        if (table, key) in self.pending:
+            return self.pending[(table, key)]
+        return self._get(table, key)
+
+    def items(self, table):
+        """
+        Get all the key, value pairs in a table, including any staged values
+        :param table: The table name
+        :return: dictionary of the table contents
+        """
+        result = self._items(table)
+        for (pending_table, key), value in self.pending.iteritems():
+            if pending_table == table:
+                result[key] = value
+        return result
+
+    def put(self, table, key, value):
+        """
+        Stage a value to be written on the next commit
+        :param table: The table name
+        :param key: The key within the table, a string, number or tuple of them
+        :param value: The value to store, which must be picklable
+        """
+        self.pending[(table, key)] = value
+
+    def empty(self):
+        """
+        :return: True if nothing has been stored
+        """
+        raise NotImplementedError
+
+    def commit(self):
+        """
+        Write all staged values
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Release the store, any staged values are discarded
+        """
+        raise NotImplementedError
+
+    def _get(self, table, key):
+        raise NotImplementedError
+
+    def _items(self, table):
+        raise NotImplementedError
+
+
+class SqliteStore(StateStore):
+    """
+    State store in a sqlite database using write ahead logging, each commit is one transaction
+    """
+    def __init__(self, path):
+        super(SqliteStore, self).__init__()
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS state '
+                          '(tbl TEXT NOT NULL, key TEXT NOT NULL, value BLOB, PRIMARY KEY (tbl, key))')
+        self.conn.commit()
+
+    def empty(self):
+        return self.conn.execute('SELECT 1 FROM state LIMIT 1').fetchone() is None and not self.pending
+
+    def commit(self):
+        if self.pending:
+            rows = [(table, repr(key), sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+                    for (table, key), value in self.pending.iteritems()]
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO state (tbl, key, value) VALUES (?, ?, ?)', rows)
+            self.pending = {}
+
+    def close(self):
+        self.pending = {}
+        self.conn.close()
+
+    def _get(self, table, key):
+        row = self.conn.execute('SELECT value FROM state WHERE tbl = ? AND key = ?', (table, repr(key))).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(str(row[0]))
+
+    def _items(self, table):
+        rows = self.conn.execute('SELECT key, value FROM state WHERE tbl = ?', (table,))
+        return dict((ast.literal_eval(key), pickle.loads(str(value))) for key, value in rows)
+
+
+class JournalStore(StateStore):
+    """
+    State store in an append only journal of pickled records.  The journal is replayed into memory on open and
+    compacted to one record per key once superseded records outnumber live ones by compact_ratio.  A partly
+    written final record, from an interrupted commit, is cut off on open so later commits follow the last whole
+    record.
+    """
+    def __init__(self, path, compact_ratio=4):
+        super(JournalStore, self).__init__()
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.values = {}
+        self.n_records = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as fid:
+                journal = fid.read()
+            records = cStringIO.StringIO(journal)
+            # end of the last whole record
+            end = 0
+            while end < len(journal):
+                try:
+                    table, key, value = pickle.load(records)
+                except Exception:
+                    # a partly written final record from an interrupted commit, which may fail to unpickle in
+                    # any number of ways depending on where it was cut
+                    break
+                self.values[(table, key)] = value
+                self.n_records += 1
+                end = records.tell()
+            if end < len(journal):
+                with open(path, 'r+b') as fid:
+                    fid.truncate(end)
+        self.fid = open(path, 'ab')
+
+    def empty(self):
+        return not self.values and not self.pending
+
+    def commit(self):
+        if self.pending:
+            for (table, key), value in self.pending.iteritems():
+                pickle.dump((table, key, value), self.fid, pickle.HIGHEST_PROTOCOL)
+                self.values[(table, key)] = value
+                self.n_records += 1
+            self.fid.flush()
+            os.fsync(self.fid.fileno())
+            self.pending = {}
+            if self.n_records > self.compact_ratio * len(self.values):
+                self.compact()
+
+    def compact(self):
+        """
+        Rewrite the journal with only the latest record for each key
+        """
+        tempfn = self.path + '.compact'
+        with open(tempfn, 'wb') as fid:
+            for (table, key), value in self.values.iteritems():
+                pickle.dump((table, key, value), fid, pickle.HIGHEST_PROTOCOL)
+            fid.flush()
+            os.fsync(fid.fileno())
+        self.fid.close()
+        os.rename(tempfn, self.path)
+        self.fid = open(self.path, 'ab')
+        self.n_records = len(self.values)
+
+    def close(self):
+        self.pending = {}
+        self.fid.close()
+
+    def _get(self, table, key):
+        return self.values.get((table, key))
+
+    def _items(self, table):
+        return dict((key, value) for (value_table, key), value in self.values.iteritems() if value_table == table)
+
+
+# map of backend name to store class and file extension
+STORE_BACKENDS = {
+    'sqlite': (SqliteStore, '.db'),
+    'journal': (JournalStore, '.journal')}
+
+
+def store_path(name, backend=None):
+    """
+    Get the path of a named store in the data directory
+    :param name: The store name, such as 'mdd' or 'sio'
+    :param backend: The backend name, defaults to mdd_config.state_backend
+    :return: The store file path
+    """
+    if backend is None:
+        backend = mdd_config.state_backend
+    if backend not in STORE_BACKENDS:
+        raise ValueError('Unknown state backend %s' % backend)
+    return mdd_config.datafile(name + STORE_BACKENDS[backend][1])
+
+
+def open_store(name, backend=None):
+    """
+    Open a named store in the data directory
+    :param name: The store name, such as 'mdd' or 'sio'
+    :param backend: The backend name, defaults to mdd_config.state_backend
+    :return: The opened StateStore
+    """
+    if backend is None:
+        backend = mdd_config.state_backend
+    path = store_path(name, backend)
+    return STORE_BACKENDS[backend][0](path)
+
+
+def migrate_pickle(store, pickle_file, convert):
+    """
+    One time migration of a pickle state file into an empty store.  The pickle file is renamed with a .migrated
+    extension once its contents are committed, so it is not migrated again.
+    :param store: The StateStore to migrate into
+    :param pickle_file: The pickle state file
+    :param convert: Function taking the unpickled object and the store, which puts its contents into the store
+    :return: True if the pickle file was migrated
+    """
+    if not os.path.exists(pickle_file) or not store.empty():
+        return False
+    with open(pickle_file, 'rb') as fid:
+        old_db = pickle.load(fid)
+    convert(old_db, store)
+    store.commit()
+    os.rename(pickle_file, pickle_file + '.migrated')
+    return True
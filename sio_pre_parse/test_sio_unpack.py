@@ -8,13 +8,25 @@ __license__ = 'Apache 2.0'
 
 import unittest
 import os
+import benchmark
 import mdd
+import mdd_data
+import mkmdr
+import mdd_synth
+import mdp_config
+import json
 import pickle
 import glob
+import random
+import shutil
+import state_store
+import tempfile
 import time
 
+from pipeline_profile import PipelineProfile
 from sio_unpack import SIO_HEADER_MATCHER, SIO_HEADER_GROUP_DATA_LENGTH, \
-    SIO_HEADER_GROUP_ID, SIO_BLOCK_END, StateKey
+    SIO_HEADER_GROUP_ID, SIO_BLOCK_END, SIO_HEADER_LENGTH, StateKey, SioState, SioFileStateInit, SioParse, \
+    OutputFilePool, IntervalSet, unescape_block
 
 
 INPUT_HYPM_PATH = 'gp02hypm_mdd'  # deployment 1 .mdd files
@@ -31,10 +43,14 @@ class TestSioUnpack(unittest.TestCase):
         if not os.path.exists(OUTPUT_PATH):
             os.mkdir(OUTPUT_PATH)
 
+        # drop the in memory mdd database so it is reopened from the cleared state
+        mdd_data.mdd_data.close()
+
         # remove all generated files
-        pckl_files = glob.glob(OUTPUT_PATH + '/*.pckl')
-        for pckl_file in pckl_files:
-            os.remove(pckl_file)
+        state_files = glob.glob(OUTPUT_PATH + '/mdd.*')
+        state_files.extend(glob.glob(OUTPUT_PATH + '/sio.*'))
+        for state_file in state_files:
+            os.remove(state_file)
 
         node_files = glob.glob(OUTPUT_PATH + '/node*.dat')
         for node_file in node_files:
@@ -502,6 +518,715 @@ class TestSioUnpack(unittest.TestCase):
         if not self.check_for_tags(data):
             self.fail("Found header tag in data file")
 
+    def test_mmap_sections(self):
+        """
+        Test that the memory mapped sections match those read into memory
+        """
+        test_files = glob.glob(INPUT_HYPM_PATH + '/*.mdd')
+        test_files.extend(glob.glob(INPUT_GI_PATH + '/*.mdd'))
+
+        for test_file in test_files:
+            read_mdd = mdd.mdd(test_file)
+            mmap_mdd = mdd.mdd(test_file, use_mmap=True)
+            mmap_sections = [(s.node, s.port, s.start, s.end, str(s.data)) for s in mmap_mdd.iter_sections()]
+            mmap_mdd.close()
+            read_sections = [(s.node, s.port, s.start, s.end, s.data) for s in read_mdd.sections]
+
+            if mmap_sections != read_sections:
+                self.fail("Memory mapped sections do not match for %s" % test_file)
+
+    def test_scan_tags(self):
+        """
+        Test that the single pass tag scanner finds the same sections as the original find based parser
+        """
+        test_files = glob.glob(INPUT_HYPM_PATH + '/*.mdd')
+        test_files.extend(glob.glob(INPUT_FLMB_PATH + '/*.mdd'))
+        test_files.extend(glob.glob(INPUT_GI_PATH + '/*.mdd'))
+
+        for test_file in test_files:
+            d = mdd.mdd(test_file)
+            found_sections = [(s.node, s.port, s.start, s.end, s.data) for s in d.iter_sections_find()]
+            scanned_sections = [(s.node, s.port, s.start, s.end, s.data) for s in d.sections]
+
+            if scanned_sections != found_sections:
+                self.fail("Scanned sections do not match for %s" % test_file)
+
+        # the payload follows the line after the last tag, a file ending on a tag line without its newline has none
+        self.assertEqual(list(mdd.scan_tags('NODE:1\nPORT:1\nSTARTOFFSET:0\nENDOFFSET:3\nabcd')),
+                         [(1, 1, 0, 3, 40, 44)])
+        self.assertEqual(list(mdd.scan_tags('NODE:1\nPORT:1\nSTARTOFFSET:0\nENDOFFSET:3')), [])
+
+    def test_section_index(self):
+        """
+        Test that inserting into the section index merges sections the same as sorting and merging the full list
+        """
+        rand = random.Random(1234)
+        for _ in xrange(50):
+            sects = []
+            index = {}
+            for _ in xrange(rand.randint(1, 60)):
+                start = rand.randint(0, 2000)
+                end = start + rand.randint(0, 200)
+                sect = mdd_data.data_section(rand.randint(1, 2), rand.randint(1, 2), start, end, None)
+                sect.time = rand.randint(0, 1000)
+                sects.append(mdd_data.data_section(sect.node, sect.port, start, end, None))
+                sects[-1].time = sect.time
+                index.setdefault((sect.node, sect.port), mdd_data.section_index()).insert(sect)
+
+            # the original sort and merge of the whole section list
+            sects.sort(key=lambda a: (a.node, a.port, a.start))
+            n = 0
+            while n < len(sects) - 1:
+                curr = sects[n]
+                while n < len(sects) - 1:
+                    next_sect = sects[n + 1]
+                    if curr.node != next_sect.node or curr.port != next_sect.port:
+                        break
+                    elif curr.end < next_sect.start - 1:
+                        break
+                    curr.end = max(curr.end, next_sect.end)
+                    curr.time = max(curr.time, next_sect.time)
+                    del sects[n + 1]
+                n += 1
+
+            expected = [(s.node, s.port, s.start, s.end, s.time) for s in sects]
+            indexed = [(s.node, s.port, s.start, s.end, s.time)
+                       for key in sorted(index.keys()) for s in index[key]]
+            self.assertEqual(indexed, expected)
+
+    def test_interval_set(self):
+        """
+        Test that the interval set unprocessed data matches the original list updates for randomly growing files
+        and randomly processed blocks
+        """
+        rand = random.Random(4321)
+        sio_parse = SioParse(open_state=False)
+        for _ in xrange(200):
+            file_len = rand.randint(0, 500)
+            list_state = {StateKey.UNPROCESSED_DATA: [[0, file_len]], StateKey.FILE_SIZE: file_len}
+            set_state = {StateKey.UNPROCESSED_DATA: IntervalSet([[0, file_len]]), StateKey.FILE_SIZE: file_len}
+
+            for _ in xrange(rand.randint(1, 20)):
+                if rand.random() < 0.3:
+                    file_len += rand.randint(0, 300)
+                    update_list_file_length(list_state, file_len)
+                    sio_parse.update_state_file_length(set_state, file_len)
+                elif list_state[StateKey.UNPROCESSED_DATA]:
+                    # process a block within one of the unprocessed blocks
+                    unproc_start, unproc_end = rand.choice(list_state[StateKey.UNPROCESSED_DATA])
+                    start_idx = rand.randint(unproc_start, unproc_end)
+                    end_idx = rand.randint(start_idx, unproc_end)
+                    update_list_processed(list_state, start_idx, end_idx)
+                    sio_parse.update_processed_file_state(set_state, start_idx, end_idx)
+
+                self.assertEqual(set_state[StateKey.UNPROCESSED_DATA].to_list(),
+                                 [unproc for unproc in list_state[StateKey.UNPROCESSED_DATA]
+                                  if unproc[0] < unproc[1]])
+                self.assertEqual(set_state[StateKey.FILE_SIZE], list_state[StateKey.FILE_SIZE])
+
+        # adding joins overlapping and touching intervals, subtracting splits them
+        intervals = IntervalSet([[10, 20], [30, 40], [20, 25]])
+        self.assertEqual(intervals.to_list(), [[10, 25], [30, 40]])
+        intervals.add(24, 31)
+        self.assertEqual(intervals.to_list(), [[10, 40]])
+        intervals.subtract(15, 35)
+        self.assertEqual(intervals.to_list(), [[10, 15], [35, 40]])
+        intervals.subtract(0, 100)
+        self.assertEqual(len(intervals), 0)
+
+    def test_gap_index(self):
+        """
+        Test that the gap index gives the same missing ranges as walking the full sorted section list
+        """
+        rand = random.Random(2468)
+        for _ in xrange(50):
+            index = {}
+            for _ in xrange(rand.randint(0, 40)):
+                start = rand.randint(0, 3000)
+                sect = mdd_data.data_section(rand.randint(1, 2), rand.randint(1, 2), start,
+                                             start + rand.randint(1, 100), None)
+                sect.time = 0
+                index.setdefault((sect.node, sect.port), mdd_data.section_index()).insert(sect)
+            sects = [sect for key in sorted(index.keys()) for sect in index[key]]
+            gaps = mkmdr.gap_index(index)
+
+            for node in (1, 2, 3):
+                for port in (1, 2):
+                    minval = rand.choice([0, rand.randint(0, 3200)])
+                    maxval = rand.choice([mkmdr.final, rand.randint(0, 3200)])
+
+                    # the original walk of the section list
+                    expected = []
+                    posn = minval
+                    for sect in sects:
+                        if sect.node != node or sect.port != port:
+                            continue
+                        if sect.start > posn:
+                            expected.append((posn, sect.start))
+                        posn = max(minval, sect.end + 1)
+                    expected.append((posn, maxval))
+
+                    self.assertEqual(gaps.missing(node, port, minval, maxval), expected)
+
+    def test_sys_config(self):
+        """
+        Test that the parsed config is cached until the file changes, and the node and glider lookups
+        """
+        config_xml = """<modemConfig>
+          <deployment>
+            <gliderList><glider>ru01</glider><glider>ru02</glider></gliderList>
+            <nodeList>
+              <node><nodeID>14</nodeID><coordinates>40.1,-70.2,500</coordinates><name>hypm</name>
+                <rate>1000</rate></node>
+              <node><nodeID>16</nodeID><coordinates>40.3,-70.4,90</coordinates><name>flmb</name>
+                <rate>500</rate></node>
+            </nodeList>
+          </deployment>
+          <deployment>
+            <gliderList><glider>ru03</glider></gliderList>
+            <nodeList>
+              <node><nodeID>58</nodeID><coordinates>59.9,-39.5,2600</coordinates><name>gi</name>
+                <rate>2000</rate></node>
+            </nodeList>
+          </deployment>
+        </modemConfig>"""
+        config_fn = os.path.join(OUTPUT_PATH, 'test_ooi.xml')
+        with open(config_fn, 'w') as fid:
+            fid.write(config_xml)
+        old_config_fn = mdp_config.xml_config_fn
+        mdp_config.xml_config_fn = config_fn
+        try:
+            deployments = mdp_config.getSysConfig()
+            self.assertEqual([gliders for gliders, _ in deployments], [['ru01', 'ru02'], ['ru03']])
+            self.assertTrue(mdp_config.getSysConfig() is deployments)
+
+            node = mdp_config.getNode(14)
+            self.assertEqual((node.id, node.lat, node.lon, node.depth, node.name, node.rate),
+                             (14, 40.1, -70.2, 500.0, 'hypm', 1000.0))
+            self.assertFalse(hasattr(node, '__dict__'))
+            self.assertEqual(mdp_config.getNode(99), None)
+            self.assertEqual([node.id for node in mdp_config.getDeployment('ru02')[1]], [14, 16])
+            self.assertEqual(mdp_config.getNodeGliders(58), ['ru03'])
+            self.assertEqual(mdp_config.getGliders(), ['ru01', 'ru02', 'ru03'])
+
+            # a changed file is read again
+            with open(config_fn, 'w') as fid:
+                fid.write(config_xml.replace('ru03', 'ru04'))
+            os.utime(config_fn, (time.time() + 10, time.time() + 10))
+            self.assertEqual(mdp_config.getGliders(), ['ru01', 'ru02', 'ru04'])
+        finally:
+            mdp_config.xml_config_fn = old_config_fn
+            os.remove(config_fn)
+
+    def test_state_migration(self):
+        """
+        Test that an old sio pickle file is migrated into the state store and then continued from
+        """
+        old_db = SioFileStateInit()
+        old_db.file_state['node58p1.dat'] = {StateKey.UNPROCESSED_DATA: [[4059, 4060]],
+                                             StateKey.FILE_SIZE: 4060,
+                                             StateKey.OUTPUT_INDEX: 1}
+        pkl_fid = open(OUTPUT_PATH + '/sio.pckl', 'w')
+        pickle.dump(old_db, pkl_fid)
+        pkl_fid.close()
+
+        file_state = self.get_file_state('node58p1.dat')
+        if file_state != old_db.file_state['node58p1.dat']:
+            print "file state: '%s'" % file_state
+            self.fail("Migrated file state does not match")
+
+        if os.path.exists(OUTPUT_PATH + '/sio.pckl'):
+            self.fail("Pickle file was not marked as migrated")
+
+        # blocks [0 3583] [3840 4058]
+        test_file1 = os.path.join(INPUT_HYPM_PATH, 'unit_364-2013-206-2-0.mdd')
+        # blocks [0 1279] [1536 1791] [2048 2303] [2560 2815] [3072 4059]
+        test_file2 = os.path.join(INPUT_HYPM_PATH, 'unit_364-2013-206-3-0.mdd')
+        # blocks [0 2047] [2304 4095] [4096 7451]
+        test_file3 = os.path.join(INPUT_HYPM_PATH, 'unit_364-2013-206-6-0.mdd')
+
+        mdd.procall([test_file1, test_file2, test_file3])
+
+        file_state = self.get_file_state('node58p1.dat')
+        expected_file_state = {StateKey.UNPROCESSED_DATA: [[4059, 4060]],
+                               StateKey.FILE_SIZE: 7452,
+                               StateKey.OUTPUT_INDEX: 2}
+
+        if file_state != expected_file_state:
+            print "file state: '%s'" % file_state
+            self.fail("Expected file state after migration does not match")
+
+    def test_journal_store(self):
+        """
+        Test that the journal store keeps committed values across reopening, and discards staged values on close
+        """
+        journal_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(journal_dir, 'test.journal')
+            store = state_store.JournalStore(path)
+            self.assertTrue(store.empty())
+            store.put('index', (58, 1), [1, 2])
+            store.put('meta', 'stats', {'a': 1})
+            self.assertFalse(store.empty())
+            self.assertEqual(store.get('index', (58, 1)), [1, 2])
+            store.commit()
+            store.put('index', (58, 1), [3])
+            store.put('index', (59, 1), [4])
+            self.assertEqual(store.items('index'), {(58, 1): [3], (59, 1): [4]})
+            store.close()
+
+            store = state_store.JournalStore(path)
+            self.assertEqual(store.items('index'), {(58, 1): [1, 2]})
+            self.assertEqual(store.get('meta', 'stats'), {'a': 1})
+            self.assertIsNone(store.get('index', (59, 1)))
+            store.close()
+        finally:
+            shutil.rmtree(journal_dir)
+
+    def test_journal_compact(self):
+        """
+        Test that the journal is compacted to one record per key once superseded records build up
+        """
+        journal_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(journal_dir, 'test.journal')
+            store = state_store.JournalStore(path, compact_ratio=2)
+            for i in range(20):
+                store.put('meta', 'count', i)
+                store.put('meta', 'constant', 'x')
+                store.commit()
+                self.assertTrue(store.n_records <= 2 * 2 + 2)
+            store.close()
+            self.assertFalse(os.path.exists(path + '.compact'))
+
+            store = state_store.JournalStore(path, compact_ratio=2)
+            self.assertEqual(store.items('meta'), {'count': 19, 'constant': 'x'})
+            self.assertTrue(store.n_records <= 2 * 2 + 2)
+            store.close()
+        finally:
+            shutil.rmtree(journal_dir)
+
+    def test_journal_torn_tail(self):
+        """
+        Test that a journal whose final record was cut short at any point opens with the earlier records, and that
+        records committed after reopening it are kept
+        """
+        journal_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(journal_dir, 'test.journal')
+            store = state_store.JournalStore(path)
+            store.put('meta', 'first', 1)
+            store.commit()
+            good_size = os.path.getsize(path)
+            index = mdd_data.section_index()
+            index.insert(mdd_data.data_section(58, 1, 0, 100, None))
+            index.sections[0].time = 5
+            store.put('index', (58, 1), index)
+            store.commit()
+            store.close()
+            with open(path, 'rb') as fid:
+                journal = fid.read()
+
+            for cut in xrange(good_size, len(journal)):
+                with open(path, 'wb') as fid:
+                    fid.write(journal[:cut])
+                store = state_store.JournalStore(path)
+                self.assertEqual(store.items('meta'), {'first': 1}, 'cut at %d' % cut)
+                self.assertIsNone(store.get('index', (58, 1)))
+                store.put('meta', 'second', 2)
+                store.commit()
+                store.close()
+
+                store = state_store.JournalStore(path)
+                self.assertEqual(store.items('meta'), {'first': 1, 'second': 2}, 'cut at %d' % cut)
+                store.close()
+        finally:
+            shutil.rmtree(journal_dir)
+
+    def test_mdd_migration(self):
+        """
+        Test that an old mdd pickle file, with a flat list of sections, is migrated into section indexes in the
+        state store
+        """
+        old_db = mdd_data.mdddb()
+        del old_db.index
+        old_db.stats.accumulate('unit_364', 58, 'sections', 3)
+        old_db.offsets = {'unit_364-2013-206-2-0.mdd': 4059}
+        old_db.sects = []
+        for node, start, end in ((58, 200, 299), (58, 0, 99), (58, 100, 150), (59, 0, 10)):
+            sect = mdd_data.data_section(node, 1, start, end, 'data')
+            sect.time = start
+            old_db.sects.append(sect)
+        with open(OUTPUT_PATH + '/mdd.pckl', 'wb') as fid:
+            pickle.dump(old_db, fid)
+
+        db = mdd_data.mdd_data()
+        self.assertFalse(os.path.exists(OUTPUT_PATH + '/mdd.pckl'))
+        self.assertTrue(os.path.exists(OUTPUT_PATH + '/mdd.pckl.migrated'))
+        self.assertEqual(db.offsets(), {'unit_364-2013-206-2-0.mdd': 4059})
+        self.assertEqual(db.stats().get('unit_364', 58, 'sections'), 3)
+        self.assertEqual([(sect.node, sect.start, sect.end, sect.data) for sect in db.sects()],
+                         [(58, 0, 150, None), (58, 200, 299, None), (59, 0, 10, None)])
+
+        # the migrated state is read back from the store once reopened
+        mdd_data.mdd_data.close()
+        db = mdd_data.mdd_data()
+        self.assertEqual([(sect.node, sect.start, sect.end) for sect in db.sects()],
+                         [(58, 0, 150), (58, 200, 299), (59, 0, 10)])
+
+    def test_output_file_pool(self):
+        """
+        Test that evicted output files are reopened and appended to, and that opens and bytes are counted
+        """
+        pool = OutputFilePool(max_open=2)
+        for idx in xrange(3):
+            for file_idx in xrange(3):
+                pool.write(file_idx, 'node_pool_%d.dat' % file_idx, 'block %d %d;' % (file_idx, idx))
+        pool.close()
+
+        for file_idx in xrange(3):
+            file_name = 'node_pool_%d.dat' % file_idx
+            expected = ''.join(['block %d %d;' % (file_idx, idx) for idx in xrange(3)])
+            self.assertEqual(self.read_full_file(file_name), expected)
+            # each write came after the other two files, so the file was evicted and reopened every time
+            self.assertEqual(pool.stats[file_name], [3, len(expected)])
+
+        # parsing a node file opens each of its instrument group files once
+        test_file = os.path.join(INPUT_HYPM_PATH, 'unit_364-2013-206-2-0.mdd')
+        mdd.procall([test_file])
+
+        # clear the sio state and output so the node file is parsed again from the start
+        for old_file in glob.glob(OUTPUT_PATH + '/sio.*') + glob.glob(OUTPUT_PATH + '/node58p1_*'):
+            os.remove(old_file)
+        sio_parse = SioParse()
+        sio_parse.parse_file('node58p1.dat')
+        sio_parse.close()
+
+        self.assertTrue(sio_parse.output_stats)
+        for file_out, (n_opens, n_bytes) in sio_parse.output_stats.iteritems():
+            self.assertEqual(n_opens, 1)
+            self.assertEqual(n_bytes, len(self.read_full_file(file_out)))
+
+    def test_node_file_writer(self):
+        """
+        Test that the node file writer batches adjacent sections, leaves gaps sparse and keeps the write order
+        """
+        writer = mdd.NodeFileWriter()
+        writer.write('node999p1.dat', 0, 'abc')
+        # adjacent, batched with the previous section
+        writer.write('node999p1.dat', 3, buffer('xdefx', 1, 3))
+        # past the end of file
+        writer.write('node999p1.dat', 100, 'xyz')
+        # overwrites earlier data
+        writer.write('node999p1.dat', 1, 'Q')
+        writer.close()
+
+        self.assertEqual(self.read_full_file('node999p1.dat'), 'aQcdef' + '\0' * 94 + 'xyz')
+        self.assertEqual(writer.stats, {'sections': 4, 'opens': 1, 'writes': 3, 'extends': 1, 'bytes': 10,
+                                        'zero_bytes': 94})
+        self.assertEqual(writer.syscalls_saved(), 7)
+
+    def test_unescape_block(self):
+        """
+        Test that single pass unescaping gives the same blocks and processed lengths as replacing the escape
+        sequences in the block and then extending it
+        """
+        test_files = glob.glob(INPUT_HYPM_PATH + '/*.mdd')
+        test_files.extend(glob.glob(INPUT_FLMB_PATH + '/*.mdd'))
+        test_files.extend(glob.glob(INPUT_GI_PATH + '/*.mdd'))
+        mdd.procall(test_files)
+
+        n_escaped = 0
+        for node_file in ['node14p1.dat', 'node16p1.dat', 'node17p1.dat', 'node58p1.dat', 'node59p1.dat',
+                          'node60p1.dat']:
+            data = self.read_full_file(node_file)
+            for match in SIO_HEADER_MATCHER.finditer(data):
+                data_len = int(match.group(SIO_HEADER_GROUP_DATA_LENGTH), 16)
+
+                # the original replace and extend
+                end_block_idx = match.end(0) + data_len + 1
+                match_block = data[match.start(0):end_block_idx]
+                orig_len = len(match_block)
+                match_block = match_block.replace(b'\x18\x6b', b'\x2b')
+                match_block = match_block.replace(b'\x18\x58', b'\x18')
+                n_replaced = orig_len - len(match_block)
+                match_block += data[end_block_idx:end_block_idx + n_replaced]
+
+                block, n_consumed = unescape_block(data, match.start(0), SIO_HEADER_LENGTH + data_len)
+                self.assertEqual(str(block), match_block)
+                if len(block) == SIO_HEADER_LENGTH + data_len:
+                    self.assertEqual(n_consumed, end_block_idx + n_replaced - match.start(0))
+                n_escaped += n_replaced
+
+        # make sure escape sequences were exercised
+        self.assertTrue(n_escaped > 0)
+
+    def test_parallel(self):
+        """
+        Test that parsing node files in a process pool gives the same output files and state as parsing serially
+        """
+        runs = [glob.glob(INPUT_GI_PATH + '/gi_*.mdd'),
+                glob.glob(INPUT_FLMB_PATH + '/unit_363-2013-218*.mdd') +
+                glob.glob(INPUT_HYPM_PATH + '/unit_364-2013-225*.mdd'),
+                glob.glob(INPUT_FLMB_PATH + '/unit_*.mdd') + glob.glob(INPUT_HYPM_PATH + '/unit_*.mdd')]
+
+        serial_output = self.run_workers(runs, 1)
+        self.setUp()
+        parallel_output = self.run_workers(runs, 3)
+
+        self.assertEqual(sorted(parallel_output.keys()), sorted(serial_output.keys()))
+        for key in serial_output:
+            if parallel_output[key] != serial_output[key]:
+                self.fail("Parallel output does not match serial output for %s" % key)
+
+    def test_watch(self):
+        """
+        Test that the watcher processes only .mdd files arriving after it starts, once they stop changing, and gives
+        the same output files and state as processing each file in turn
+        """
+        test_files = sorted(glob.glob(INPUT_GI_PATH + '/gi_*.mdd'))
+        watch_dir = tempfile.mkdtemp()
+        try:
+            # a file already in the directory is skipped
+            shutil.copy(test_files[0], watch_dir)
+            watcher = mdd.MddWatcher([watch_dir])
+            self.assertEqual(watcher.poll(), [])
+
+            for test_file in test_files[1:]:
+                shutil.copy(test_file, watch_dir)
+                # the first scan only notes the new file
+                self.assertEqual(watcher.poll(), [])
+                processed = watcher.poll()
+                self.assertEqual([fn for fn, _, _ in processed], [os.path.join(watch_dir, os.path.basename(test_file))])
+                self.assertTrue(processed[0][1] >= processed[0][2] >= 0)
+            watcher.close()
+        finally:
+            shutil.rmtree(watch_dir)
+
+        watch_output = self.run_workers([], 1)
+        self.setUp()
+        serial_output = self.run_workers([[test_file] for test_file in test_files[1:]], 1)
+
+        self.assertEqual(sorted(watch_output.keys()), sorted(serial_output.keys()))
+        for key in serial_output:
+            if watch_output[key] != serial_output[key]:
+                self.fail("Watched output does not match serial output for %s" % key)
+
+    def test_watch_errors(self):
+        """
+        Test that a .mdd file which fails to process is skipped until it changes without stopping the watcher, and
+        that removed files are forgotten
+        """
+        test_files = sorted(glob.glob(INPUT_GI_PATH + '/gi_*.mdd'))
+        watch_dir = tempfile.mkdtemp()
+        try:
+            watcher = mdd.MddWatcher([watch_dir])
+            # an empty file, as when a file is created before it is written
+            bad_file = os.path.join(watch_dir, 'a_bad.mdd')
+            open(bad_file, 'w').close()
+            good_file = os.path.join(watch_dir, os.path.basename(test_files[0]))
+            shutil.copy(test_files[0], good_file)
+            self.assertEqual(watcher.poll(), [])
+            self.assertEqual([fn for fn, _, _ in watcher.poll()], [good_file])
+            self.assertEqual(watcher.done, set([good_file]))
+            self.assertEqual(watcher.failed.keys(), [bad_file])
+            self.assertEqual(watcher.poll(), [])
+
+            # a failed file is retried once it changes
+            shutil.copy(test_files[1], bad_file)
+            os.utime(bad_file, (time.time() + 10, time.time() + 10))
+            self.assertEqual(watcher.poll(), [])
+            self.assertEqual([fn for fn, _, _ in watcher.poll()], [bad_file])
+            self.assertEqual(watcher.failed, {})
+
+            # files removed from the directory are forgotten, whether processed, pending or failed
+            pending_file = os.path.join(watch_dir, 'pending.mdd')
+            failed_file = os.path.join(watch_dir, 'failed.mdd')
+            open(pending_file, 'w').close()
+            open(failed_file, 'w').close()
+            watcher.poll()
+            os.remove(pending_file)
+            watcher.poll()
+            self.assertEqual(watcher.failed.keys(), [failed_file])
+            self.assertEqual(watcher.done, set([good_file, bad_file]))
+            for fn in (good_file, bad_file, failed_file):
+                os.remove(fn)
+            self.assertEqual(watcher.poll(), [])
+            self.assertEqual((watcher.done, watcher.pending, watcher.failed), (set(), {}, {}))
+            watcher.close()
+        finally:
+            shutil.rmtree(watch_dir)
+
+    def test_ingest_error(self):
+        """
+        Test that an .mdd file is released when parsing it fails, after the sections already read are written out,
+        and when its header cannot be read
+        """
+        test_file = os.path.join(INPUT_HYPM_PATH, 'unit_364-2013-206-3-0.mdd')
+        closed = []
+        mdd_close = mdd.mdd.close
+
+        def close(d):
+            closed.append(d.fid)
+            mdd_close(d)
+
+        class FailingWriter(mdd.NodeFileWriter):
+            def write(self, filename, start, data):
+                if self.stats['sections']:
+                    raise IOError('disk full')
+                mdd.NodeFileWriter.write(self, filename, start, data)
+
+        mdd.mdd.close = close
+        try:
+            db = mdd_data.mdd_data()
+            db.reset()
+            writer = FailingWriter()
+            self.assertRaises(IOError, mdd.ingest, db, writer, test_file)
+            self.assertEqual(len(closed), 1)
+            self.assertTrue(closed[0].closed)
+            writer.close()
+            self.assertEqual(os.path.getsize(os.path.join(OUTPUT_PATH, 'node58p1.dat')), 1280)
+
+            # an empty file, which has no header
+            empty_file = os.path.join(OUTPUT_PATH, 'mdd.empty.mdd')
+            open(empty_file, 'w').close()
+            self.assertRaises(ValueError, mdd.ingest, db, writer, empty_file)
+            self.assertEqual(len(closed), 2)
+            self.assertTrue(closed[1].closed)
+        finally:
+            mdd.mdd.close = mdd_close
+
+    def test_profile(self):
+        """
+        Test that profiling gives the same output, and that pool workers return their counters to be merged
+        """
+        test_files = glob.glob(INPUT_FLMB_PATH + '/unit_*.mdd') + glob.glob(INPUT_HYPM_PATH + '/unit_*.mdd')
+        serial_output = self.run_workers([test_files], 1)
+
+        reports = []
+        for workers in (1, 3):
+            self.setUp()
+            profile = PipelineProfile()
+            mdd.procall(test_files, workers=workers, profile=profile)
+            reports.append(json.loads(profile.to_json()))
+            self.assertEqual(self.run_workers([], 1), serial_output)
+
+        for report in reports:
+            self.assertEqual(sorted(report['stages'].keys()),
+                             ['header_match', 'mdd_state_save', 'node_write', 'output_write', 'sio_read',
+                              'sio_state_save', 'tag_scan', 'unescape'])
+            n_blocks = sum(node['blocks'] for node in report['nodes'].values())
+            self.assertTrue(n_blocks > 0)
+            self.assertEqual(sum(instrument['blocks'] for instrument in report['instruments'].values()), n_blocks)
+            self.assertEqual(report['stages']['output_write']['blocks'], n_blocks)
+            self.assertTrue(report['stages']['tag_scan']['mb_per_sec'] > 0)
+
+        # the merged worker counters match the serial counters
+        for table in ('nodes', 'instruments'):
+            for report in reports:
+                for counters in report[table].values():
+                    del counters['secs'], counters['mb_per_sec'], counters['blocks_per_sec']
+            self.assertEqual(reports[1][table], reports[0][table])
+
+    def test_synthetic(self):
+        """
+        Test that every complete block in generated .mdd files without gaps or escapes is found in the instrument
+        group files
+        """
+        mdd_dir = tempfile.mkdtemp()
+        try:
+            deployment = mdd_synth.SyntheticDeployment(gap_fraction=0, escape_density=0, seed=3)
+            mdd.procall(deployment.generate(mdd_dir, 5, 10, 700))
+        finally:
+            shutil.rmtree(mdd_dir)
+
+        for node in deployment.nodes:
+            found = {}
+            for output_file in glob.glob(OUTPUT_PATH + '/node%dp1_*.dat' % node):
+                for match in SIO_HEADER_MATCHER.finditer(self.read_full_file(os.path.basename(output_file))):
+                    instrument_id = match.group(SIO_HEADER_GROUP_ID)
+                    found[instrument_id] = found.get(instrument_id, 0) + 1
+            expected = dict((instrument_id, count) for (block_node, instrument_id), count
+                            in deployment.blocks.iteritems() if block_node == node)
+            self.assertTrue(len(expected) > 1)
+            # the last block generated is incomplete if only part of it was cut into sections
+            n_incomplete = 1 if deployment.streams[node] else 0
+            self.assertEqual(sum(found.values()), sum(expected.values()) - n_incomplete)
+            for instrument_id, count in found.iteritems():
+                self.assertTrue(count <= expected[instrument_id])
+
+    def test_bench_procall(self):
+        """
+        Test that the procall benchmark writes its state into its own data directory, leaving the pickled state
+        files in the real data directory unmigrated and the rest of the directory untouched
+        """
+        with open(os.path.join(OUTPUT_PATH, 'mdd.pckl'), 'wb') as fid:
+            pickle.dump(mdd_data.mdddb(), fid)
+        with open(os.path.join(OUTPUT_PATH, 'sio.pckl'), 'wb') as fid:
+            pickle.dump(SioFileStateInit(), fid)
+        try:
+            before = dict((fn, (os.path.getsize(fn), os.path.getmtime(fn))) for fn in glob.glob(OUTPUT_PATH + '/*'))
+
+            results = benchmark.bench_procall(scales=(1,), n_files=2, sections_per_file=4, section_size=512)
+
+            self.assertEqual(len(results), 1)
+            after = dict((fn, (os.path.getsize(fn), os.path.getmtime(fn))) for fn in glob.glob(OUTPUT_PATH + '/*'))
+            self.assertEqual(after, before)
+        finally:
+            for pickle_file in glob.glob(OUTPUT_PATH + '/*.pckl*'):
+                os.remove(pickle_file)
+
+    def test_scan_window(self):
+        """
+        Test that scanning node files in small windows gives the same output files and state as the default window
+        """
+        test_files = glob.glob(INPUT_GI_PATH + '/gi_*.mdd')
+        test_files.extend(glob.glob(INPUT_HYPM_PATH + '/unit_364-2013-225*.mdd'))
+        mdd.procall(test_files)
+        node_files = [os.path.basename(f) for f in glob.glob(OUTPUT_PATH + '/node*p1.dat')]
+
+        outputs = []
+        for window_size in [None, 40, 1000]:
+            # clear the sio state and output so the node files are parsed again from the start
+            for old_file in glob.glob(OUTPUT_PATH + '/sio.*') + glob.glob(OUTPUT_PATH + '/node*_*.dat'):
+                os.remove(old_file)
+
+            if window_size is None:
+                sio_parse = SioParse()
+            else:
+                sio_parse = SioParse(window_size=window_size)
+            sio_parse.parse_files(node_files)
+            sio_parse.save()
+            sio_parse.close()
+
+            output = {}
+            for output_file in glob.glob(OUTPUT_PATH + '/node*_*.dat'):
+                output[os.path.basename(output_file)] = self.read_full_file(os.path.basename(output_file))
+            for node_file in node_files:
+                output['state ' + node_file] = self.get_file_state(node_file)
+            outputs.append(output)
+
+        self.assertEqual(outputs[1], outputs[0])
+        self.assertEqual(outputs[2], outputs[0])
+
+    def run_workers(self, runs, workers):
+        """
+        Process each list of .mdd files in turn with the given number of workers
+        :param runs: List of lists of .mdd files
+        :param workers: Number of processes parsing node files
+        :return: dictionary of output file name -> data, and node file name -> file state
+        """
+        for test_files in runs:
+            mdd.procall(test_files, workers=workers)
+
+        output = {}
+        for node_file in glob.glob(OUTPUT_PATH + '/node*.dat'):
+            file_name = os.path.basename(node_file)
+            output[file_name] = self.read_full_file(file_name)
+            if file_name.endswith('p1.dat'):
+                output['state ' + file_name] = self.get_file_state(file_name)
+        return output
+
     def check_for_tags(self, data_in):
         """
         Return False if a tag is found in the file, otherwise return true
@@ -648,17 +1373,14 @@ class TestSioUnpack(unittest.TestCase):
 
     def get_file_state(self, filename):
         """
-        Get the file state for this filename from the stored sio pickle file
+        Get the file state for this filename from the stored sio state
         :param filename:
         :return: file state dictionary
         """
-        # load the pickle file
-        pkl_fid = open(OUTPUT_PATH + '/sio.pckl')
-        sio_db = pickle.load(pkl_fid)
-        pkl_fid.close()
-
-        # get the file state for this filename
-        return sio_db.file_state.get(filename)
+        sio_state = SioState()
+        file_state = sio_state.get_file_state(filename)
+        sio_state.close()
+        return file_state
 
     @staticmethod
     def compare_sio_matches(data_orig, data_out):
@@ -732,3 +1454,46 @@ class TestSioUnpack(unittest.TestCase):
                     nodes[snode][1] = sect.end
                     nodes[snode][1] = sect.time
         print nodes
+
+
+def update_list_file_length(file_state, file_len):
+    """
+    The original list update of the unprocessed data for a change in file length
+    """
+    last_size = file_state[StateKey.FILE_SIZE]
+    unprocessed = file_state[StateKey.UNPROCESSED_DATA]
+    if last_size != file_len:
+        if unprocessed == [] and last_size < file_len:
+            unprocessed.append([last_size, file_len])
+            file_state[StateKey.FILE_SIZE] = file_len
+        elif unprocessed != [] and unprocessed[-1][1] < file_len:
+            if last_size > unprocessed[-1][1]:
+                unprocessed.append([last_size, file_len])
+                file_state[StateKey.FILE_SIZE] = file_len
+            elif last_size == unprocessed[-1][1]:
+                unprocessed[-1][1] = file_len
+                file_state[StateKey.FILE_SIZE] = file_len
+
+
+def update_list_processed(file_state, start_idx, end_idx):
+    """
+    The original list update of the unprocessed data after a block has been processed
+    """
+    unprocessed = file_state[StateKey.UNPROCESSED_DATA]
+    for unproc in unprocessed:
+        if start_idx >= unproc[0] and end_idx <= unproc[1]:
+            unprocessed.remove(unproc)
+            if start_idx > unproc[0]:
+                unprocessed.append([unproc[0], start_idx])
+            if end_idx < unproc[1]:
+                unprocessed.append([end_idx, unproc[1]])
+            break
+
+    unprocessed.sort()
+    combined = []
+    for unproc in unprocessed:
+        if combined and combined[-1][1] == unproc[0]:
+            combined[-1][1] = unproc[1]
+        else:
+            combined.append(unproc)
+    file_state[StateKey.UNPROCESSED_DATA] = combined